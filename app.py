@@ -1,4 +1,6 @@
-from fastapi import FastAPI, Header, HTTPException, Depends
+from fastapi import FastAPI, Header, HTTPException, Depends, WebSocket, Request
+from fastapi.responses import StreamingResponse, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from typing import Optional
@@ -6,15 +8,38 @@ from uuid import uuid4, UUID
 from datetime import datetime, timezone, timedelta
 import os
 import json
+import time
+import asyncio
 import base64
 import hmac
 import hashlib
 import secrets
+from concurrent.futures import ThreadPoolExecutor, wait
 
 import psycopg
 from psycopg.errors import UniqueViolation, UndefinedTable
 import requests
-from math import radians, sin, cos, sqrt, atan2
+
+from db import pooled_conn, pool_stats, close_pool
+from geo_cache import geocode_cache, route_cache, normalize_address, ROUTE_CACHE_FALLBACK_TTL_SECONDS
+from http_client import get_client, http_stats, close_clients
+from driver_index import driver_index
+from geo_distance import haversine_miles, distances_from
+from batch_dispatch import batch_dispatcher
+from event_bus import event_bus, location_bus, notification_bus, publish as publish_ride_event, publish_driver_location
+from live_tracking import live_locations
+from dispatch_board import DispatchBoard
+from location_history import ingest_fixes, read_trail, history_maintainer
+from location_buffer import location_buffer
+from location_store import location_store
+from fare import FARE_BASE_USD, FARE_PER_MILE_USD, fare_columns_available, finalize_ride_fare
+from resource_versions import resource_versions, content_etag, etag_matches
+from notification_feed import (
+    NOTIFICATIONS_CURSOR_SETTLE_MS, NOTIFICATIONS_FALLBACK_POLL_SECONDS, NOTIFICATIONS_LONGPOLL_MAX_SECONDS,
+    notification_waiters, encode_cursor, decode_cursor, cursor_floor, recipient_key,
+)
+from notification_counts import unread_count, mark_read, mark_all_read
+from notification_retention import notification_retention
 
 # Stripe integration (optional)
 try:
@@ -24,18 +49,26 @@ except ImportError:
     STRIPE_AVAILABLE = False
     stripe = None
 
+# Route Stripe SDK calls through the shared keep-alive session (latency shows up in /admin/metrics)
+if STRIPE_AVAILABLE and hasattr(stripe, "RequestsClient"):
+    try:
+        stripe.default_http_client = stripe.RequestsClient(session=get_client("stripe").session)
+    except Exception as e:
+        print(f"Warning: Could not attach Stripe to shared HTTP session: {e}")
+
 # Notifications (optional - graceful fallback if module doesn't exist)
 try:
-    from notifications import notify_ride_booked, notify_ride_assigned, notify_ride_status_update
+    # Ride writes queue notifications on their own transaction (outbox, see notification_outbox.py)
+    from notification_outbox import notification_outbox, enqueue as enqueue_notification, enqueue_many as enqueue_notifications
+    from notifications import notifies_status
     NOTIFICATIONS_AVAILABLE = True
 except ImportError:
     NOTIFICATIONS_AVAILABLE = False
+    notification_outbox = None
     # Define no-op functions if notifications module not available
-    def notify_ride_booked(*args, **kwargs):
-        pass
-    def notify_ride_assigned(*args, **kwargs):
+    def enqueue_notification(*args, **kwargs):
         pass
-    def notify_ride_status_update(*args, **kwargs):
+    def enqueue_notifications(*args, **kwargs):
         pass
 
 
@@ -94,6 +127,17 @@ JWT_SECRET = _get_env("GLOBAPP_JWT_SECRET") or ""
 ACCESS_TOKEN_MINUTES = int(_get_env("GLOBAPP_ACCESS_TOKEN_MINUTES") or "15")
 REFRESH_TOKEN_DAYS = int(_get_env("GLOBAPP_REFRESH_TOKEN_DAYS") or "30")
 
+# Quote tokens (quote_id returned by /rides/quote, accepted by /rides and /payment/create-intent)
+QUOTE_SECRET = _get_env("GLOBAPP_QUOTE_SECRET") or JWT_SECRET
+QUOTE_TTL_MINUTES = int(_get_env("GLOBAPP_QUOTE_TTL_MINUTES") or "15")
+
+# Stream tokens (?token= for EventSource feeds, issued by POST /dispatch/board/stream-token)
+STREAM_TOKEN_SECONDS = int(_get_env("GLOBAPP_STREAM_TOKEN_SECONDS") or "60")
+
+# Geocoding fan-out: pickup + dropoff are looked up concurrently, with one deadline for the pair
+GEOCODE_WORKERS = int(_get_env("GLOBAPP_GEOCODE_WORKERS") or "8")
+GEOCODE_PAIR_DEADLINE_SECONDS = float(_get_env("GLOBAPP_GEOCODE_PAIR_DEADLINE_SECONDS") or "10")
+
 # Presence thresholds (seconds). Used by /dispatch/driver-presence and helper presence_status().
 PRESENCE_ONLINE_SECONDS = int(_get_env("GLOBAPP_PRESENCE_ONLINE_SECONDS") or "60")   # <= 60s => online
 PRESENCE_STALE_SECONDS = int(_get_env("GLOBAPP_PRESENCE_STALE_SECONDS") or "600")   # <= 10m => stale
@@ -103,6 +147,18 @@ PRESENCE_STALE_SECONDS = int(_get_env("GLOBAPP_PRESENCE_STALE_SECONDS") or "600"
 AUTO_ASSIGNMENT_ENABLED_ENV = _get_env("GLOBAPP_AUTO_ASSIGNMENT_ENABLED")
 AUTO_ASSIGNMENT_ENABLED_DEFAULT = AUTO_ASSIGNMENT_ENABLED_ENV.lower() == "true" if AUTO_ASSIGNMENT_ENABLED_ENV else False
 
+# Auto-assign candidate search (driver_index.py): nearest N drivers, optionally within a radius (0 = no limit)
+AUTO_ASSIGN_CANDIDATES = int(_get_env("GLOBAPP_AUTO_ASSIGN_CANDIDATES") or "25")
+AUTO_ASSIGN_RADIUS_MILES = float(_get_env("GLOBAPP_AUTO_ASSIGN_RADIUS_MILES") or "0")
+AUTO_ASSIGN_MAX_LOCATION_AGE_SECONDS = 3600  # same 1 hour freshness window as before
+
+# Batched driver location upload (POST /driver/location/batch)
+LOCATION_BATCH_MAX_FIXES = int(_get_env("GLOBAPP_LOCATION_BATCH_MAX_FIXES") or "500")
+LOCATION_MAX_FUTURE_SKEW_SECONDS = int(_get_env("GLOBAPP_LOCATION_MAX_FUTURE_SKEW_SECONDS") or "120")
+
+# Trip replay (GET /drivers/{driver_id}/location-history, /rides/{ride_id}/trail)
+LOCATION_TRAIL_MAX_POINTS = int(_get_env("GLOBAPP_LOCATION_TRAIL_MAX_POINTS") or "5000")
+
 
 def require_public_key(x_api_key: str | None):
     # If PUBLIC_KEY is not set, do not block (keeps backward compatibility)
@@ -120,9 +176,28 @@ def require_admin_key(x_api_key: str | None):
 
 
 def db_conn():
+    """Borrow a connection from the process-wide pool (db.py). Use as: `with db_conn() as conn:`"""
     if not DB_URL:
         raise HTTPException(status_code=500, detail="DATABASE_URL is not configured")
-    return psycopg.connect(DB_URL)
+    return pooled_conn()
+
+
+# -----------------------------
+# Conditional GET (ETag / If-None-Match, see resource_versions.py)
+# -----------------------------
+def _not_modified(etag: str) -> Response:
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": "no-cache"})
+
+
+def _tagged(response: Response, if_none_match: str | None, etag: str | None, body):
+    """Return body with its ETag; 304 if the client has it. Without a version, tag by content hash."""
+    if etag is None:
+        etag = content_etag(body)
+        if etag_matches(if_none_match, etag):
+            return _not_modified(etag)
+    response.headers["ETag"] = etag
+    response.headers["Cache-Control"] = "no-cache"
+    return body
 
 
 # -----------------------------
@@ -170,8 +245,15 @@ def calculate_distance_duration(pickup: str, dropoff: str) -> tuple[float, float
     Uses Google Maps Directions API for accurate road distance if API key is available.
     Falls back to Nominatim geocoding + Haversine formula if Google Maps API is not configured.
     
+    Provider results are cached per pickup/dropoff pair (route_cache), so quote -> book
+    for the same trip only calls the provider once.
+    
     Returns: (distance_miles, duration_minutes)
     """
+    cached_route = route_cache.get(pickup, dropoff)
+    if cached_route:
+        return cached_route
+    
     # Try Google Maps Directions API first (most accurate - actual road distance)
     if GOOGLE_MAPS_API_KEY:
         try:
@@ -182,7 +264,7 @@ def calculate_distance_duration(pickup: str, dropoff: str) -> tuple[float, float
                 "key": GOOGLE_MAPS_API_KEY,
                 "units": "imperial"  # Get distance in miles
             }
-            directions_response = requests.get(directions_url, params=params, timeout=10)
+            directions_response = get_client("google_maps").get(directions_url, params=params)
             
             if directions_response.status_code == 200:
                 directions_data = directions_response.json()
@@ -200,7 +282,13 @@ def calculate_distance_duration(pickup: str, dropoff: str) -> tuple[float, float
                     duration_minutes = duration_seconds / 60
                     
                     if distance_miles > 0:
-                        return (round(distance_miles, 2), round(duration_minutes, 1))
+                        result = (round(distance_miles, 2), round(duration_minutes, 1))
+                        route_cache.put(pickup, dropoff, result[0], result[1], provider="google_directions")
+                        # Directions already geocoded both ends; keep them for quotes and auto-assign
+                        for address, loc in ((pickup, leg.get("start_location")), (dropoff, leg.get("end_location"))):
+                            if loc and loc.get("lat") is not None and loc.get("lng") is not None:
+                                geocode_cache.put(address, (float(loc["lat"]), float(loc["lng"])))
+                        return result
                 else:
                     print(f"Warning: Google Directions API returned status: {directions_data.get('status')}")
         except requests.exceptions.RequestException as e:
@@ -209,69 +297,35 @@ def calculate_distance_duration(pickup: str, dropoff: str) -> tuple[float, float
             print(f"Google Directions API error: {e}")
     
     # Fallback to Nominatim geocoding + Haversine formula (straight-line distance)
+    # geocode_pair() goes through the geocode cache, so repeat addresses make no HTTP call
     try:
-        # Geocode addresses using Nominatim (free, no API key required)
-        nominatim_url = "https://nominatim.openstreetmap.org/search"
-        headers = {
-            "User-Agent": "GlobApp/1.0"  # Required by Nominatim
-        }
-        
-        # Geocode pickup
-        pickup_params = {
-            "q": pickup,
-            "format": "json",
-            "limit": 1,
-            "countrycodes": "us"
-        }
-        pickup_response = requests.get(nominatim_url, params=pickup_params, headers=headers, timeout=10)
-        
-        # Geocode dropoff
-        dropoff_params = {
-            "q": dropoff,
-            "format": "json",
-            "limit": 1,
-            "countrycodes": "us"
-        }
-        dropoff_response = requests.get(nominatim_url, params=dropoff_params, headers=headers, timeout=10)
+        pickup_coords, dropoff_coords = geocode_pair(pickup, dropoff)
         
-        if pickup_response.status_code == 200 and dropoff_response.status_code == 200:
-            pickup_data = pickup_response.json()
-            dropoff_data = dropoff_response.json()
+        if pickup_coords and dropoff_coords:
+            pickup_lat, pickup_lon = pickup_coords
+            dropoff_lat, dropoff_lon = dropoff_coords
             
-            if pickup_data and dropoff_data and len(pickup_data) > 0 and len(dropoff_data) > 0:
-                pickup_lat = float(pickup_data[0]["lat"])
-                pickup_lon = float(pickup_data[0]["lon"])
-                dropoff_lat = float(dropoff_data[0]["lat"])
-                dropoff_lon = float(dropoff_data[0]["lon"])
-                
-                # Calculate distance using Haversine formula (straight-line distance)
-                R = 3959  # Earth radius in miles
-                lat1, lon1 = radians(pickup_lat), radians(pickup_lon)
-                lat2, lon2 = radians(dropoff_lat), radians(dropoff_lon)
-                
-                dlat = lat2 - lat1
-                dlon = lon2 - lon1
-                
-                a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-                c = 2 * atan2(sqrt(a), sqrt(1-a))
-                distance_miles = R * c
-                
-                # Estimate duration: assume average speed of 25 mph in city traffic
-                # Add 2 minutes base time for pickup/dropoff
-                # Note: This is less accurate than Google Directions API
-                duration_minutes = (distance_miles / 25) * 60 + 2
-                
-                # Return valid distance (should be > 0 if geocoding succeeded)
-                if distance_miles > 0:
-                    return (round(distance_miles, 2), round(duration_minutes, 1))
-                else:
-                    print(f"Warning: Geocoding returned 0 distance. Pickup: {pickup_lat},{pickup_lon}, Dropoff: {dropoff_lat},{dropoff_lon}")
+            # Calculate distance using Haversine formula (straight-line distance)
+            distance_miles = haversine_miles(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
+            
+            # Estimate duration: assume average speed of 25 mph in city traffic
+            # Add 2 minutes base time for pickup/dropoff
+            # Note: This is less accurate than Google Directions API
+            duration_minutes = (distance_miles / 25) * 60 + 2
+            
+            # Return valid distance (should be > 0 if geocoding succeeded)
+            if distance_miles > 0:
+                result = (round(distance_miles, 2), round(duration_minutes, 1))
+                # Short TTL: one Directions outage must not pin an underpriced straight line for a day
+                route_cache.put(
+                    pickup, dropoff, result[0], result[1],
+                    provider="nominatim_haversine", ttl_seconds=ROUTE_CACHE_FALLBACK_TTL_SECONDS,
+                )
+                return result
             else:
-                print(f"Warning: Geocoding returned empty results. Pickup: {pickup}, Dropoff: {dropoff}")
+                print(f"Warning: Geocoding returned 0 distance. Pickup: {pickup_lat},{pickup_lon}, Dropoff: {dropoff_lat},{dropoff_lon}")
         else:
-            print(f"Warning: Geocoding API returned non-200 status. Pickup: {pickup_response.status_code}, Dropoff: {dropoff_response.status_code}")
-    except requests.exceptions.RequestException as e:
-        print(f"Geocoding network error: {e}")
+            print(f"Warning: Geocoding returned empty results. Pickup: {pickup}, Dropoff: {dropoff}")
     except Exception as e:
         print(f"Geocoding error: {e}")
     
@@ -297,16 +351,7 @@ def calculate_distance_duration(pickup: str, dropoff: str) -> tuple[float, float
             pickup_lat, pickup_lon = 33.0462, -96.9942
         
         # Calculate distance using Haversine formula
-        R = 3959  # Earth radius in miles
-        lat1, lon1 = radians(pickup_lat), radians(pickup_lon)
-        lat2, lon2 = radians(dropoff_lat), radians(dropoff_lon)
-        
-        dlat = lat2 - lat1
-        dlon = lon2 - lon1
-        
-        a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-        c = 2 * atan2(sqrt(a), sqrt(1-a))
-        distance_miles = R * c
+        distance_miles = haversine_miles(pickup_lat, pickup_lon, dropoff_lat, dropoff_lon)
         
         # Estimate duration: assume average speed of 25 mph
         duration_minutes = (distance_miles / 25) * 60 + 2
@@ -368,57 +413,76 @@ def get_setting(key: str, default: bool = False) -> bool:
     return default
 
 
+def _nominatim_geocode(address: str) -> tuple[float, float] | None:
+    """
+    Single Nominatim lookup (no caching).
+    Returns (lat, lng), None if Nominatim has no result, and raises on network/HTTP errors
+    so that transient failures are not negative-cached.
+    """
+    nominatim_url = "https://nominatim.openstreetmap.org/search"
+    headers = {
+        "User-Agent": "GlobApp/1.0"  # Required by Nominatim
+    }
+    params = {
+        "q": address,
+        "format": "json",
+        "limit": 1,
+        "countrycodes": "us"
+    }
+    response = get_client("nominatim").get(nominatim_url, params=params, headers=headers)
+    response.raise_for_status()
+    
+    data = response.json()
+    if data and len(data) > 0:
+        return (float(data[0]["lat"]), float(data[0]["lon"]))
+    return None
+
+
 def geocode_address(address: str) -> tuple[float, float] | None:
     """
     Geocode an address to coordinates using Nominatim.
+    Results (including not-found) are cached in memory and in the geocode_cache table.
     Returns (lat, lng) or None if geocoding fails.
     """
     try:
-        nominatim_url = "https://nominatim.openstreetmap.org/search"
-        headers = {
-            "User-Agent": "GlobApp/1.0"  # Required by Nominatim
-        }
-        params = {
-            "q": address,
-            "format": "json",
-            "limit": 1,
-            "countrycodes": "us"
-        }
-        response = requests.get(nominatim_url, params=params, headers=headers, timeout=10)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                lat = float(data[0]["lat"])
-                lon = float(data[0]["lon"])
-                return (lat, lon)
-        
-        print(f"Warning: Geocoding failed for address: {address}")
-        return None
+        coords = geocode_cache.lookup(address, _nominatim_geocode)
+        if coords is None:
+            print(f"Warning: Geocoding failed for address: {address}")
+        return coords
     except Exception as e:
         print(f"Geocoding error for '{address}': {e}")
         return None
 
 
+_geocode_executor = ThreadPoolExecutor(max_workers=GEOCODE_WORKERS, thread_name_prefix="geocode")
+
+
+def geocode_pair(pickup: str, dropoff: str) -> tuple[tuple[float, float] | None, tuple[float, float] | None]:
+    """
+    Geocode pickup and dropoff concurrently.
+    Waits at most GEOCODE_PAIR_DEADLINE_SECONDS for both; a lookup that misses the deadline
+    returns None here but keeps running and still fills the cache for the next request.
+    """
+    pickup_future = _geocode_executor.submit(geocode_address, pickup)
+    dropoff_future = _geocode_executor.submit(geocode_address, dropoff)
+    wait([pickup_future, dropoff_future], timeout=GEOCODE_PAIR_DEADLINE_SECONDS)
+
+    results = []
+    for address, future in ((pickup, pickup_future), (dropoff, dropoff_future)):
+        if future.done():
+            results.append(future.result())
+        else:
+            print(f"Warning: Geocoding exceeded {GEOCODE_PAIR_DEADLINE_SECONDS}s deadline for: {address}")
+            results.append(None)
+    return results[0], results[1]
+
+
 def calculate_distance_miles(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
     """
     Calculate distance between two coordinates using Haversine formula.
     Returns distance in miles.
     """
-    R = 3959  # Earth radius in miles
-    lat1_rad = radians(lat1)
-    lon1_rad = radians(lon1)
-    lat2_rad = radians(lat2)
-    lon2_rad = radians(lon2)
-    
-    dlat = lat2_rad - lat1_rad
-    dlon = lon2_rad - lon1_rad
-    
-    a = sin(dlat/2)**2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1-a))
-    distance_miles = R * c
-    
-    return round(distance_miles, 2)
+    return round(haversine_miles(lat1, lon1, lat2, lon2), 2)
 
 
 # -----------------------------
@@ -519,6 +583,110 @@ def make_refresh_token() -> str:
     return secrets.token_urlsafe(48)
 
 
+# -----------------------------
+# Quote tokens (signed, short-lived)
+# -----------------------------
+def make_quote_token(
+    pickup: str,
+    dropoff: str,
+    service_type: str,
+    distance_miles: float,
+    duration_min: float,
+    price_usd: float,
+) -> tuple[str, datetime] | tuple[None, None]:
+    """
+    Sign the computed quote so /rides and /payment/create-intent can reuse it
+    instead of calling the routing providers again. Returns (None, None) if no secret is configured.
+    """
+    if not QUOTE_SECRET:
+        return None, None
+    now = datetime.now(timezone.utc)
+    exp = now + timedelta(minutes=QUOTE_TTL_MINUTES)
+    pickup_coords = geocode_cache.peek(pickup)
+    dropoff_coords = geocode_cache.peek(dropoff)
+    payload = {
+        "typ": "quote",
+        "qid": str(uuid4()),
+        "pickup": pickup,
+        "dropoff": dropoff,
+        "service_type": service_type,
+        "distance_miles": distance_miles,
+        "duration_min": duration_min,
+        "price_usd": price_usd,
+        "pickup_coords": list(pickup_coords) if pickup_coords else None,
+        "dropoff_coords": list(dropoff_coords) if dropoff_coords else None,
+        "iat": int(now.timestamp()),
+        "exp": int(exp.timestamp()),
+    }
+    return jwt_encode(payload, QUOTE_SECRET), exp
+
+
+def read_quote_token(
+    token: str | None,
+    pickup: str | None = None,
+    dropoff: str | None = None,
+    service_type: str | None = None,
+) -> dict | None:
+    """
+    Verify a quote token and check it was issued for this trip.
+    Returns the quote payload, or None if missing/invalid/expired/mismatched (caller recomputes).
+    """
+    if not token or not QUOTE_SECRET:
+        return None
+    try:
+        quote = jwt_decode(token, QUOTE_SECRET)
+    except HTTPException as e:
+        print(f"Info: Ignoring quote token ({e.detail})")
+        return None
+    except Exception:
+        print("Info: Ignoring malformed quote token")
+        return None
+
+    if quote.get("typ") != "quote":
+        return None
+    if pickup is not None and normalize_address(quote.get("pickup", "")) != normalize_address(pickup):
+        return None
+    if dropoff is not None and normalize_address(quote.get("dropoff", "")) != normalize_address(dropoff):
+        return None
+    if service_type is not None and quote.get("service_type") != service_type:
+        return None
+    return quote
+
+
+# -----------------------------
+# Stream tokens (signed, short-lived)
+# -----------------------------
+def make_stream_token(stream: str) -> tuple[str, datetime]:
+    """
+    Sign a token that opens one admin stream. EventSource can't send headers, so the stream
+    accepts this in the query string instead of the admin key (URLs end up in access logs).
+    """
+    require_jwt_secret()
+    now = datetime.now(timezone.utc)
+    exp = now + timedelta(seconds=STREAM_TOKEN_SECONDS)
+    payload = {
+        "typ": "stream",
+        "stream": stream,
+        "iat": int(now.timestamp()),
+        "exp": int(exp.timestamp()),
+    }
+    return jwt_encode(payload, JWT_SECRET), exp
+
+
+def require_stream_token(token: str | None, stream: str):
+    if not token:
+        raise HTTPException(status_code=401, detail="Missing stream token")
+    require_jwt_secret()
+    try:
+        payload = jwt_decode(token, JWT_SECRET)
+    except HTTPException:
+        raise
+    except Exception:
+        raise HTTPException(status_code=401, detail="Invalid token format")
+    if payload.get("typ") != "stream" or payload.get("stream") != stream:
+        raise HTTPException(status_code=401, detail="Invalid token type")
+
+
 # -----------------------------
 # Bearer token parsing (robust)
 # -----------------------------
@@ -583,6 +751,7 @@ class RideCreateIn(BaseModel):
     pickup: str
     dropoff: str
     service_type: str = "economy"
+    quote_id: Optional[str] = None  # token from /rides/quote; skips recomputing distance/price
 
 
 class DriverCreateIn(BaseModel):
@@ -612,6 +781,14 @@ class DriverLocationUpsert(BaseModel):
     accuracy_m: float | None = Field(default=None, ge=0)
 
 
+class DriverLocationFix(DriverLocationUpsert):
+    recorded_at_utc: datetime  # device GPS time; naive values are taken as UTC
+
+
+class DriverLocationBatchIn(BaseModel):
+    fixes: list[DriverLocationFix]
+
+
 class RideAssignIn(BaseModel):
     driver_id: UUID
 
@@ -635,6 +812,13 @@ class RiderLocationUpsert(BaseModel):
     accuracy_m: float | None = Field(default=None, ge=0)
 
 
+class NotificationsReadAllIn(BaseModel):
+    recipient_type: str
+    recipient_id: Optional[UUID] = None  # None for admin (broadcast)
+    up_to: Optional[str] = None  # cursor (X-Next-Cursor); only notifications at or before it
+    up_to_id: Optional[UUID] = None  # or: the newest notification the client has shown
+
+
 # -----------------------------
 # Existing (keep)
 # -----------------------------
@@ -671,25 +855,98 @@ def v1_time():
     return {"utc": datetime.now(timezone.utc).isoformat()}
 
 
+@app.on_event("startup")
+def _start_background_jobs():
+    resource_versions.start()  # subscribe before the listener connects
+    notification_waiters.start()
+    event_bus.start()
+    location_bus.start()
+    notification_bus.start()
+    location_store.start()
+    batch_dispatcher.start(_batch_dispatch_tick)
+    location_buffer.start()
+    history_maintainer.start()
+    notification_retention.start()
+    if notification_outbox:
+        notification_outbox.start()
+
+
+@app.on_event("shutdown")
+def _shutdown_resources():
+    batch_dispatcher.stop()
+    history_maintainer.stop()
+    notification_retention.stop()
+    if notification_outbox:
+        notification_outbox.stop()
+    location_buffer.stop()  # flushes buffered fixes; needs the pool, so before close_pool()
+    location_store.stop()
+    resource_versions.stop()
+    notification_waiters.stop()
+    event_bus.stop()
+    location_bus.stop()
+    notification_bus.stop()
+    _geocode_executor.shutdown(wait=False, cancel_futures=True)
+    close_clients()
+    close_pool()
+
+
 # -----------------------------
-# Rides (PUBLIC key)
+# Metrics (ADMIN key)
 # -----------------------------
-@app.post("/api/v1/rides/quote")
-def rides_quote(payload: RideQuoteIn, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
-    require_public_key(x_api_key)
+@app.get("/api/v1/admin/metrics")
+def admin_metrics(x_api_key: str | None = Header(default=None, alias="X-API-Key")):
+    """Process-level runtime metrics (this worker only)."""
+    require_admin_key(x_api_key)
+    return {
+        "db_pool": pool_stats(),
+        "geocode_cache": geocode_cache.stats(),
+        "route_cache": route_cache.stats(),
+        "http_clients": http_stats(),
+        "driver_index": driver_index.stats(),
+        "batch_dispatch": batch_dispatcher.stats(),
+        "event_bus": event_bus.stats(),
+        "location_bus": location_bus.stats(),
+        "live_tracking": live_locations.stats(),
+        "dispatch_board": dispatch_board.stats(),
+        "location_buffer": location_buffer.stats(),
+        "location_store": location_store.stats(),
+        "location_history": history_maintainer.stats(),
+        "resource_versions": resource_versions.stats(),
+        "notification_outbox": notification_outbox.stats() if notification_outbox else None,
+        "notification_bus": notification_bus.stats(),
+        "notification_feed": notification_waiters.stats(),
+        "notification_retention": notification_retention.stats(),
+    }
 
+
+# -----------------------------
+# Rides (PUBLIC key)
+# -----------------------------
+def build_quote(payload: RideQuoteIn) -> dict:
+    """Compute a fare quote and sign it as quote_id (shared by /rides/quote and /fare/estimate)."""
     # Calculate real distance and duration
     estimated_distance_miles, estimated_duration_min = calculate_distance_duration(
         payload.pickup, 
         payload.dropoff
     )
     
-    base = 4.00
-    per_mile = 2.80
+    base = FARE_BASE_USD
+    per_mile = FARE_PER_MILE_USD
     distance_fare = per_mile * estimated_distance_miles
     price = round(base + distance_fare, 2)
 
+    quote_id, quote_expires_at = make_quote_token(
+        pickup=payload.pickup,
+        dropoff=payload.dropoff,
+        service_type=payload.service_type,
+        distance_miles=estimated_distance_miles,
+        duration_min=estimated_duration_min,
+        price_usd=price,
+    )
+
     return {
+        "quote_id": quote_id,
+        "quote_expires_at_utc": quote_expires_at.replace(tzinfo=None).isoformat() if quote_expires_at else None,
         "service_type": payload.service_type,
         "estimated_distance_miles": estimated_distance_miles,
         "estimated_duration_min": estimated_duration_min,
@@ -705,51 +962,44 @@ def rides_quote(payload: RideQuoteIn, x_api_key: str | None = Header(default=Non
     }
 
 
+@app.post("/api/v1/rides/quote")
+def rides_quote(payload: RideQuoteIn, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
+    require_public_key(x_api_key)
+    return build_quote(payload)
+
+
 @app.post("/api/v1/fare/estimate")
 def fare_estimate(payload: RideQuoteIn, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
     """Alias for /api/v1/rides/quote - returns fare estimate with breakdown"""
     require_public_key(x_api_key)
-
-    # Calculate real distance and duration
-    estimated_distance_miles, estimated_duration_min = calculate_distance_duration(
-        payload.pickup, 
-        payload.dropoff
-    )
-    
-    base = 4.00
-    per_mile = 2.80
-    distance_fare = per_mile * estimated_distance_miles
-    price = round(base + distance_fare, 2)
-
-    return {
-        "service_type": payload.service_type,
-        "estimated_distance_miles": estimated_distance_miles,
-        "estimated_duration_min": estimated_duration_min,
-        "estimated_price_usd": price,
-        "total_estimated_usd": price,
-        "breakdown": {
-            "base_fare": base,
-            "distance_fare": round(distance_fare, 2),
-            "time_fare": 0,
-            "booking_fee": 0,
-            "total_estimated": price,
-        },
-    }
+    return build_quote(payload)
 
 
 @app.post("/api/v1/rides")
 def create_ride(payload: RideCreateIn, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
     require_public_key(x_api_key)
 
-    # Calculate real distance and duration
-    estimated_distance_miles, estimated_duration_min = calculate_distance_duration(
-        payload.pickup, 
-        payload.dropoff
-    )
-    
-    base = 4.00
-    per_mile = 2.80
-    estimated_price_usd = round(base + per_mile * estimated_distance_miles, 2)
+    # Reuse the signed quote when the client passes it back (no second routing call)
+    quote = read_quote_token(payload.quote_id, payload.pickup, payload.dropoff, payload.service_type)
+    if quote:
+        estimated_distance_miles = float(quote["distance_miles"])
+        estimated_duration_min = float(quote["duration_min"])
+        estimated_price_usd = float(quote["price_usd"])
+        # Geocoded ends travel with the quote; seed this worker's cache for auto-assign
+        if quote.get("pickup_coords"):
+            geocode_cache.prime(payload.pickup, quote["pickup_coords"])
+        if quote.get("dropoff_coords"):
+            geocode_cache.prime(payload.dropoff, quote["dropoff_coords"])
+    else:
+        # Calculate real distance and duration
+        estimated_distance_miles, estimated_duration_min = calculate_distance_duration(
+            payload.pickup, 
+            payload.dropoff
+        )
+        
+        base = FARE_BASE_USD
+        per_mile = FARE_PER_MILE_USD
+        estimated_price_usd = round(base + per_mile * estimated_distance_miles, 2)
 
     ride_id = uuid4()
     created_at_utc = datetime.now(timezone.utc).replace(tzinfo=None)
@@ -812,26 +1062,23 @@ def create_ride(payload: RideCreateIn, x_api_key: str | None = Header(default=No
                         created_at_utc,
                     ),
                 )
+                publish_ride_event(cur, "ride.created", ride_id, status="requested", service_type=payload.service_type)
+                # Notifications commit with the ride
+                if NOTIFICATIONS_AVAILABLE:
+                    enqueue_notification(
+                        cur,
+                        "ride_booked",
+                        ride_id=ride_id,
+                        rider_name=payload.rider_name,
+                        pickup=payload.pickup,
+                        dropoff=payload.dropoff,
+                    )
                 conn.commit()
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB insert failed: {e}")
 
-    # Send notifications (graceful fallback if notifications not available)
-    try:
-        if NOTIFICATIONS_AVAILABLE:
-            notify_ride_booked(
-                ride_id=ride_id,
-                rider_name=payload.rider_name,
-                pickup=payload.pickup,
-                dropoff=payload.dropoff,
-                rider_phone=rider_phone_e164,
-            )
-    except Exception as notify_error:
-        # Don't fail the request if notification fails
-        print(f"Warning: Failed to send ride booked notification: {notify_error}")
-
     return {
         "ride_id": str(ride_id),
         "status": "requested",
@@ -841,6 +1088,7 @@ def create_ride(payload: RideCreateIn, x_api_key: str | None = Header(default=No
         "estimated_distance_miles": estimated_distance_miles,
         "estimated_duration_min": estimated_duration_min,
         "service_type": payload.service_type,
+        "quote_id": quote["qid"] if quote else None,
     }
 
 
@@ -905,10 +1153,19 @@ def get_my_rides(
 
 
 @app.get("/api/v1/rides/{ride_id}")
-def get_ride(ride_id: UUID, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
-    """Get ride details including driver and payment information"""
+def get_ride(
+    ride_id: UUID,
+    response: Response,
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
+):
+    """Get ride details including driver and payment information (send If-None-Match when polling)"""
     require_public_key(x_api_key)
 
+    etag = resource_versions.etag("ride", ride_id)
+    if resource_versions.not_modified(if_none_match, etag):
+        return _not_modified(etag)
+
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
@@ -946,6 +1203,19 @@ def get_ride(ride_id: UUID, x_api_key: str | None = Header(default=None, alias="
                     (str(ride_id),)
                 )
                 payment_row = cur.fetchone()
+
+                # Fare finalized from the GPS trail at completion (migration 014)
+                final_fare_row = None
+                if ride_row[6] == "completed" and fare_columns_available(cur):
+                    cur.execute(
+                        """
+                        SELECT final_fare_usd, actual_distance_miles, actual_duration_min, fare_source
+                        FROM rides
+                        WHERE id = %s
+                        """,
+                        (str(ride_id),)
+                    )
+                    final_fare_row = cur.fetchone()
                 
     except HTTPException:
         raise
@@ -965,7 +1235,7 @@ def get_ride(ride_id: UUID, x_api_key: str | None = Header(default=None, alias="
         "estimated_distance_miles": float(ride_row[7]) if ride_row[7] else None,
         "estimated_duration_min": float(ride_row[8]) if ride_row[8] else None,
         "estimated_price_usd": float(ride_row[9]) if ride_row[9] else None,
-        "final_fare_usd": None,  # Column doesn't exist in rides table - get from payment if available
+        "final_fare_usd": None,  # set at completion (trail-priced); else from payment if available
         "created_at_utc": ride_row[10].isoformat() if ride_row[10] else None,
         "assigned_at_utc": ride_row[11].isoformat() if ride_row[11] else None,
         "enroute_at_utc": ride_row[12].isoformat() if ride_row[12] else None,
@@ -981,8 +1251,8 @@ def get_ride(ride_id: UUID, x_api_key: str | None = Header(default=None, alias="
     
     # Add fare quote breakdown
     if ride_data["estimated_price_usd"]:
-        base = 4.00
-        per_mile = 2.80
+        base = FARE_BASE_USD
+        per_mile = FARE_PER_MILE_USD
         distance_fare = per_mile * (ride_data["estimated_distance_miles"] or 0)
         ride_data["fare_quote"] = {
             "distance_miles": ride_data["estimated_distance_miles"],
@@ -1012,8 +1282,14 @@ def get_ride(ride_id: UUID, x_api_key: str | None = Header(default=None, alias="
         # Use payment amount as final fare if payment exists
         if payment_amount_usd:
             ride_data["final_fare_usd"] = payment_amount_usd
+
+    if final_fare_row and final_fare_row[0] is not None:
+        ride_data["final_fare_usd"] = float(final_fare_row[0])
+        ride_data["actual_distance_miles"] = float(final_fare_row[1]) if final_fare_row[1] is not None else None
+        ride_data["actual_duration_min"] = float(final_fare_row[2]) if final_fare_row[2] is not None else None
+        ride_data["fare_source"] = final_fare_row[3]
     
-    return ride_data
+    return _tagged(response, if_none_match, etag, ride_data)
 
 
 @app.post("/api/v1/rides/{ride_id}/cancel")
@@ -1036,9 +1312,10 @@ def rider_cancel_ride(
             with conn.cursor() as cur:
                 cur.execute(
                     """
-                    SELECT rider_name, rider_phone_e164, status, assigned_driver_id, pickup, dropoff
-                    FROM rides
-                    WHERE id = %s
+                    SELECT r.rider_name, r.rider_phone_e164, r.status, r.assigned_driver_id, r.pickup, r.dropoff, d.name
+                    FROM rides r
+                    LEFT JOIN drivers d ON d.id = r.assigned_driver_id
+                    WHERE r.id = %s
                     """,
                     (str(ride_id),),
                 )
@@ -1046,7 +1323,7 @@ def rider_cancel_ride(
                 if not row:
                     raise HTTPException(status_code=404, detail="Ride not found")
 
-                rider_name, ride_phone_e164, current_status, assigned_driver_id, pickup, dropoff = row
+                rider_name, ride_phone_e164, current_status, assigned_driver_id, pickup, dropoff, driver_name = row
                 status_norm = (current_status or "").strip().lower()
 
                 if ride_phone_e164 != phone_norm:
@@ -1067,28 +1344,23 @@ def rider_cancel_ride(
                     """,
                     (now_utc, str(ride_id)),
                 )
-                conn.commit()
-
-        # Best-effort notifications
-        try:
-            if NOTIFICATIONS_AVAILABLE and assigned_driver_id:
-                driver_name = ""
-                with db_conn() as conn:
-                    with conn.cursor() as cur:
-                        cur.execute("SELECT name FROM drivers WHERE id = %s", (str(assigned_driver_id),))
-                        drow = cur.fetchone()
-                        driver_name = drow[0] if drow else "Driver"
-                notify_ride_status_update(
-                    ride_id=ride_id,
-                    driver_id=assigned_driver_id,
-                    driver_name=driver_name,
-                    rider_name=rider_name,
-                    pickup=pickup,
-                    dropoff=dropoff,
-                    status="cancelled",
+                publish_ride_event(
+                    cur, "ride.cancelled", ride_id, status="cancelled",
+                    driver_id=assigned_driver_id, previous_status=status_norm, cancelled_by="rider",
                 )
-        except Exception as notify_error:
-            print(f"Warning: Failed to send rider cancel notification: {notify_error}")
+                if NOTIFICATIONS_AVAILABLE and assigned_driver_id:
+                    enqueue_notification(
+                        cur,
+                        "ride_status",
+                        ride_id=ride_id,
+                        driver_id=assigned_driver_id,
+                        driver_name=driver_name or "Driver",
+                        rider_name=rider_name,
+                        pickup=pickup,
+                        dropoff=dropoff,
+                        status="cancelled",
+                    )
+                conn.commit()
 
     except HTTPException:
         raise
@@ -1098,57 +1370,100 @@ def rider_cancel_ride(
     return {"ok": True, "ride_id": str(ride_id), "status": "cancelled", "cancelled_at_utc": now_utc.isoformat()}
 
 
+def _load_ride_driver_location(ride_id: UUID) -> tuple | None:
+    """(status, assigned_driver_id, location_row | None) for a ride in one query; None if no such ride."""
+    if location_store.ready:
+        # Position from memory; only the ride itself is read
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT status, assigned_driver_id FROM rides WHERE id = %s", (str(ride_id),))
+                row = cur.fetchone()
+        if not row:
+            return None
+        p = location_store.drivers.get(row[1]) if row[1] else None
+        location_row = (
+            (p["lat"], p["lng"], p["heading_deg"], p["speed_mph"], p["accuracy_m"], p["updated_at_utc"])
+            if p else None
+        )
+        return row[0], row[1], location_row
+
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT r.status, r.assigned_driver_id,
+                       dl.lat, dl.lng, dl.heading_deg, dl.speed_mph, dl.accuracy_m, dl.updated_at_utc
+                FROM rides r
+                LEFT JOIN driver_locations dl ON dl.driver_id = r.assigned_driver_id
+                WHERE r.id = %s
+                """,
+                (str(ride_id),)
+            )
+            row = cur.fetchone()
+    if not row:
+        return None
+    location_row = row[2:] if row[1] and row[2] is not None else None
+    if row[1]:
+        # A fix still in the write-behind buffer is newer than what's stored
+        buffered = location_buffer.get(row[1])
+        if buffered and (location_row is None or location_row[5] is None or buffered[1] >= location_row[5]):
+            location_row = (*buffered[2:], buffered[1])
+    return row[0], row[1], location_row
+
+
+def _ride_location_etag(ride_etag: str | None, updated_at_utc) -> str | None:
+    """Ride version + the position's timestamp (only while positions are served from memory)."""
+    if not location_store.ready:
+        return None
+    return resource_versions.extend(ride_etag, updated_at_utc.isoformat() if updated_at_utc else "-")
+
+
 @app.get("/api/v1/rides/{ride_id}/driver-location")
-def get_ride_driver_location(ride_id: UUID, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
-    """Get driver location for a specific ride (rider access)"""
+def get_ride_driver_location(
+    ride_id: UUID,
+    response: Response,
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
+):
+    """
+    Get driver location for a specific ride (rider access). For live updates use the /ws variant.
+    Polls with If-None-Match are answered from memory when the ride's driver is known here.
+    """
     require_public_key(x_api_key)
 
+    ride_etag = resource_versions.etag("ride", ride_id)
+    known, known_driver_id = resource_versions.ride_driver(ride_id)
+    if known and if_none_match:
+        p = location_store.drivers.get(known_driver_id) if known_driver_id else None
+        etag = _ride_location_etag(ride_etag, p["updated_at_utc"] if p else None)
+        if resource_versions.not_modified(if_none_match, etag):
+            return _not_modified(etag)
+
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                # Get ride and assigned_driver_id
-                cur.execute(
-                    """
-                    SELECT assigned_driver_id, status
-                    FROM rides
-                    WHERE id = %s
-                    """,
-                    (str(ride_id),)
-                )
-                ride_row = cur.fetchone()
-                
-                if not ride_row:
-                    raise HTTPException(status_code=404, detail="Ride not found")
-                
-                driver_id = ride_row[0]
-                if not driver_id:
-                    return {"driver_id": None, "message": "Ride not yet assigned to a driver"}
-                
-                # Get driver location
-                cur.execute(
-                    """
-                    SELECT lat, lng, heading_deg, speed_mph, accuracy_m, updated_at_utc
-                    FROM driver_locations
-                    WHERE driver_id = %s
-                    """,
-                    (str(driver_id),)
-                )
-                location_row = cur.fetchone()
-                
+        ride = _load_ride_driver_location(ride_id)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
 
+    if not ride:
+        raise HTTPException(status_code=404, detail="Ride not found")
+
+    _, driver_id, location_row = ride
+    resource_versions.remember_driver(ride_id, driver_id, ride_etag)
+    etag = _ride_location_etag(ride_etag, location_row[5] if location_row else None)
+    if not driver_id:
+        return _tagged(response, if_none_match, etag, {"driver_id": None, "message": "Ride not yet assigned to a driver"})
+
     if not location_row:
-        return {
+        return _tagged(response, if_none_match, etag, {
             "driver_id": str(driver_id),
             "lat": None,
             "lng": None,
             "message": "Driver location not available"
-        }
+        })
 
-    return {
+    return _tagged(response, if_none_match, etag, {
         "driver_id": str(driver_id),
         "lat": location_row[0],
         "lng": location_row[1],
@@ -1156,7 +1471,50 @@ def get_ride_driver_location(ride_id: UUID, x_api_key: str | None = Header(defau
         "speed_mph": location_row[3],
         "accuracy_m": location_row[4],
         "updated_at_utc": location_row[5].isoformat() if location_row[5] else None,
-    }
+    })
+
+
+@app.websocket("/api/v1/rides/{ride_id}/driver-location/ws")
+async def ride_driver_location_ws(websocket: WebSocket, ride_id: UUID, api_key: str | None = None):
+    """
+    Live driver location for a ride (rider access). Sends a snapshot, then location deltas and
+    ride status changes as they happen. Browsers can't set headers on WebSockets, so the public
+    key may also be passed as ?api_key=.
+    """
+    try:
+        require_public_key(websocket.headers.get("x-api-key") or api_key)
+    except HTTPException:
+        await websocket.close(code=1008)
+        return
+
+    try:
+        ride = await run_in_threadpool(_load_ride_driver_location, ride_id)
+    except Exception as e:
+        print(f"Warning: Live location snapshot failed: {e}")
+        await websocket.close(code=1011)
+        return
+    if not ride:
+        await websocket.close(code=1008)
+        return
+
+    status, driver_id, location_row = ride
+    location = None
+    if location_row:
+        location = {
+            "lat": location_row[0],
+            "lng": location_row[1],
+            "heading_deg": location_row[2],
+            "speed_mph": location_row[3],
+            "accuracy_m": location_row[4],
+            "updated_at_utc": location_row[5].isoformat() if location_row[5] else None,
+        }
+    await live_locations.stream(
+        websocket,
+        str(ride_id),
+        (status or "").strip().lower(),
+        str(driver_id) if driver_id else None,
+        location,
+    )
 
 
 _ACTIVE_RIDER_TRACK_STATUSES = frozenset({"assigned", "enroute", "arrived", "in_progress"})
@@ -1229,6 +1587,8 @@ def upsert_rider_location(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB write failed: {e}")
 
+    location_store.put_rider(ride_id, payload.lat, payload.lng, payload.accuracy_m, now_utc)
+
     return {"ok": True, "ride_id": str(ride_id), "updated_at_utc": now_utc.isoformat()}
 
 
@@ -1261,15 +1621,19 @@ def get_ride_rider_location(
                         "updated_at_utc": None,
                         "message": "Ride is not in an active tracking state",
                     }
-                cur.execute(
-                    """
-                    SELECT lat, lng, accuracy_m, updated_at_utc
-                    FROM rider_locations
-                    WHERE ride_id = %s
-                    """,
-                    (str(ride_id),),
-                )
-                loc = cur.fetchone()
+                if location_store.ready:
+                    p = location_store.riders.get(ride_id)
+                    loc = (p["lat"], p["lng"], p["accuracy_m"], p["updated_at_utc"]) if p else None
+                else:
+                    cur.execute(
+                        """
+                        SELECT lat, lng, accuracy_m, updated_at_utc
+                        FROM rider_locations
+                        WHERE ride_id = %s
+                        """,
+                        (str(ride_id),),
+                    )
+                    loc = cur.fetchone()
     except HTTPException:
         raise
     except UndefinedTable:
@@ -1306,14 +1670,20 @@ def get_ride_rider_location(
 @app.get("/api/v1/rides/{ride_id}/messages")
 def get_ride_messages(
     ride_id: UUID,
+    response: Response,
     limit: int = 100,
     x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
 ):
     """List messages for a ride. Rider: X-API-Key. Driver: Bearer token (optional)."""
     require_public_key(x_api_key)
     if limit < 1 or limit > 200:
         limit = 100
 
+    etag = resource_versions.extend(resource_versions.etag("messages", ride_id), limit)
+    if resource_versions.not_modified(if_none_match, etag):
+        return _not_modified(etag)
+
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
@@ -1333,7 +1703,7 @@ def get_ride_messages(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
 
-    return [
+    return _tagged(response, if_none_match, etag, [
         {
             "id": str(r[0]),
             "ride_id": str(r[1]),
@@ -1343,7 +1713,7 @@ def get_ride_messages(
             "created_at_utc": r[5].isoformat() if r[5] else None,
         }
         for r in rows
-    ]
+    ])
 
 
 @app.post("/api/v1/rides/{ride_id}/messages")
@@ -1400,6 +1770,7 @@ def post_ride_message(
                     """,
                     (str(msg_id), str(ride_id), sender_type, str(sender_id) if sender_id else None, message_text, created_at_utc),
                 )
+                publish_ride_event(cur, "ride.message", ride_id, sender_type=sender_type)
                 conn.commit()
     except UndefinedTable:
         raise HTTPException(status_code=503, detail="Chat not available (run migration 007_add_ride_messages.sql)")
@@ -1421,7 +1792,7 @@ def post_ride_message(
 # -----------------------------
 class PaymentIntentCreateIn(BaseModel):
     ride_id: UUID
-    quote_id: Optional[UUID] = None
+    quote_id: Optional[str] = None  # token from /rides/quote
     provider: str = Field(..., description="Payment provider: 'cash' or 'stripe'")
 
 
@@ -1473,7 +1844,7 @@ def create_payment_intent(
         with db_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    "SELECT id, estimated_price_usd FROM rides WHERE id = %s",
+                    "SELECT id, estimated_price_usd, pickup, dropoff, service_type FROM rides WHERE id = %s",
                     (str(payload.ride_id),)
                 )
                 ride_row = cur.fetchone()
@@ -1486,6 +1857,15 @@ def create_payment_intent(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Database error: {e}")
     
+    # The charge is always the price recorded on the ride. A quote for this trip must agree with it
+    # (booking with quote_id stores the quoted price), so the rider is never charged something else.
+    quote = read_quote_token(payload.quote_id, ride_row[2], ride_row[3], ride_row[4])
+    if quote and abs(float(quote["price_usd"]) - estimated_price) >= 0.005:
+        raise HTTPException(
+            status_code=409,
+            detail=f"Quote price {float(quote['price_usd']):.2f} does not match the ride price {estimated_price:.2f}",
+        )
+    
     payment_id = uuid4()
     created_at_utc = datetime.now(timezone.utc).replace(tzinfo=None)
     
@@ -1512,6 +1892,7 @@ def create_payment_intent(
                 metadata={
                     "ride_id": str(payload.ride_id),
                     "payment_id": str(payment_id),
+                    "quote_id": quote["qid"] if quote else "",
                 },
                 automatic_payment_methods={
                     "enabled": True,
@@ -1544,6 +1925,7 @@ def create_payment_intent(
                                 created_at_utc,  # updated_at_utc same as created_at initially
                             ),
                         )
+                        publish_ride_event(cur, "ride.payment", payload.ride_id, payment_status="requires_method")
                         conn.commit()
             except psycopg.errors.UndefinedTable:
                 # Table doesn't exist yet - that's OK, payment still works
@@ -1593,6 +1975,7 @@ def create_payment_intent(
                         created_at_utc,  # updated_at_utc same as created_at initially
                     ),
                 )
+                publish_ride_event(cur, "ride.payment", payload.ride_id, payment_status="pending_cash")
                 conn.commit()
     except psycopg.errors.UndefinedTable:
         # Table doesn't exist yet - that's OK, payment still works
@@ -1650,9 +2033,13 @@ def confirm_payment(
                                     confirmed_at_utc = %s,
                                     updated_at_utc = %s
                                 WHERE id = %s
+                                RETURNING ride_id
                                 """,
                                 (confirmed_at_utc, confirmed_at_utc, str(payload.payment_id)),
                             )
+                            paid = cur.fetchone()
+                            if paid:
+                                publish_ride_event(cur, "ride.payment", paid[0], payment_status="captured")
                             conn.commit()
                 except psycopg.errors.UndefinedTable:
                     # Table doesn't exist yet - that's OK, payment still works
@@ -2025,43 +2412,112 @@ def driver_refresh(payload: DriverRefreshIn):
 @app.put("/api/v1/driver/location")
 def upsert_my_location(payload: DriverLocationUpsert, driver_id: UUID = Depends(require_driver_access_token)):
     updated_at_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    fix = (updated_at_utc, payload.lat, payload.lng, payload.heading_deg, payload.speed_mph, payload.accuracy_m)
+
+    # Acknowledged once buffered; written (and pushed to riders) by the next bulk flush
+    if not location_buffer.add(driver_id, fix):
+        try:
+            with db_conn() as conn:
+                with conn.cursor() as cur:
+                    # Latest position + GPS trail row in one statement
+                    _, applied = ingest_fixes(cur, driver_id, [fix], updated_at_utc)
+                    # Pushed to riders watching this driver's ride (no-op unless the driver has an active ride)
+                    if applied:
+                        publish_driver_location(cur, driver_id, *fix[1:], updated_at_utc)
+                    conn.commit()
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"DB upsert failed: {e}")
+        if not applied:
+            # A newer position is already stored; don't feed the index/store a fix the DB rejected
+            return {"ok": True, "driver_id": str(driver_id), "updated_at_utc": updated_at_utc.isoformat()}
+
+    driver_index.upsert(driver_id, payload.lat, payload.lng, updated_at_utc)
+    location_store.put_driver(driver_id, *fix[1:], updated_at_utc)
+
+    return {"ok": True, "driver_id": str(driver_id), "updated_at_utc": updated_at_utc.isoformat()}
+
+
+@app.post("/api/v1/driver/location/batch")
+def upload_my_locations(payload: DriverLocationBatchIn, driver_id: UUID = Depends(require_driver_access_token)):
+    """
+    Upload buffered GPS fixes (e.g. after a connectivity gap) in one request.
+    The newest fix becomes the current position (unless a newer one is already stored);
+    every fix is appended to the trail. Re-sending fixes already stored is harmless.
+    """
+    if not payload.fixes:
+        raise HTTPException(status_code=400, detail="fixes must not be empty")
+    if len(payload.fixes) > LOCATION_BATCH_MAX_FIXES:
+        raise HTTPException(status_code=400, detail=f"At most {LOCATION_BATCH_MAX_FIXES} fixes per batch")
+
+    received_at_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    max_recorded = received_at_utc + timedelta(seconds=LOCATION_MAX_FUTURE_SKEW_SECONDS)
+
+    fixes_by_time = {}
+    rejected = 0
+    for f in payload.fixes:
+        recorded = f.recorded_at_utc
+        if recorded.tzinfo is not None:
+            recorded = recorded.astimezone(timezone.utc).replace(tzinfo=None)
+        if recorded > max_recorded:
+            rejected += 1  # device clock far ahead; would pin the driver's position in the future
+            continue
+        fixes_by_time[recorded] = (recorded, f.lat, f.lng, f.heading_deg, f.speed_mph, f.accuracy_m)
+    fixes = sorted(fixes_by_time.values())
+    if not fixes:
+        raise HTTPException(status_code=400, detail="All fixes have recorded_at_utc too far in the future")
 
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO driver_locations (driver_id, lat, lng, heading_deg, speed_mph, accuracy_m, updated_at_utc)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (driver_id) DO UPDATE SET
-                      lat = EXCLUDED.lat,
-                      lng = EXCLUDED.lng,
-                      heading_deg = EXCLUDED.heading_deg,
-                      speed_mph = EXCLUDED.speed_mph,
-                      accuracy_m = EXCLUDED.accuracy_m,
-                      updated_at_utc = EXCLUDED.updated_at_utc
-                    """,
-                    (
-                        str(driver_id),
-                        payload.lat,
-                        payload.lng,
-                        payload.heading_deg,
-                        payload.speed_mph,
-                        payload.accuracy_m,
-                        updated_at_utc,
-                    ),
-                )
+                inserted, latest = ingest_fixes(cur, driver_id, fixes, received_at_utc)
+                if latest:
+                    publish_driver_location(cur, driver_id, *latest[1:], latest[0])
                 conn.commit()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB upsert failed: {e}")
 
-    return {"ok": True, "driver_id": str(driver_id), "updated_at_utc": updated_at_utc.isoformat()}
+    if latest:
+        driver_index.upsert(driver_id, latest[1], latest[2], latest[0])
+        location_store.put_driver(driver_id, *latest[1:], latest[0])
+
+    return {
+        "ok": True,
+        "driver_id": str(driver_id),
+        "received": len(payload.fixes),
+        "stored": inserted,  # new trail rows (re-sent fixes are skipped)
+        "rejected": rejected,
+        "latest_applied": latest is not None,
+        "latest_recorded_at_utc": fixes[-1][0].isoformat(),
+    }
 
 
 @app.get("/api/v1/drivers/{driver_id}/location")
 def get_driver_location(driver_id: UUID, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
     require_admin_key(x_api_key)
 
+    if location_store.ready:
+        p = location_store.drivers.get(driver_id)
+        if not p:
+            return None
+        return {
+            "driver_id": str(driver_id),
+            **p,
+            "updated_at_utc": p["updated_at_utc"].isoformat() if p["updated_at_utc"] else None,
+        }
+
+    buffered = location_buffer.get(driver_id)
+    if buffered:
+        # Not flushed yet, and newer than anything this worker has written
+        return {
+            "driver_id": buffered[0],
+            "lat": buffered[2],
+            "lng": buffered[3],
+            "heading_deg": buffered[4],
+            "speed_mph": buffered[5],
+            "accuracy_m": buffered[6],
+            "updated_at_utc": buffered[1].isoformat(),
+        }
+
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
@@ -2091,36 +2547,152 @@ def get_driver_location(driver_id: UUID, x_api_key: str | None = Header(default=
     }
 
 
+def _trail_response(driver_id, start_utc: datetime, end_utc: datetime, limit: int) -> dict:
+    if limit < 1 or limit > LOCATION_TRAIL_MAX_POINTS:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {LOCATION_TRAIL_MAX_POINTS}")
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                rows = read_trail(cur, driver_id, start_utc, end_utc, limit + 1)
+    except UndefinedTable:
+        raise HTTPException(
+            status_code=503,
+            detail="driver_location_history table missing. Run migrations/012_driver_location_history.sql",
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
+
+    truncated = len(rows) > limit
+    rows = rows[:limit]
+    return {
+        "driver_id": str(driver_id),
+        "from_utc": start_utc.isoformat(),
+        "to_utc": end_utc.isoformat(),
+        "count": len(rows),
+        "truncated": truncated,  # more in range: ask again with from_utc = last recorded_at_utc (that point repeats)
+        "points": [
+            {
+                "recorded_at_utc": r[0].isoformat(),
+                "lat": r[1],
+                "lng": r[2],
+                "heading_deg": r[3],
+                "speed_mph": r[4],
+                "accuracy_m": r[5],
+            }
+            for r in rows
+        ],
+    }
+
+
+def _naive_utc(ts: datetime) -> datetime:
+    return ts.astimezone(timezone.utc).replace(tzinfo=None) if ts.tzinfo is not None else ts
+
+
+@app.get("/api/v1/drivers/{driver_id}/location-history")
+def get_driver_location_history(
+    driver_id: UUID,
+    from_utc: Optional[datetime] = None,
+    to_utc: Optional[datetime] = None,
+    limit: int = 1000,
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+):
+    """GPS trail for a driver, oldest first. Defaults to the last hour; from_utc is inclusive, to_utc exclusive."""
+    require_admin_key(x_api_key)
+    end_utc = _naive_utc(to_utc) if to_utc else datetime.now(timezone.utc).replace(tzinfo=None)
+    start_utc = _naive_utc(from_utc) if from_utc else end_utc - timedelta(hours=1)
+    if start_utc >= end_utc:
+        raise HTTPException(status_code=400, detail="from_utc must be before to_utc")
+    return _trail_response(driver_id, start_utc, end_utc, limit)
+
+
+@app.get("/api/v1/rides/{ride_id}/trail")
+def get_ride_trail(
+    ride_id: UUID,
+    from_utc: Optional[datetime] = None,
+    limit: int = 1000,
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+):
+    """
+    Replay of the assigned driver's GPS trail for a ride, from assignment to completion or
+    cancellation (or now, if still active). Page with from_utc (see "truncated").
+    """
+    require_admin_key(x_api_key)
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT assigned_driver_id, assigned_at_utc, COALESCE(completed_at_utc, cancelled_at_utc), status
+                    FROM rides
+                    WHERE id = %s
+                    """,
+                    (str(ride_id),),
+                )
+                row = cur.fetchone()
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
+
+    if not row:
+        raise HTTPException(status_code=404, detail="Ride not found")
+    driver_id, assigned_at, ended_at, status = row
+    if not driver_id or not assigned_at:
+        raise HTTPException(status_code=400, detail=f"Ride has no assigned driver (status={status})")
+
+    # Ended timestamps are inclusive for the ride; the range end is exclusive
+    end_utc = (ended_at + timedelta(microseconds=1)) if ended_at else datetime.now(timezone.utc).replace(tzinfo=None)
+    start_utc = max(_naive_utc(from_utc), assigned_at) if from_utc else assigned_at
+    out = _trail_response(driver_id, start_utc, end_utc, limit)
+    return {"ride_id": str(ride_id), "status": status, **out}
+
+
 @app.get("/api/v1/dispatch/available-drivers")
 def list_available_drivers(
     minutes_recent: int = 5,
+    near_lat: Optional[float] = None,
+    near_lng: Optional[float] = None,
     x_api_key: str | None = Header(default=None, alias="X-API-Key"),
 ):
+    """Recently seen active drivers. With near_lat/near_lng, adds distance_miles and sorts nearest first."""
     require_admin_key(x_api_key)
 
     if minutes_recent < 1:
         raise HTTPException(status_code=400, detail="minutes_recent must be >= 1")
+    if (near_lat is None) != (near_lng is None):
+        raise HTTPException(status_code=400, detail="near_lat and near_lng must be given together")
 
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT d.id, d.name, d.phone, d.vehicle, d.is_active,
-                           dl.lat, dl.lng, dl.updated_at_utc
-                    FROM drivers d
-                    JOIN driver_locations dl ON dl.driver_id = d.id
-                    WHERE d.is_active = true
-                      AND dl.updated_at_utc >= (now() - (%s || ' minutes')::interval)
-                    ORDER BY dl.updated_at_utc DESC
-                    """,
-                    (minutes_recent,),
-                )
-                rows = cur.fetchall()
+                if location_store.ready:
+                    # Recency filter over the in-memory arrays; only driver details are read
+                    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(minutes=minutes_recent)
+                    recent = location_store.drivers.updated_since(cutoff)
+                    rows = []
+                    if recent:
+                        cur.execute(
+                            _DRIVER_SELECT + " WHERE d.is_active = true AND d.id = ANY(%s::uuid[])",
+                            (list(recent),),
+                        )
+                        rows = _with_store_locations(cur.fetchall(), recent)
+                        rows.sort(key=lambda r: r[7], reverse=True)
+                else:
+                    cur.execute(
+                        """
+                        SELECT d.id, d.name, d.phone, d.vehicle, d.is_active,
+                               dl.lat, dl.lng, dl.updated_at_utc
+                        FROM drivers d
+                        JOIN driver_locations dl ON dl.driver_id = d.id
+                        WHERE d.is_active = true
+                          AND dl.updated_at_utc >= (now() - (%s || ' minutes')::interval)
+                        ORDER BY dl.updated_at_utc DESC
+                        """,
+                        (minutes_recent,),
+                    )
+                    rows = cur.fetchall()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB query failed: {e}")
 
-    return [
+    out = [
         {
             "driver_id": str(r[0]),
             "name": r[1],
@@ -2134,30 +2706,88 @@ def list_available_drivers(
         for r in rows
     ]
 
+    if near_lat is not None and out:
+        # One vectorized pass over every listed driver
+        distances = distances_from(near_lat, near_lng, [d["lat"] for d in out], [d["lng"] for d in out])
+        for d, miles in zip(out, distances):
+            d["distance_miles"] = round(float(miles), 2)
+        out.sort(key=lambda d: d["distance_miles"])
+
+    return out
+
 
 # -----------------------------
 # Dispatch: presence
 # -----------------------------
+_PRESENCE_SELECT = """
+    SELECT
+        d.id, d.name, d.phone, d.vehicle, d.is_active,
+        dl.lat, dl.lng, dl.updated_at_utc
+    FROM drivers d
+"""
+
+# Same columns as _PRESENCE_SELECT minus the location, for when location_store has it
+_DRIVER_SELECT = """
+    SELECT d.id, d.name, d.phone, d.vehicle, d.is_active
+    FROM drivers d
+"""
+
+
+def _with_store_locations(driver_rows, positions: dict | None = None) -> list[tuple]:
+    """Append (lat, lng, updated_at_utc) from location_store to _DRIVER_SELECT rows."""
+    if positions is None:
+        positions = location_store.drivers.get_many(r[0] for r in driver_rows)
+    out = []
+    for r in driver_rows:
+        p = positions.get(str(r[0]))
+        out.append((*r, p["lat"], p["lng"], p["updated_at_utc"]) if p else (*r, None, None, None))
+    return out
+
+
+def _presence_row(r) -> dict:
+    return {
+        "driver_id": str(r[0]),
+        "name": r[1],
+        "phone": r[2],
+        "vehicle": r[3],
+        "is_active": bool(r[4]),
+        "lat": r[5],
+        "lng": r[6],
+        "last_seen_utc": r[7].isoformat() if r[7] else None,
+    }
+
+
+def _load_presence_rows() -> list[tuple]:
+    """Newest 500 drivers with their current location (from location_store when it's loaded)."""
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            if location_store.ready:
+                cur.execute(_DRIVER_SELECT + " ORDER BY d.created_at_utc DESC LIMIT 500")
+                return _with_store_locations(cur.fetchall())
+            cur.execute(
+                _PRESENCE_SELECT + """
+                LEFT JOIN driver_locations dl ON dl.driver_id = d.id
+                ORDER BY d.created_at_utc DESC
+                LIMIT 500
+                """
+            )
+            return cur.fetchall()
+
+
 @app.get("/api/v1/dispatch/driver-presence")
-def driver_presence(x_api_key: str | None = Header(default=None, alias="X-API-Key")):
+def driver_presence(
+    near_lat: Optional[float] = None,
+    near_lng: Optional[float] = None,
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+):
+    """Presence for up to 500 drivers. With near_lat/near_lng, adds distance_miles (null without a location)."""
     require_admin_key(x_api_key)
+    if (near_lat is None) != (near_lng is None):
+        raise HTTPException(status_code=400, detail="near_lat and near_lng must be given together")
     now = datetime.now(timezone.utc)
 
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    SELECT
-                        d.id, d.name, d.phone, d.vehicle, d.is_active,
-                        dl.lat, dl.lng, dl.updated_at_utc
-                    FROM drivers d
-                    LEFT JOIN driver_locations dl ON dl.driver_id = d.id
-                    ORDER BY d.created_at_utc DESC
-                    LIMIT 500
-                    """
-                )
-                rows = cur.fetchall()
+        rows = _load_presence_rows()
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB query failed: {e}")
 
@@ -2171,19 +2801,20 @@ def driver_presence(x_api_key: str | None = Header(default=None, alias="X-API-Ke
 
         out.append(
             {
-                "driver_id": str(r[0]),
-                "name": r[1],
-                "phone": r[2],
-                "vehicle": r[3],
-                "is_active": bool(r[4]),
+                **_presence_row(r),
                 "status": presence_status(age_seconds),
-                "lat": r[5],
-                "lng": r[6],
-                "last_seen_utc": last_seen.isoformat() if last_seen else None,
                 "age_seconds": age_seconds,
             }
         )
 
+    if near_lat is not None:
+        located = [d for d in out if d["lat"] is not None and d["lng"] is not None]
+        distances = distances_from(near_lat, near_lng, [d["lat"] for d in located], [d["lng"] for d in located])
+        for d in out:
+            d["distance_miles"] = None
+        for d, miles in zip(located, distances):
+            d["distance_miles"] = round(float(miles), 2)
+
     return out
 
 
@@ -2253,7 +2884,7 @@ def dispatch_assign_ride(
         with db_conn() as conn:
             with conn.cursor() as cur:
                 # ride exists + assignable
-                cur.execute("SELECT status FROM rides WHERE id = %s", (str(ride_id),))
+                cur.execute("SELECT status, assigned_driver_id FROM rides WHERE id = %s", (str(ride_id),))
                 ride = cur.fetchone()
                 if not ride:
                     raise HTTPException(status_code=404, detail="Ride not found")
@@ -2263,7 +2894,7 @@ def dispatch_assign_ride(
                     raise HTTPException(status_code=400, detail=f"Ride is not assignable (status={status})")
 
                 # driver exists + active
-                cur.execute("SELECT is_active FROM drivers WHERE id = %s", (str(payload.driver_id),))
+                cur.execute("SELECT is_active, name FROM drivers WHERE id = %s", (str(payload.driver_id),))
                 drow = cur.fetchone()
                 if not drow:
                     raise HTTPException(status_code=404, detail="Driver not found")
@@ -2278,9 +2909,28 @@ def dispatch_assign_ride(
                         assigned_at_utc = %s,
                         status = 'assigned'
                     WHERE id = %s
+                    RETURNING rider_name, pickup, dropoff
                     """,
                     (str(payload.driver_id), now_utc, str(ride_id)),
                 )
+                ride_row = cur.fetchone()
+                publish_ride_event(
+                    cur, "ride.assigned", ride_id, status="assigned",
+                    driver_id=payload.driver_id, previous_status=status, assigned_by="dispatch",
+                    previous_driver_id=str(ride[1]) if ride[1] else None,
+                )
+                # Ride details came back from the UPDATE; driver name from the check above
+                if NOTIFICATIONS_AVAILABLE and ride_row:
+                    enqueue_notification(
+                        cur,
+                        "ride_assigned",
+                        ride_id=ride_id,
+                        driver_id=payload.driver_id,
+                        driver_name=drow[1],
+                        rider_name=ride_row[0],
+                        pickup=ride_row[1],
+                        dropoff=ride_row[2],
+                    )
                 conn.commit()
 
     except UniqueViolation:
@@ -2290,50 +2940,6 @@ def dispatch_assign_ride(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB operation failed: {e}")
 
-    # Send notifications (graceful fallback if notifications not available)
-    try:
-        if NOTIFICATIONS_AVAILABLE:
-            # Fetch ride and driver details for notification
-            with db_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        SELECT rider_name, pickup, dropoff
-                        FROM rides
-                        WHERE id = %s
-                        """,
-                        (str(ride_id),)
-                    )
-                    ride_row = cur.fetchone()
-                    
-                    cur.execute(
-                        """
-                        SELECT name
-                        FROM drivers
-                        WHERE id = %s
-                        """,
-                        (str(payload.driver_id),)
-                    )
-                    driver_row = cur.fetchone()
-            
-            if ride_row and driver_row:
-                rider_name = ride_row[0]
-                pickup = ride_row[1]
-                dropoff = ride_row[2]
-                driver_name = driver_row[0]
-                
-                notify_ride_assigned(
-                    ride_id=ride_id,
-                    driver_id=payload.driver_id,
-                    driver_name=driver_name,
-                    rider_name=rider_name,
-                    pickup=pickup,
-                    dropoff=dropoff,
-                )
-    except Exception as notify_error:
-        # Don't fail the request if notification fails
-        print(f"Warning: Failed to send ride assigned notification: {notify_error}")
-
     return {
         "ok": True,
         "ride_id": str(ride_id),
@@ -2382,6 +2988,57 @@ def update_auto_assignment_setting(
     return {"enabled": payload.enabled}
 
 
+def _nearest_free_driver(cur, lat: float, lng: float) -> tuple[Optional[dict], bool]:
+    """
+    Closest active driver with no active ride, nearest first from driver_index.
+    Each page of AUTO_ASSIGN_CANDIDATES goes through the availability anti-join (one indexed
+    query, idx_rides_active_driver); if all of them are busy the index is paged further (each page
+    twice the last), so the cap never turns "nearest few are busy" into "no driver" and a lookup
+    costs a few pages rather than a read of every busy driver.
+    Returns (driver or None, whether any driver had a recent location).
+    """
+    seen: set = set()
+    page = AUTO_ASSIGN_CANDIDATES
+    while True:
+        candidates = driver_index.nearest(
+            lat,
+            lng,
+            k=page,
+            radius_miles=AUTO_ASSIGN_RADIUS_MILES or None,
+            max_age_seconds=AUTO_ASSIGN_MAX_LOCATION_AGE_SECONDS,
+            exclude=seen,
+        )
+        if not candidates:
+            return None, bool(seen)
+        # Confirm this page in one set-based query (active, still no active ride)
+        cur.execute("""
+            SELECT d.id, d.name
+            FROM drivers d
+            WHERE d.id = ANY(%s::uuid[])
+            AND d.is_active = true
+            AND NOT EXISTS (
+                SELECT 1 FROM rides r
+                WHERE r.assigned_driver_id = d.id
+                AND r.status IN ('assigned', 'enroute', 'arrived', 'in_progress')
+            )
+        """, ([c["driver_id"] for c in candidates],))
+        free_driver_names = {str(r[0]): r[1] for r in cur.fetchall()}
+        # Candidates are already nearest-first
+        for candidate in candidates:
+            if candidate["driver_id"] in free_driver_names:
+                return {
+                    "driver_id": candidate["driver_id"],
+                    "driver_name": free_driver_names[candidate["driver_id"]],
+                    "distance_miles": candidate["distance_miles"],
+                    "lat": candidate["lat"],
+                    "lng": candidate["lng"],
+                }, True
+        if len(candidates) < page:
+            return None, True
+        seen.update(c["driver_id"] for c in candidates)
+        page *= 2
+
+
 @app.post("/api/v1/dispatch/rides/{ride_id}/auto-assign")
 def dispatch_auto_assign_ride(
     ride_id: UUID,
@@ -2439,69 +3096,23 @@ def dispatch_auto_assign_ride(
                 
                 pickup_lat, pickup_lon = pickup_coords
                 
-                # Get available drivers with locations
-                cur.execute("""
-                    SELECT 
-                        d.id, d.name, d.is_active,
-                        dl.lat, dl.lng, dl.updated_at_utc
-                    FROM drivers d
-                    LEFT JOIN driver_locations dl ON dl.driver_id = d.id
-                    WHERE d.is_active = true
-                    AND dl.lat IS NOT NULL
-                    AND dl.lng IS NOT NULL
-                    AND dl.updated_at_utc > NOW() - INTERVAL '1 hour'
-                    ORDER BY dl.updated_at_utc DESC
-                """)
-                driver_rows = cur.fetchall()
+                # Nearest free driver with a recent location, from the in-memory spatial index
+                # (sync pulls positions written by other workers since the last call)
+                driver_index.sync(cur)
+                closest_driver, any_candidates = _nearest_free_driver(cur, pickup_lat, pickup_lon)
                 
-                if not driver_rows:
+                if not any_candidates:
                     raise HTTPException(
                         status_code=404,
                         detail="No available drivers with recent location data found"
                     )
                 
-                # Calculate distance from each driver to pickup
-                driver_distances = []
-                for row in driver_rows:
-                    driver_id = row[0]
-                    driver_name = row[1]
-                    driver_lat = row[3]
-                    driver_lon = row[4]
-                    
-                    # Check if driver already has an active ride
-                    cur.execute("""
-                        SELECT id FROM rides
-                        WHERE assigned_driver_id = %s
-                        AND status IN ('assigned', 'enroute', 'arrived', 'in_progress')
-                        LIMIT 1
-                    """, (str(driver_id),))
-                    has_active_ride = cur.fetchone()
-                    
-                    if has_active_ride:
-                        continue  # Skip drivers with active rides
-                    
-                    distance = calculate_distance_miles(
-                        driver_lat, driver_lon,
-                        pickup_lat, pickup_lon
-                    )
-                    
-                    driver_distances.append({
-                        "driver_id": driver_id,
-                        "driver_name": driver_name,
-                        "distance_miles": distance,
-                        "lat": driver_lat,
-                        "lng": driver_lon,
-                    })
-                
-                if not driver_distances:
+                if not closest_driver:
                     raise HTTPException(
                         status_code=404,
                         detail="No available drivers (all drivers have active rides)"
                     )
                 
-                # Sort by distance and select closest
-                driver_distances.sort(key=lambda x: x["distance_miles"])
-                closest_driver = driver_distances[0]
                 assigned_driver_id = closest_driver["driver_id"]
                 
                 # Assign ride to closest driver
@@ -2511,50 +3122,33 @@ def dispatch_auto_assign_ride(
                         assigned_at_utc = %s,
                         status = 'assigned'
                     WHERE id = %s
+                    RETURNING rider_name, dropoff
                 """, (str(assigned_driver_id), now_utc, str(ride_id)))
+                rider_name, dropoff = cur.fetchone()
+                publish_ride_event(
+                    cur, "ride.assigned", ride_id, status="assigned",
+                    driver_id=assigned_driver_id, previous_status=ride_status, assigned_by="auto",
+                )
+                if NOTIFICATIONS_AVAILABLE:
+                    enqueue_notification(
+                        cur,
+                        "ride_assigned",
+                        ride_id=ride_id,
+                        driver_id=assigned_driver_id,
+                        driver_name=closest_driver["driver_name"],
+                        rider_name=rider_name,
+                        pickup=pickup_address,
+                        dropoff=dropoff,
+                    )
                 conn.commit()
                 
+    except UniqueViolation:
+        raise HTTPException(status_code=409, detail="Driver already has an active ride")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Auto-assignment failed: {e}")
     
-    # Send notifications (graceful fallback)
-    try:
-        if NOTIFICATIONS_AVAILABLE:
-            with db_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute("""
-                        SELECT rider_name, pickup, dropoff
-                        FROM rides
-                        WHERE id = %s
-                    """, (str(ride_id),))
-                    ride_row = cur.fetchone()
-                    
-                    cur.execute("""
-                        SELECT name
-                        FROM drivers
-                        WHERE id = %s
-                    """, (str(assigned_driver_id),))
-                    driver_row = cur.fetchone()
-            
-            if ride_row and driver_row:
-                rider_name = ride_row[0]
-                pickup = ride_row[1]
-                dropoff = ride_row[2]
-                driver_name = driver_row[0]
-                
-                notify_ride_assigned(
-                    ride_id=ride_id,
-                    driver_id=assigned_driver_id,
-                    driver_name=driver_name,
-                    rider_name=rider_name,
-                    pickup=pickup,
-                    dropoff=dropoff,
-                )
-    except Exception as notify_error:
-        print(f"Warning: Failed to send ride assigned notification: {notify_error}")
-    
     return {
         "ok": True,
         "ride_id": str(ride_id),
@@ -2567,8 +3161,82 @@ def dispatch_auto_assign_ride(
     }
 
 
+def _enqueue_assigned_notifications(cur, assignments: list[dict]):
+    # Runs on the batch's transaction: one outbox INSERT for every assignment
+    enqueue_notifications(cur, "ride_assigned", [
+        {
+            "ride_id": a["ride_id"],
+            "driver_id": a["driver_id"],
+            "driver_name": a["driver_name"],
+            "rider_name": a["rider_name"],
+            "pickup": a["pickup"],
+            "dropoff": a["dropoff"],
+        }
+        for a in assignments
+    ])
+
+
+def run_batch_dispatch(max_rides: Optional[int] = None, exclusive: bool = True) -> dict:
+    """
+    One batch assignment run; assigned notifications are queued on the batch's transaction.
+    Used by the batch-assign endpoint, the background loop and dispatch_worker.py (exclusive=False).
+    """
+    with db_conn() as conn:
+        return batch_dispatcher.run(
+            conn,
+            geocode_address,
+            radius_miles=AUTO_ASSIGN_RADIUS_MILES or None,
+            max_location_age_seconds=AUTO_ASSIGN_MAX_LOCATION_AGE_SECONDS,
+            max_rides=max_rides,
+            exclusive=exclusive,
+            on_assigned=_enqueue_assigned_notifications if NOTIFICATIONS_AVAILABLE else None,
+        )
+
+
+def _batch_dispatch_tick():
+    if DB_URL and get_setting("auto_assignment_enabled", False):
+        run_batch_dispatch()
+
+
+@app.post("/api/v1/dispatch/batch-assign")
+def dispatch_batch_assign(x_api_key: str | None = Header(default=None, alias="X-API-Key")):
+    """Assign all waiting rides at once, minimizing total pickup distance across the batch"""
+    require_admin_key(x_api_key)
+    
+    if not get_setting("auto_assignment_enabled", False):
+        raise HTTPException(
+            status_code=400, 
+            detail="Auto-assignment is disabled. Enable it via /api/v1/admin/settings/auto-assignment"
+        )
+    
+    try:
+        result = run_batch_dispatch()
+    except UniqueViolation:
+        raise HTTPException(status_code=409, detail="A driver in the batch already has an active ride; retry")
+    except RuntimeError as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Batch assignment failed: {e}")
+    
+    return {
+        "ok": True,
+        "assigned_count": len(result["assignments"]),
+        **result,
+    }
+
+
 @app.get("/api/v1/driver/assigned-ride")
-def driver_assigned_ride(driver_id: UUID = Depends(require_driver_access_token)):
+def driver_assigned_ride(
+    response: Response,
+    driver_id: UUID = Depends(require_driver_access_token),
+    if_none_match: str | None = Header(default=None, alias="If-None-Match"),
+):
+    etag = resource_versions.etag("driver", driver_id)
+    if resource_versions.not_modified(if_none_match, etag):
+        return _not_modified(etag)
+
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
@@ -2590,9 +3258,9 @@ def driver_assigned_ride(driver_id: UUID = Depends(require_driver_access_token))
         raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
 
     if not row:
-        return None
+        return _tagged(response, if_none_match, etag, None)
 
-    return {
+    return _tagged(response, if_none_match, etag, {
         "ride_id": str(row[0]),
         "rider_name": row[1],
         "rider_phone_masked": mask_phone(row[2]),
@@ -2602,7 +3270,7 @@ def driver_assigned_ride(driver_id: UUID = Depends(require_driver_access_token))
         "status": row[6],
         "created_at_utc": row[7].isoformat() if row[7] else None,
         "assigned_at_utc": row[8].isoformat() if row[8] else None,
-    }
+    })
 
 
 # =========================================================
@@ -2696,7 +3364,7 @@ def driver_accept_ride(
                     raise HTTPException(status_code=409, detail="Ride already assigned")
 
                 cur.execute(
-                    "SELECT is_active FROM drivers WHERE id = %s",
+                    "SELECT is_active, name FROM drivers WHERE id = %s",
                     (str(driver_id),),
                 )
                 drow = cur.fetchone()
@@ -2722,34 +3390,27 @@ def driver_accept_ride(
                     UPDATE rides
                     SET assigned_driver_id = %s, assigned_at_utc = %s, status = 'assigned'
                     WHERE id = %s AND status = 'requested' AND assigned_driver_id IS NULL
+                    RETURNING rider_name, pickup, dropoff
                     """,
                     (str(driver_id), now_utc, str(ride_id)),
                 )
-                if cur.rowcount == 0:
+                ride_row = cur.fetchone()
+                if ride_row is None:
                     raise HTTPException(status_code=409, detail="Ride could not be accepted (stale state)")
+                publish_ride_event(cur, "ride.accepted", ride_id, status="assigned", driver_id=driver_id)
+                if NOTIFICATIONS_AVAILABLE:
+                    enqueue_notification(
+                        cur,
+                        "ride_assigned",
+                        ride_id=ride_id,
+                        driver_id=driver_id,
+                        driver_name=drow[1],
+                        rider_name=ride_row[0],
+                        pickup=ride_row[1],
+                        dropoff=ride_row[2],
+                    )
                 conn.commit()
 
-                cur.execute(
-                    "SELECT rider_name, rider_phone_e164, pickup, dropoff FROM rides WHERE id = %s",
-                    (str(ride_id),),
-                )
-                ride_row = cur.fetchone()
-                cur.execute("SELECT name FROM drivers WHERE id = %s", (str(driver_id),))
-                driver_row = cur.fetchone()
-
-        try:
-            if NOTIFICATIONS_AVAILABLE and ride_row and driver_row:
-                notify_ride_assigned(
-                    ride_id=ride_id,
-                    driver_id=driver_id,
-                    driver_name=driver_row[0],
-                    rider_name=ride_row[0],
-                    pickup=ride_row[2],
-                    dropoff=ride_row[3],
-                )
-        except Exception as notify_error:
-            print(f"Warning: Failed to send ride assigned notification: {notify_error}")
-
         return {
             "ok": True,
             "ride_id": str(ride_id),
@@ -2793,6 +3454,10 @@ def driver_update_ride_status(
 
     now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
 
+    if new_status == "completed":
+        # The trail must include this driver's fixes still waiting in the write-behind buffer
+        location_buffer.flush_driver(driver_id)
+
     # Map status -> timestamp column
     ts_col_by_status = {
         "enroute": "enroute_at_utc",
@@ -2808,9 +3473,10 @@ def driver_update_ride_status(
                 # Fetch current ride assignment + status
                 cur.execute(
                     """
-                    SELECT assigned_driver_id, status
-                    FROM rides
-                    WHERE id = %s
+                    SELECT r.assigned_driver_id, r.status, r.rider_name, r.pickup, r.dropoff, d.name
+                    FROM rides r
+                    LEFT JOIN drivers d ON d.id = r.assigned_driver_id
+                    WHERE r.id = %s
                     """,
                     (str(ride_id),),
                 )
@@ -2865,6 +3531,35 @@ def driver_update_ride_status(
                         (new_status, str(ride_id)),
                     )
 
+                fare = None
+                if new_status == "completed" and fare_columns_available(cur):
+                    try:
+                        with conn.transaction():  # savepoint: a pricing failure must not block completion
+                            fare = finalize_ride_fare(cur, ride_id, now_utc)
+                    except Exception as e:
+                        print(f"Warning: Fare finalization failed for ride {ride_id}: {e}")
+
+                publish_ride_event(
+                    cur,
+                    "ride.cancelled" if new_status == "cancelled" else "ride.status_changed",
+                    ride_id,
+                    status=new_status,
+                    driver_id=driver_id,
+                    previous_status=current_status_norm,
+                )
+                # Status notifications commit with the update (ride + driver details from the first read)
+                if NOTIFICATIONS_AVAILABLE and notifies_status(new_status):
+                    enqueue_notification(
+                        cur,
+                        "ride_status",
+                        ride_id=ride_id,
+                        driver_id=driver_id,
+                        driver_name=row[5],
+                        rider_name=row[2],
+                        pickup=row[3],
+                        dropoff=row[4],
+                        status=new_status,
+                    )
                 conn.commit()
 
     except HTTPException:
@@ -2872,57 +3567,93 @@ def driver_update_ride_status(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB operation failed: {e}")
 
-    # Send notifications for status updates (graceful fallback if notifications not available)
+    out = {"ok": True, "ride_id": str(ride_id), "driver_id": str(driver_id), "status": new_status}
+    if fare:
+        out["fare"] = fare
+    return out
+
+
+@app.post("/api/v1/admin/rides/{ride_id}/finalize-fare")
+def admin_finalize_ride_fare(ride_id: UUID, x_api_key: str | None = Header(default=None, alias="X-API-Key")):
+    """Re-price a completed ride from its GPS trail (e.g. after a late backlog upload or a dispute)."""
+    require_admin_key(x_api_key)
     try:
-        if NOTIFICATIONS_AVAILABLE and new_status in ("enroute", "arrived", "in_progress", "completed", "cancelled"):
-            # Fetch ride and driver details for notification
-            with db_conn() as conn:
-                with conn.cursor() as cur:
-                    cur.execute(
-                        """
-                        SELECT rider_name, pickup, dropoff
-                        FROM rides
-                        WHERE id = %s
-                        """,
-                        (str(ride_id),)
-                    )
-                    ride_row = cur.fetchone()
-                    
-                    cur.execute(
-                        """
-                        SELECT name
-                        FROM drivers
-                        WHERE id = %s
-                        """,
-                        (str(driver_id),)
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                if not fare_columns_available(cur):
+                    raise HTTPException(
+                        status_code=503,
+                        detail="rides fare columns missing. Run migrations/014_ride_actual_fare.sql",
                     )
-                    driver_row = cur.fetchone()
-            
-            if ride_row and driver_row:
-                rider_name = ride_row[0]
-                pickup = ride_row[1]
-                dropoff = ride_row[2]
-                driver_name = driver_row[0]
-                
-                notify_ride_status_update(
-                    ride_id=ride_id,
-                    driver_id=driver_id,
-                    driver_name=driver_name,
-                    rider_name=rider_name,
-                    pickup=pickup,
-                    dropoff=dropoff,
-                    status=new_status,
-                )
-    except Exception as notify_error:
-        # Don't fail the request if notification fails
-        print(f"Warning: Failed to send ride status notification: {notify_error}")
+                cur.execute("SELECT status FROM rides WHERE id = %s", (str(ride_id),))
+                row = cur.fetchone()
+                if not row:
+                    raise HTTPException(status_code=404, detail="Ride not found")
+                if row[0] != "completed":
+                    raise HTTPException(status_code=400, detail=f"Ride is not completed (status={row[0]})")
+                fare = finalize_ride_fare(cur, ride_id)
+                publish_ride_event(cur, "ride.fare_finalized", ride_id, status="completed")
+                conn.commit()
+    except HTTPException:
+        raise
+    except UndefinedTable:
+        raise HTTPException(
+            status_code=503,
+            detail="driver_location_history table missing. Run migrations/012_driver_location_history.sql",
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB operation failed: {e}")
 
-    return {"ok": True, "ride_id": str(ride_id), "driver_id": str(driver_id), "status": new_status}
+    return {"ok": True, "ride_id": str(ride_id), "fare": fare}
 
 
 # -----------------------------
 # Phase 2 — Step 4A: Dispatch "active rides" (ADMIN)
 # -----------------------------
+_ACTIVE_RIDE_SELECT = """
+    SELECT
+        r.id,
+        r.rider_name,
+        r.rider_phone_e164,
+        r.pickup,
+        r.dropoff,
+        r.service_type,
+        r.status,
+        r.created_at_utc,
+        r.assigned_at_utc,
+        r.enroute_at_utc,
+        r.arrived_at_utc,
+        r.in_progress_at_utc,
+        r.assigned_driver_id,
+        d.name,
+        d.vehicle,
+        d.phone
+    FROM rides r
+    LEFT JOIN drivers d ON d.id = r.assigned_driver_id
+"""
+
+
+def _active_ride_row(r) -> dict:
+    return {
+        "ride_id": str(r[0]),
+        "rider_name": r[1],
+        "rider_phone_e164": r[2],
+        "pickup": r[3],
+        "dropoff": r[4],
+        "service_type": r[5],
+        "status": r[6],
+        "created_at_utc": r[7].isoformat() if r[7] else None,
+        "assigned_at_utc": r[8].isoformat() if r[8] else None,
+        "enroute_at_utc": r[9].isoformat() if r[9] else None,
+        "arrived_at_utc": r[10].isoformat() if r[10] else None,
+        "in_progress_at_utc": r[11].isoformat() if r[11] else None,
+        "assigned_driver_id": str(r[12]) if r[12] else None,
+        "driver_name": r[13],
+        "vehicle": r[14],
+        "driver_phone_e164": r[15],
+    }
+
+
 @app.get("/api/v1/dispatch/active-rides")
 def dispatch_active_rides(
     limit: int = 50,
@@ -2937,26 +3668,7 @@ def dispatch_active_rides(
         with db_conn() as conn:
             with conn.cursor() as cur:
                 cur.execute(
-                    """
-                    SELECT
-                        r.id,
-                        r.rider_name,
-                        r.rider_phone_e164,
-                        r.pickup,
-                        r.dropoff,
-                        r.service_type,
-                        r.status,
-                        r.created_at_utc,
-                        r.assigned_at_utc,
-                        r.enroute_at_utc,
-                        r.arrived_at_utc,
-                        r.in_progress_at_utc,
-                        r.assigned_driver_id,
-                        d.name,
-                        d.vehicle,
-                        d.phone
-                    FROM rides r
-                    LEFT JOIN drivers d ON d.id = r.assigned_driver_id
+                    _ACTIVE_RIDE_SELECT + """
                     WHERE r.status IN ('assigned','enroute','arrived','in_progress')
                     ORDER BY r.created_at_utc DESC
                     LIMIT %s
@@ -2967,27 +3679,92 @@ def dispatch_active_rides(
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
 
-    return [
-        {
-            "ride_id": str(r[0]),
-            "rider_name": r[1],
-            "rider_phone_e164": r[2],
-            "pickup": r[3],
-            "dropoff": r[4],
-            "service_type": r[5],
-            "status": r[6],
-            "created_at_utc": r[7].isoformat() if r[7] else None,
-            "assigned_at_utc": r[8].isoformat() if r[8] else None,
-            "enroute_at_utc": r[9].isoformat() if r[9] else None,
-            "arrived_at_utc": r[10].isoformat() if r[10] else None,
-            "in_progress_at_utc": r[11].isoformat() if r[11] else None,
-            "assigned_driver_id": str(r[12]) if r[12] else None,
-            "driver_name": r[13],
-            "vehicle": r[14],
-            "driver_phone_e164": r[15],
-        }
-        for r in rows
-    ]
+    return [_active_ride_row(r) for r in rows]
+
+
+# -----------------------------
+# Dispatch: live board (SSE)
+# -----------------------------
+DISPATCH_BOARD_MAX_RIDES = 500  # same cap as the presence list
+
+
+def _board_load_rides(ride_ids: list | None) -> list[dict]:
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            if ride_ids is None:
+                cur.execute(
+                    _ACTIVE_RIDE_SELECT + """
+                    WHERE r.status IN ('assigned','enroute','arrived','in_progress')
+                    ORDER BY r.created_at_utc DESC
+                    LIMIT %s
+                    """,
+                    (DISPATCH_BOARD_MAX_RIDES,),
+                )
+            else:
+                cur.execute(_ACTIVE_RIDE_SELECT + " WHERE r.id = ANY(%s::uuid[])", (ride_ids,))
+            return [_active_ride_row(r) for r in cur.fetchall()]
+
+
+def _board_load_drivers(since: datetime | None) -> list[dict]:
+    if since is None:
+        return [_presence_row(r) for r in _load_presence_rows()]
+    if location_store.ready:
+        moved = location_store.drivers.updated_since(since)
+        if not moved:
+            return []
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(_DRIVER_SELECT + " WHERE d.id = ANY(%s::uuid[])", (list(moved),))
+                return [_presence_row(r) for r in _with_store_locations(cur.fetchall(), moved)]
+    with db_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                _PRESENCE_SELECT + """
+                JOIN driver_locations dl ON dl.driver_id = d.id
+                WHERE dl.updated_at_utc > %s
+                """,
+                (since,),
+            )
+            return [_presence_row(r) for r in cur.fetchall()]
+
+
+dispatch_board = DispatchBoard(_board_load_rides, _board_load_drivers, presence_status)
+
+
+@app.post("/api/v1/dispatch/board/stream-token")
+def dispatch_board_stream_token(x_api_key: str | None = Header(default=None, alias="X-API-Key")):
+    """Short-lived token for opening the board stream from EventSource (?token=)."""
+    require_admin_key(x_api_key)
+    token, exp = make_stream_token("dispatch_board")
+    return {
+        "token": token,
+        "expires_at_utc": exp.replace(tzinfo=None).isoformat(),
+        "expires_in_seconds": STREAM_TOKEN_SECONDS,
+    }
+
+
+@app.get("/api/v1/dispatch/board/stream")
+async def dispatch_board_stream(
+    request: Request,
+    token: str | None = None,
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+):
+    """
+    SSE feed of active rides + driver presence: a snapshot, then add/update/remove events.
+    EventSource can't set headers, so browsers pass ?token= from POST /dispatch/board/stream-token
+    (checked when the stream opens); the admin key is only accepted as the X-API-Key header.
+    """
+    if x_api_key:
+        require_admin_key(x_api_key)
+    else:
+        require_stream_token(token, "dispatch_board")
+    if not DB_URL:
+        raise HTTPException(status_code=500, detail="DATABASE_URL is missing. Set it in /etc/globapp-api.env")
+    return StreamingResponse(
+        dispatch_board.stream(request),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},  # no nginx buffering
+    )
 
 
 # -----------------------------
@@ -3221,13 +3998,98 @@ def driver_wallet_summary(
 # -----------------------------
 # Notifications
 # -----------------------------
+def _notification_json(r) -> Optional[dict]:
+    try:
+        # Handle metadata_json - psycopg3 returns JSONB as dict, psycopg2 as string
+        metadata = {}
+        if r[10]:
+            if isinstance(r[10], dict):
+                metadata = r[10]
+            elif isinstance(r[10], str):
+                metadata = json.loads(r[10])
+            else:
+                metadata = {}
+
+        return {
+            "id": str(r[0]),
+            "ride_id": str(r[1]) if r[1] else None,
+            "driver_id": str(r[2]) if r[2] else None,
+            "recipient_type": r[3],
+            "recipient_id": str(r[4]) if r[4] else None,
+            "notification_type": r[5],
+            "title": r[6],
+            "message": r[7],
+            "channel": r[8],
+            "status": r[9],
+            "metadata": metadata,
+            "created_at_utc": r[11].isoformat() if r[11] else None,
+            "sent_at_utc": r[12].isoformat() if r[12] else None,
+            "read_at_utc": r[13].isoformat() if r[13] else None,
+        }
+    except Exception as e:
+        # Log error but continue processing other rows
+        print(f"Warning: Error processing notification row: {e}")
+        return None
+
+
+def _read_notifications(where_clauses: list, params: list, after: Optional[tuple], limit: int):
+    """
+    One page of notifications: newest first, or with a cursor (created_at_utc, id) the ones after
+    it, oldest first. Returns (rows, next_cursor, pending); see notification_feed.py for the
+    settle window. pending means only unsettled rows are past the cursor (retry shortly).
+    """
+    where_clauses = list(where_clauses)
+    params = list(params)
+    if after:
+        where_clauses.append("(created_at_utc, id) > (%s, %s)")
+        params.extend([after[0], str(after[1])])
+        order_sql = "created_at_utc ASC, id ASC"
+    else:
+        order_sql = "created_at_utc DESC, id DESC"
+    where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
+    params.append(limit)
+    cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(milliseconds=NOTIFICATIONS_CURSOR_SETTLE_MS)
+
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    f"""
+                    SELECT 
+                        id, ride_id, driver_id, recipient_type, recipient_id,
+                        notification_type, title, message, channel, status,
+                        metadata_json, created_at_utc, sent_at_utc, read_at_utc
+                    FROM notifications
+                    WHERE {where_sql}
+                    ORDER BY {order_sql}
+                    LIMIT %s
+                    """,
+                    tuple(params),
+                )
+                rows = cur.fetchall()
+    except UndefinedTable:
+        # Table doesn't exist yet - return empty list
+        return [], None, False
+
+    if after:
+        # Ascending, so the settled rows are a prefix; stop at the first one that may still be overtaken
+        settled = [r for r in rows if r[11] <= cutoff]
+        next_cursor = encode_cursor(settled[-1][11], settled[-1][0]) if settled else encode_cursor(*after)
+        return settled, next_cursor, bool(rows) and not settled
+    # Newest first: resume from the settle cutoff (rows newer than it may be returned again)
+    return rows, cursor_floor(cutoff), False
+
+
 @app.get("/api/v1/notifications")
-def get_notifications(
+async def get_notifications(
+    response: Response,
     recipient_type: Optional[str] = None,  # 'rider', 'driver', 'admin'
     recipient_id: Optional[str] = None,  # UUID string
     ride_id: Optional[str] = None,  # UUID string
     status: Optional[str] = None,  # 'pending', 'sent', 'read', 'failed'
     limit: int = 50,
+    after: Optional[str] = None,  # cursor from X-Next-Cursor
+    wait: float = 0,  # long-poll seconds (needs after + recipient_type)
     x_api_key: str | None = Header(default=None, alias="X-API-Key"),
 ):
     """
@@ -3236,6 +4098,12 @@ def get_notifications(
     For riders: recipient_type='rider', recipient_id=ride_id (or get from ride)
     For drivers: recipient_type='driver', recipient_id=driver_id
     For admin: recipient_type='admin', recipient_id=None (broadcast)
+
+    Without after: the newest notifications, newest first. Every response carries X-Next-Cursor;
+    pass it back as after= to get only newer notifications, oldest first. With wait=<seconds>
+    the request blocks until a new notification arrives for the recipient or the wait runs out
+    (empty list). The response cursor may be past rows returned by a newest-first read; clients
+    should de-duplicate by id.
     """
     require_public_key(x_api_key)  # Public endpoint, but requires API key
     
@@ -3265,68 +4133,117 @@ def get_notifications(
             raise HTTPException(status_code=400, detail="Invalid status")
         where_clauses.append("status = %s")
         params.append(status)
-    
-    where_sql = " AND ".join(where_clauses) if where_clauses else "1=1"
-    params.append(limit)
-    
+
+    position = None
+    if after:
+        position = decode_cursor(after)
+        if position is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    if wait < 0 or wait > NOTIFICATIONS_LONGPOLL_MAX_SECONDS:
+        raise HTTPException(status_code=400, detail=f"wait must be between 0 and {NOTIFICATIONS_LONGPOLL_MAX_SECONDS:g}")
+    if wait and (position is None or not recipient_type):
+        raise HTTPException(status_code=400, detail="wait requires after and recipient_type")
+
+    async def read():
+        try:
+            return await run_in_threadpool(_read_notifications, where_clauses, params, position, limit)
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
+
+    if not wait:
+        rows, next_cursor, _ = await read()
+    else:
+        if notification_waiters.full:
+            notification_waiters.rejected += 1
+            raise HTTPException(status_code=503, detail="Too many waiting requests")
+        deadline = time.monotonic() + wait
+        settle_seconds = NOTIFICATIONS_CURSOR_SETTLE_MS / 1000.0
+        with notification_waiters.watch(recipient_key(recipient_type, recipient_id)) as waiter:
+            rows, next_cursor, pending = await read()
+            while not rows:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                if pending:
+                    # Rows are there but inside the settle window
+                    await asyncio.sleep(min(settle_seconds, remaining))
+                elif notification_waiters.live:
+                    if not await waiter.wait(remaining):
+                        break
+                    await asyncio.sleep(min(settle_seconds, max(deadline - time.monotonic(), 0)))
+                else:
+                    await asyncio.sleep(min(NOTIFICATIONS_FALLBACK_POLL_SECONDS, remaining))
+                rows, next_cursor, pending = await read()
+
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return [n for n in (_notification_json(r) for r in rows) if n is not None]
+
+
+@app.get("/api/v1/notifications/unread-count")
+def get_notifications_unread_count(
+    recipient_type: str,
+    recipient_id: Optional[UUID] = None,  # None for admin (broadcast)
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+):
+    """Unread notifications for one recipient (badge count; see notification_counts.py)"""
+    require_public_key(x_api_key)
+
+    if recipient_type not in ("rider", "driver", "admin"):
+        raise HTTPException(status_code=400, detail="Invalid recipient_type. Must be 'rider', 'driver', or 'admin'")
+
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    f"""
-                    SELECT 
-                        id, ride_id, driver_id, recipient_type, recipient_id,
-                        notification_type, title, message, channel, status,
-                        metadata_json, created_at_utc, sent_at_utc, read_at_utc
-                    FROM notifications
-                    WHERE {where_sql}
-                    ORDER BY created_at_utc DESC
-                    LIMIT %s
-                    """,
-                    tuple(params),
-                )
-                rows = cur.fetchall()
+                count = unread_count(cur, recipient_type, recipient_id)
     except UndefinedTable:
-        # Table doesn't exist yet - return empty list
-        return []
+        count = 0
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"DB read failed: {e}")
-    
-    result = []
-    for r in rows:
-        try:
-            # Handle metadata_json - psycopg3 returns JSONB as dict, psycopg2 as string
-            metadata = {}
-            if r[10]:
-                if isinstance(r[10], dict):
-                    metadata = r[10]
-                elif isinstance(r[10], str):
-                    metadata = json.loads(r[10])
-                else:
-                    metadata = {}
-            
-            result.append({
-                "id": str(r[0]),
-                "ride_id": str(r[1]) if r[1] else None,
-                "driver_id": str(r[2]) if r[2] else None,
-                "recipient_type": r[3],
-                "recipient_id": str(r[4]) if r[4] else None,
-                "notification_type": r[5],
-                "title": r[6],
-                "message": r[7],
-                "channel": r[8],
-                "status": r[9],
-                "metadata": metadata,
-                "created_at_utc": r[11].isoformat() if r[11] else None,
-                "sent_at_utc": r[12].isoformat() if r[12] else None,
-                "read_at_utc": r[13].isoformat() if r[13] else None,
-            })
-        except Exception as e:
-            # Log error but continue processing other rows
-            print(f"Warning: Error processing notification row: {e}")
-            continue
-    
-    return result
+
+    return {
+        "recipient_type": recipient_type,
+        "recipient_id": str(recipient_id) if recipient_id else None,
+        "unread_count": count,
+    }
+
+
+@app.post("/api/v1/notifications/read-all")
+def mark_all_notifications_read(
+    payload: NotificationsReadAllIn,
+    x_api_key: str | None = Header(default=None, alias="X-API-Key"),
+):
+    """
+    Mark all of a recipient's unread notifications as read, in one statement.
+    up_to (a cursor from X-Next-Cursor) or up_to_id (the newest notification the user saw) leaves
+    anything newer unread.
+    """
+    require_public_key(x_api_key)
+
+    if payload.recipient_type not in ("rider", "driver", "admin"):
+        raise HTTPException(status_code=400, detail="Invalid recipient_type. Must be 'rider', 'driver', or 'admin'")
+    up_to = None
+    if payload.up_to:
+        up_to = decode_cursor(payload.up_to)
+        if up_to is None:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+
+    try:
+        with db_conn() as conn:
+            with conn.cursor() as cur:
+                marked, unread = mark_all_read(
+                    cur, payload.recipient_type, payload.recipient_id, now_utc, up_to=up_to, up_to_id=payload.up_to_id
+                )
+            conn.commit()
+    except UndefinedTable:
+        raise HTTPException(status_code=404, detail="Notifications table not found")
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"DB operation failed: {e}")
+
+    return {"ok": True, "marked": marked, "unread_count": unread, "read_at_utc": now_utc.isoformat()}
 
 
 @app.post("/api/v1/notifications/{notification_id}/read")
@@ -3342,18 +4259,11 @@ def mark_notification_read(
     try:
         with db_conn() as conn:
             with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    UPDATE notifications
-                    SET status = 'read',
-                        read_at_utc = %s
-                    WHERE id = %s
-                    """,
-                    (now_utc, str(notification_id)),
-                )
+                # Decrements the recipient's unread counter in the same statement
+                found = mark_read(cur, notification_id, now_utc)
                 conn.commit()
                 
-                if cur.rowcount == 0:
+                if not found:
                     raise HTTPException(status_code=404, detail="Notification not found")
     except UndefinedTable:
         raise HTTPException(status_code=404, detail="Notifications table not found")
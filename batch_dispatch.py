@@ -0,0 +1,461 @@
+"""
+Batch auto-assignment for GlobApp dispatch
+Collects every waiting `requested` ride and the idle drivers near them, builds a pickup
+distance matrix (geo_distance.distance_matrix) and solves a global min-cost assignment
+(Hungarian algorithm), then commits all assignments in a single UPDATE.
+
+Greedy nearest-driver assignment (one ride at a time) can hand the only nearby driver to
+the wrong ride during a surge; minimizing total pickup distance over the whole batch avoids that.
+
+Rides and candidate drivers are row-locked with SKIP LOCKED, so concurrent batches (e.g. several
+dispatch_worker.py processes) claim disjoint rides and drivers and can never double-assign.
+exclusive=True additionally serializes runs through a transaction-level advisory lock. Pickups are
+geocoded before either is taken.
+
+Rides claimed but left unassigned (no free driver in reach) are stamped dispatch_attempted_at_utc
+(migration 019) and skipped for BATCH_DISPATCH_RETRY_SECONDS; never-tried rides are claimed first,
+so unassignable old rides don't take every batch's slots.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Optional
+
+# NumPy (optional - batch dispatch is disabled without it)
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    np = None
+
+# SciPy's C implementation is used when installed; otherwise the NumPy solver below
+try:
+    from scipy.optimize import linear_sum_assignment
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+    linear_sum_assignment = None
+
+from driver_index import driver_index
+from geo_distance import distance_matrix
+from event_bus import publish as publish_ride_event
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+BATCH_DISPATCH_INTERVAL_SECONDS = float(_env("GLOBAPP_BATCH_DISPATCH_INTERVAL_SECONDS", "0"))  # 0 = no background loop
+BATCH_DISPATCH_WINDOW_MINUTES = int(_env("GLOBAPP_BATCH_DISPATCH_WINDOW_MINUTES", "60"))  # only rides requested this recently
+BATCH_DISPATCH_MAX_RIDES = int(_env("GLOBAPP_BATCH_DISPATCH_MAX_RIDES", "200"))  # matrix rows
+BATCH_DISPATCH_MAX_DRIVERS = int(_env("GLOBAPP_BATCH_DISPATCH_MAX_DRIVERS", "400"))  # matrix columns
+BATCH_DISPATCH_CANDIDATES_PER_RIDE = int(_env("GLOBAPP_BATCH_DISPATCH_CANDIDATES_PER_RIDE", "10"))
+BATCH_DISPATCH_RETRY_SECONDS = float(_env("GLOBAPP_BATCH_DISPATCH_RETRY_SECONDS", "30"))  # after an unassigned claim
+
+_BATCH_LOCK_KEY = 7301001  # pg advisory lock id for "batch dispatch running"
+_INFEASIBLE_COST = 1e6  # pairs outside the radius; never committed
+_CANDIDATE_PAGES = 4  # index pages per ride when its nearest drivers are busy (each twice the last)
+_COLUMNS_RECHECK_SECONDS = 60
+
+_columns_ready: Optional[bool] = None
+_columns_checked_at = 0.0
+
+
+def dispatch_columns_available(cur) -> bool:
+    """Whether migration 019 has run (cached; a missing column is re-checked every minute)."""
+    global _columns_ready, _columns_checked_at
+    if _columns_ready or (_columns_ready is False and time.monotonic() - _columns_checked_at < _COLUMNS_RECHECK_SECONDS):
+        return _columns_ready
+    cur.execute(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'rides' AND column_name = 'dispatch_attempted_at_utc'
+        )
+        """
+    )
+    _columns_ready = bool(cur.fetchone()[0])
+    _columns_checked_at = time.monotonic()
+    if not _columns_ready:
+        print("Warning: rides.dispatch_attempted_at_utc missing; unassignable rides are retried every batch. Run migrations/019_rides_dispatch_attempted.sql")
+    return _columns_ready
+
+
+def _hungarian(cost) -> list[tuple[int, int]]:
+    """
+    Min-cost assignment for an n x m matrix with n <= m (every row gets a distinct column).
+    O(n^2 m) potentials method; the inner column scan is vectorized.
+    """
+    n, m = cost.shape
+    u = np.zeros(n + 1)
+    v = np.zeros(m + 1)
+    p = np.zeros(m + 1, dtype=np.int64)    # p[j] = row (1-based) matched to column j
+    way = np.zeros(m + 1, dtype=np.int64)
+
+    for i in range(1, n + 1):
+        p[0] = i
+        j0 = 0
+        minv = np.full(m + 1, np.inf)
+        used = np.zeros(m + 1, dtype=bool)
+        while True:
+            used[j0] = True
+            i0 = p[j0]
+            free = ~used[1:]
+            reduced = cost[i0 - 1] - u[i0] - v[1:]
+            better = free & (reduced < minv[1:])
+            minv[1:][better] = reduced[better]
+            way[1:][better] = j0
+            masked = np.where(free, minv[1:], np.inf)
+            j1 = int(np.argmin(masked)) + 1
+            delta = masked[j1 - 1]
+            u[p[used]] += delta
+            v[used] -= delta
+            minv[1:][free] -= delta
+            j0 = j1
+            if p[j0] == 0:
+                break
+        while j0:
+            j1 = way[j0]
+            p[j0] = p[j1]
+            j0 = j1
+
+    return [(int(p[j]) - 1, j - 1) for j in range(1, m + 1) if p[j]]
+
+
+def solve_assignment(cost) -> list[tuple[int, int]]:
+    """(row, col) pairs minimizing total cost; handles rides > drivers by transposing."""
+    cost = np.asarray(cost, dtype=float)
+    if cost.size == 0:
+        return []
+    if SCIPY_AVAILABLE:
+        rows, cols = linear_sum_assignment(cost)
+        return list(zip(rows.tolist(), cols.tolist()))
+    if cost.shape[0] <= cost.shape[1]:
+        return _hungarian(cost)
+    return [(r, c) for c, r in _hungarian(cost.T)]
+
+
+class BatchDispatcher:
+    """Runs batch assignment on demand or on an interval, and keeps run metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.runs = 0
+        self.skipped_locked = 0
+        self.rides_claimed = 0
+        self.rides_assigned = 0
+        self.errors = 0
+        self.last_run_utc: Optional[datetime] = None
+        self.last_result: Optional[dict] = None
+        self.last_error: Optional[str] = None
+
+    def run(
+        self,
+        conn,
+        geocode: Callable[[str], Optional[tuple[float, float]]],
+        radius_miles: Optional[float] = None,
+        max_location_age_seconds: Optional[float] = None,
+        max_rides: Optional[int] = None,
+        exclusive: bool = True,
+        on_assigned: Optional[Callable] = None,
+    ) -> dict:
+        """
+        One batch on the caller's connection; commits on success.
+        exclusive=False skips the advisory lock (horizontally scaled workers rely on row locks).
+        Returns {"assignments": [...], ...stats}. Assignment rows carry ride_id, driver_id,
+        driver_name, distance_miles, rider_name, pickup, dropoff for notifications.
+        on_assigned(cur, assignments) runs on the batch's transaction just before it commits.
+        """
+        if not NUMPY_AVAILABLE:
+            raise RuntimeError("NumPy not installed. Install with: pip install numpy")
+
+        started = time.perf_counter()
+        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        try:
+            result = self._run(
+                conn,
+                geocode,
+                radius_miles,
+                max_location_age_seconds,
+                max_rides or BATCH_DISPATCH_MAX_RIDES,
+                exclusive,
+                now_utc,
+                on_assigned,
+            )
+        except Exception as e:
+            conn.rollback()
+            with self._lock:
+                self.errors += 1
+                self.last_error = str(e)
+            raise
+
+        result["duration_ms"] = round((time.perf_counter() - started) * 1000.0, 1)
+        result["run_at_utc"] = now_utc.isoformat()
+        with self._lock:
+            self.runs += 1
+            if result.get("skipped"):
+                self.skipped_locked += 1
+            self.rides_claimed += result["rides_claimed"]
+            self.rides_assigned += len(result["assignments"])
+            self.last_run_utc = now_utc
+            self.last_result = {k: v for k, v in result.items() if k != "assignments"}
+            self.last_error = None
+        return result
+
+    def _run(self, conn, geocode, radius_miles, max_location_age_seconds, max_rides, exclusive, now_utc,
+             on_assigned=None) -> dict:
+        empty = {"assignments": [], "rides_claimed": 0, "rides_considered": 0, "drivers_considered": 0}
+        with conn.cursor() as cur:
+            # Pickups are geocoded before any lock is taken (a cache miss is a provider call), then
+            # the rides are claimed and re-checked, so slow lookups never hold ride or advisory locks
+            window_start = now_utc - timedelta(minutes=BATCH_DISPATCH_WINDOW_MINUTES)
+            if dispatch_columns_available(cur):
+                cur.execute("""
+                    SELECT id, pickup
+                    FROM rides
+                    WHERE status = 'requested'
+                    AND assigned_driver_id IS NULL
+                    AND created_at_utc >= %s
+                    AND (dispatch_attempted_at_utc IS NULL OR dispatch_attempted_at_utc <= %s)
+                    ORDER BY dispatch_attempted_at_utc ASC NULLS FIRST, created_at_utc ASC
+                    LIMIT %s
+                """, (window_start, now_utc - timedelta(seconds=BATCH_DISPATCH_RETRY_SECONDS), max_rides))
+            else:
+                cur.execute("""
+                    SELECT id, pickup
+                    FROM rides
+                    WHERE status = 'requested'
+                    AND assigned_driver_id IS NULL
+                    AND created_at_utc >= %s
+                    ORDER BY created_at_utc ASC
+                    LIMIT %s
+                """, (window_start, max_rides))
+            waiting = cur.fetchall()
+            conn.rollback()
+
+            coords_by_ride: dict[str, tuple[float, float]] = {}
+            for ride_id, pickup in waiting:
+                coords = geocode(pickup) if pickup else None
+                if coords:
+                    coords_by_ride[str(ride_id)] = (coords[0], coords[1])
+            if not coords_by_ride:
+                return empty
+
+            if exclusive:
+                cur.execute("SELECT pg_try_advisory_xact_lock(%s)", (_BATCH_LOCK_KEY,))
+                if not cur.fetchone()[0]:
+                    conn.rollback()
+                    return {**empty, "skipped": "another batch is running"}
+
+            # Claim: rides another batch holds, or that were assigned/cancelled since the read, drop out
+            cur.execute("""
+                SELECT id
+                FROM rides
+                WHERE id = ANY(%s::uuid[])
+                AND status = 'requested'
+                AND assigned_driver_id IS NULL
+                ORDER BY created_at_utc ASC
+                FOR UPDATE SKIP LOCKED
+            """, (list(coords_by_ride),))
+            ride_rows = cur.fetchall()
+            empty["rides_claimed"] = len(ride_rows)
+
+            rides = [(str(r[0]), *coords_by_ride[str(r[0])]) for r in ride_rows]  # (ride_id, lat, lng)
+            if not rides:
+                conn.rollback()
+                return empty
+
+            # Candidate pool: union of each ride's nearest free drivers from the spatial index,
+            # capped at BATCH_DISPATCH_MAX_DRIVERS by distance to the closest ride. Candidates go
+            # through the availability anti-join as they are found; a ride whose nearest drivers
+            # are mostly busy pages further out (excluding those), like single auto-assign does.
+            driver_index.sync(cur)
+            best: dict[str, tuple[float, float, float]] = {}  # driver_id -> (min distance, lat, lng)
+            free_driver_names: dict[str, str] = {}
+            unavailable: set = set()  # busy, inactive, or held by another batch
+            searching = rides
+            page = BATCH_DISPATCH_CANDIDATES_PER_RIDE
+            for _ in range(_CANDIDATE_PAGES):
+                found_by_ride = []
+                for ride in searching:
+                    found = driver_index.nearest(
+                        ride[1],
+                        ride[2],
+                        k=page,
+                        radius_miles=radius_miles,
+                        max_age_seconds=max_location_age_seconds,
+                        exclude=unavailable,
+                    )
+                    found_by_ride.append((ride, found))
+                    for c in found:
+                        prev = best.get(c["driver_id"])
+                        if prev is None or c["distance_miles"] < prev[0]:
+                            best[c["driver_id"]] = (c["distance_miles"], c["lat"], c["lng"])
+                unchecked = list({c["driver_id"] for _, found in found_by_ride for c in found} - free_driver_names.keys())
+                if unchecked:
+                    free_driver_names.update(self._lock_free_drivers(cur, unchecked))
+                    unavailable.update(d for d in unchecked if d not in free_driver_names)
+                # Rides still short of free candidates while the index has more to offer
+                searching = [
+                    ride for ride, found in found_by_ride
+                    if len(found) == page
+                    and sum(1 for c in found if c["driver_id"] in free_driver_names) < BATCH_DISPATCH_CANDIDATES_PER_RIDE
+                ]
+                if not searching:
+                    break
+                page *= 2
+            candidate_ids = sorted(free_driver_names, key=lambda d: best[d][0])[:BATCH_DISPATCH_MAX_DRIVERS]
+            drivers = candidate_ids
+            if not drivers:
+                self._mark_attempted(cur, [r[0] for r in rides], now_utc)
+                conn.commit()
+                return {**empty, "rides_considered": len(rides)}
+
+            dist = distance_matrix(
+                [r[1] for r in rides],
+                [r[2] for r in rides],
+                [best[d][1] for d in drivers],
+                [best[d][2] for d in drivers],
+            )
+            cost = dist if not radius_miles else np.where(dist <= radius_miles, dist, _INFEASIBLE_COST)
+            pairs = [(i, j) for i, j in solve_assignment(cost) if cost[i, j] < _INFEASIBLE_COST]
+            if not pairs:
+                self._mark_attempted(cur, [r[0] for r in rides], now_utc)
+                conn.commit()
+                return {**empty, "rides_considered": len(rides), "drivers_considered": len(drivers)}
+
+            # All assignments in one statement / one transaction. The status guard keeps a ride
+            # that changed under us from being overwritten; a driver who picked up a ride
+            # concurrently trips the active-ride unique index and the whole batch retries next run.
+            ride_ids = [rides[i][0] for i, _ in pairs]
+            driver_ids = [drivers[j] for _, j in pairs]
+            cur.execute("""
+                UPDATE rides r
+                SET assigned_driver_id = m.driver_id,
+                    assigned_at_utc = %s,
+                    status = 'assigned'
+                FROM unnest(%s::uuid[], %s::uuid[]) AS m(ride_id, driver_id)
+                WHERE r.id = m.ride_id
+                AND r.status = 'requested'
+                AND r.assigned_driver_id IS NULL
+                RETURNING r.id, r.assigned_driver_id, r.rider_name, r.pickup, r.dropoff
+            """, (now_utc, ride_ids, driver_ids))
+            updated = cur.fetchall()
+            assigned_ids = {str(r[0]) for r in updated}
+            self._mark_attempted(cur, [r[0] for r in rides if r[0] not in assigned_ids], now_utc)
+            for ride_id, driver_id, *_ in updated:
+                publish_ride_event(
+                    cur, "ride.assigned", ride_id, status="assigned",
+                    driver_id=driver_id, previous_status="requested", assigned_by="batch",
+                )
+
+            distance_by_ride = {rides[i][0]: float(dist[i, j]) for i, j in pairs}
+            assignments = []
+            for ride_id, driver_id, rider_name, pickup, dropoff in updated:
+                assignments.append({
+                    "ride_id": str(ride_id),
+                    "driver_id": str(driver_id),
+                    "driver_name": free_driver_names.get(str(driver_id)),
+                    "distance_miles": round(distance_by_ride.get(str(ride_id), 0.0), 2),
+                    "rider_name": rider_name,
+                    "pickup": pickup,
+                    "dropoff": dropoff,
+                })
+            if on_assigned and assignments:
+                on_assigned(cur, assignments)
+            conn.commit()
+
+        return {
+            "assignments": assignments,
+            "rides_claimed": len(ride_rows),
+            "rides_considered": len(rides),
+            "drivers_considered": len(drivers),
+            "total_pickup_miles": round(sum(a["distance_miles"] for a in assignments), 2),
+            "solver": "scipy" if SCIPY_AVAILABLE else "numpy_hungarian",
+        }
+
+    @staticmethod
+    def _lock_free_drivers(cur, driver_ids: list[str]) -> dict[str, str]:
+        """
+        Lock the idle ones among driver_ids for this transaction; drivers another batch holds are
+        skipped. NO KEY UPDATE still lets other transactions reference the driver row (ride FKs).
+        Returns {driver_id: name}.
+        """
+        cur.execute("""
+            SELECT d.id, d.name
+            FROM drivers d
+            WHERE d.id = ANY(%s::uuid[])
+            AND d.is_active = true
+            AND NOT EXISTS (
+                SELECT 1 FROM rides r
+                WHERE r.assigned_driver_id = d.id
+                AND r.status IN ('assigned', 'enroute', 'arrived', 'in_progress')
+            )
+            FOR NO KEY UPDATE OF d SKIP LOCKED
+        """, (driver_ids,))
+        return {str(r[0]): r[1] for r in cur.fetchall()}
+
+    @staticmethod
+    def _mark_attempted(cur, ride_ids: list[str], now_utc: datetime):
+        """Stamp claimed rides that got no driver so the next batches move on to other rides."""
+        if ride_ids and dispatch_columns_available(cur):
+            cur.execute(
+                "UPDATE rides SET dispatch_attempted_at_utc = %s WHERE id = ANY(%s::uuid[])",
+                (now_utc, ride_ids),
+            )
+
+    # ---- background loop ----
+    def start(self, tick: Callable[[], None], interval_seconds: float = BATCH_DISPATCH_INTERVAL_SECONDS):
+        """Call tick() every interval_seconds on a daemon thread (no-op if interval <= 0)."""
+        if interval_seconds <= 0 or (self._thread and self._thread.is_alive()):
+            return
+        if not NUMPY_AVAILABLE:
+            print("Warning: Batch dispatch interval set but NumPy is not installed; background batching disabled")
+            return
+        self._stop.clear()
+
+        def loop():
+            while not self._stop.wait(interval_seconds):
+                try:
+                    tick()
+                except Exception as e:
+                    print(f"Warning: Batch dispatch run failed: {e}")
+
+        self._thread = threading.Thread(target=loop, name="batch-dispatch", daemon=True)
+        self._thread.start()
+        print(f"Info: Batch dispatch running every {interval_seconds:g}s")
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "available": NUMPY_AVAILABLE,
+                "solver": ("scipy" if SCIPY_AVAILABLE else "numpy_hungarian") if NUMPY_AVAILABLE else None,
+                "interval_seconds": BATCH_DISPATCH_INTERVAL_SECONDS,
+                "background": bool(self._thread and self._thread.is_alive()),
+                "max_rides": BATCH_DISPATCH_MAX_RIDES,
+                "max_drivers": BATCH_DISPATCH_MAX_DRIVERS,
+                "retry_seconds": BATCH_DISPATCH_RETRY_SECONDS,
+                "runs": self.runs,
+                "skipped_locked": self.skipped_locked,
+                "rides_claimed": self.rides_claimed,
+                "rides_assigned": self.rides_assigned,
+                "errors": self.errors,
+                "last_run_utc": self.last_run_utc.isoformat() if self.last_run_utc else None,
+                "last_result": self.last_result,
+                "last_error": self.last_error,
+            }
+
+
+batch_dispatcher = BatchDispatcher()
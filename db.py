@@ -1,9 +1,125 @@
 import os
+import threading
+from contextlib import contextmanager
+
 import psycopg
-from psycopg.rows import dict_row
+from psycopg.rows import dict_row, tuple_row
 
-def get_conn():
+# Connection pool (optional - falls back to one connection per call if psycopg_pool isn't installed)
+try:
+    from psycopg_pool import ConnectionPool
+    POOL_AVAILABLE = True
+except ImportError:
+    POOL_AVAILABLE = False
+    ConnectionPool = None
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+# Pool sizing / lifecycle (all optional, see .env.example)
+POOL_ENABLED = _env("GLOBAPP_DB_POOL_ENABLED", "true").lower() == "true"
+POOL_MIN_SIZE = int(_env("GLOBAPP_DB_POOL_MIN_SIZE", "2"))
+POOL_MAX_SIZE = int(_env("GLOBAPP_DB_POOL_MAX_SIZE", "10"))
+POOL_MAX_LIFETIME_SECONDS = float(_env("GLOBAPP_DB_POOL_MAX_LIFETIME_SECONDS", "3600"))  # recycle after 1h
+POOL_MAX_IDLE_SECONDS = float(_env("GLOBAPP_DB_POOL_MAX_IDLE_SECONDS", "600"))  # shrink to min_size after 10m idle
+POOL_TIMEOUT_SECONDS = float(_env("GLOBAPP_DB_POOL_TIMEOUT_SECONDS", "10"))  # wait for a free connection
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def database_url() -> str:
     db_url = os.getenv("DATABASE_URL")
     if not db_url:
         raise ValueError("DATABASE_URL is missing. Set it in /etc/globapp-api.env")
-    return psycopg.connect(db_url, row_factory=dict_row)
+    return db_url
+
+
+def _reset_connection(conn):
+    # Connections are shared between callers: undo per-borrower settings (e.g. dict_row from get_conn)
+    conn.row_factory = tuple_row
+
+
+def get_pool():
+    """
+    Process-wide connection pool, opened lazily on first use.
+    Returns None when pooling is disabled or psycopg_pool is not installed.
+    """
+    global _pool
+    if not POOL_ENABLED or not POOL_AVAILABLE:
+        return None
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    database_url(),
+                    min_size=POOL_MIN_SIZE,
+                    max_size=max(POOL_MAX_SIZE, POOL_MIN_SIZE),
+                    max_lifetime=POOL_MAX_LIFETIME_SECONDS,
+                    max_idle=POOL_MAX_IDLE_SECONDS,
+                    timeout=POOL_TIMEOUT_SECONDS,
+                    check=ConnectionPool.check_connection,  # health check on checkout
+                    reset=_reset_connection,
+                    name="globapp",
+                    open=True,
+                )
+    return _pool
+
+
+@contextmanager
+def pooled_conn(row_factory=None):
+    """
+    Borrow a connection for the duration of a `with` block.
+
+    Same semantics as `with psycopg.connect(...) as conn`: commit on success,
+    rollback on exception. The connection goes back to the pool instead of being closed.
+    """
+    pool = get_pool()
+    if pool is None:
+        with psycopg.connect(database_url()) as conn:
+            if row_factory is not None:
+                conn.row_factory = row_factory
+            yield conn
+        return
+
+    with pool.connection() as conn:
+        if row_factory is not None:
+            conn.row_factory = row_factory
+        yield conn
+
+
+def get_conn():
+    """Borrow a pooled connection with dict rows. Use as: `with get_conn() as conn:`"""
+    return pooled_conn(row_factory=dict_row)
+
+
+def pool_stats() -> dict:
+    """Pool counters for the metrics endpoint."""
+    if not POOL_ENABLED:
+        return {"enabled": False, "reason": "GLOBAPP_DB_POOL_ENABLED=false"}
+    if not POOL_AVAILABLE:
+        return {"enabled": False, "reason": "psycopg_pool not installed (pip install psycopg-pool)"}
+
+    config = {
+        "min_size": POOL_MIN_SIZE,
+        "max_size": max(POOL_MAX_SIZE, POOL_MIN_SIZE),
+        "max_lifetime_seconds": POOL_MAX_LIFETIME_SECONDS,
+        "max_idle_seconds": POOL_MAX_IDLE_SECONDS,
+        "timeout_seconds": POOL_TIMEOUT_SECONDS,
+    }
+    if _pool is None:
+        return {"enabled": True, "open": False, "config": config}
+
+    # get_stats(): pool_size, pool_available, requests_waiting, requests_num, connections_num, ...
+    return {"enabled": True, "open": True, "config": config, "stats": _pool.get_stats()}
+
+
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.close()
+            _pool = None
@@ -0,0 +1,306 @@
+"""
+Dispatcher board feed for GlobApp (Server-Sent Events)
+One in-process copy of the board (active rides + driver presence) per API worker, kept current
+incrementally and shared by every connected admin console:
+
+- rides: ride events from event_bus mark rides dirty; only those rows are re-read
+- presence: one incremental query for driver_locations changed since the last tick, plus
+  time-based online -> stale -> offline transitions computed in memory
+- a full reload every DISPATCH_BOARD_RESYNC_SECONDS catches anything the increments can't see
+  (new/deactivated drivers, writes from paths that don't publish)
+
+Consoles get a snapshot, then add/update/remove events, so their cost is O(changes) rather than
+O(board size x refresh rate). The background tick and the event_bus subscription only run while
+someone is connected.
+
+Stream:
+    event: snapshot      data: {"rides": [...], "drivers": [...]}
+    event: ride.add | ride.update | ride.remove         data: ride row ({"ride_id"} for remove)
+    event: driver.add | driver.update | driver.remove   data: presence row ({"driver_id"} for remove)
+    event: resync        (client fell behind; reconnect for a fresh snapshot)
+"""
+
+import asyncio
+import json
+import os
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from typing import Callable, Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from event_bus import event_bus
+from location_store import LOCATION_STORE_SYNC_OVERLAP_SECONDS
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+DISPATCH_BOARD_TICK_SECONDS = float(_env("GLOBAPP_DISPATCH_BOARD_TICK_SECONDS", "2"))
+DISPATCH_BOARD_RESYNC_SECONDS = float(_env("GLOBAPP_DISPATCH_BOARD_RESYNC_SECONDS", "60"))
+DISPATCH_BOARD_KEEPALIVE_SECONDS = float(_env("GLOBAPP_DISPATCH_BOARD_KEEPALIVE_SECONDS", "15"))
+DISPATCH_BOARD_CLIENT_QUEUE = int(_env("GLOBAPP_DISPATCH_BOARD_CLIENT_QUEUE", "1000"))  # events buffered per console
+
+ACTIVE_RIDE_STATUSES = frozenset({"assigned", "enroute", "arrived", "in_progress"})
+# Presence fields whose change is worth an event (location alone is not)
+_DRIVER_EVENT_FIELDS = ("name", "phone", "vehicle", "is_active", "status")
+
+
+def _sse(event: str, data, seq: Optional[int] = None) -> str:
+    head = f"id: {seq}\n" if seq is not None else ""
+    return f"{head}event: {event}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class DispatchBoard:
+    """
+    load_rides(ride_ids | None) -> ride dicts (None = all active rides)
+    load_drivers(since | None) -> presence dicts without "status" (since = location updated after)
+    presence_status(age_seconds | None) -> "online" | "stale" | "offline"
+    """
+
+    def __init__(
+        self,
+        load_rides: Callable[[Optional[list]], list[dict]],
+        load_drivers: Callable[[Optional[datetime]], list[dict]],
+        presence_status: Callable[[Optional[float]], str],
+    ):
+        self._load_rides = load_rides
+        self._load_drivers = load_drivers
+        self._presence_status = presence_status
+        self._lock = threading.Lock()       # board state + subscribers
+        self._tick_lock = threading.Lock()  # one refresh at a time
+        self._rides: dict[str, dict] = {}
+        self._drivers: dict[str, dict] = {}
+        self._last_seen: dict[str, Optional[datetime]] = {}
+        self._locations_since: Optional[datetime] = None
+        self._dirty_rides: set = set()
+        self._subscribers: dict[int, Callable] = {}
+        self._joining = 0  # subscribe() calls between taking the bus subscription and registering
+        self._next_token = 1
+        self._seq = 0
+        self._loaded = False
+        self._last_full = 0.0
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._bus_token: Optional[int] = None
+        self.events_emitted = 0
+        self.ticks = 0
+        self.full_reloads = 0
+        self.dropped_clients = 0
+        self.last_error: Optional[str] = None
+
+    # ---- subscribers ----
+    def subscribe(self, sink: Callable[[int, str, dict], None]) -> tuple[int, int, dict]:
+        """Register sink(seq, event, data); returns (token, snapshot_seq, snapshot). Blocking (loads the board if cold)."""
+        with self._lock:
+            # Ride events are followed from before the load, so none fall between load and stream
+            self._joining += 1
+            if self._bus_token is None:
+                self._bus_token = event_bus.subscribe(self._on_ride_event)
+        try:
+            if not self._loaded:
+                self.refresh(full=True)
+        finally:
+            with self._lock:
+                self._joining -= 1
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            self._subscribers[token] = sink
+            snapshot = {"rides": list(self._rides.values()), "drivers": list(self._drivers.values())}
+            seq = self._seq
+        self._ensure_thread()
+        return token, seq, snapshot
+
+    def unsubscribe(self, token: int):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def _emit(self, event: str, data: dict):
+        # Caller holds self._lock, so snapshot + subsequent events are never interleaved
+        self._seq += 1
+        self.events_emitted += 1
+        for sink in list(self._subscribers.values()):
+            sink(self._seq, event, data)
+
+    def _on_ride_event(self, event: dict):
+        ride_id = event.get("ride_id")
+        if ride_id:
+            with self._lock:
+                if not self._subscribers and not self._joining:
+                    return  # nobody watching; the next console starts from a full load
+                self._dirty_rides.add(ride_id)
+            self._wake.set()
+
+    # ---- refresh ----
+    def _ensure_thread(self):
+        with self._lock:
+            if self._thread and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="dispatch-board", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if not self._subscribers and not self._joining:
+                    # Nobody watching: stop, and reload from scratch when the next console connects
+                    self._thread = None
+                    self._loaded = False
+                    self._dirty_rides.clear()
+                    if self._bus_token is not None:
+                        event_bus.unsubscribe(self._bus_token)
+                        self._bus_token = None
+                    return
+            self._wake.wait(DISPATCH_BOARD_TICK_SECONDS)
+            self._wake.clear()
+            try:
+                self.refresh(full=time.monotonic() - self._last_full >= DISPATCH_BOARD_RESYNC_SECONDS)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Warning: Dispatch board refresh failed: {e}")
+
+    def refresh(self, full: bool = False):
+        with self._tick_lock:
+            self.ticks += 1
+            now = datetime.now(timezone.utc).replace(tzinfo=None)
+            if full:
+                with self._lock:
+                    self._dirty_rides.clear()
+                rides = self._load_rides(None)
+                drivers = self._load_drivers(None)
+            else:
+                with self._lock:
+                    dirty, self._dirty_rides = list(self._dirty_rides), set()
+                rides = self._load_rides(dirty) if dirty else []
+                drivers = self._load_drivers(self._locations_since)
+
+            with self._lock:
+                if full:
+                    self._apply_rides(rides, remove_missing=True)
+                else:
+                    found = {r["ride_id"] for r in rides}
+                    self._apply_rides(rides, remove_missing=False)
+                    for ride_id in dirty:
+                        if ride_id not in found and ride_id in self._rides:
+                            del self._rides[ride_id]
+                            self._emit("ride.remove", {"ride_id": ride_id})
+                self._apply_drivers(drivers, now, remove_missing=full)
+                self.last_error = None
+                if full:
+                    self._loaded = True
+                    self._last_full = time.monotonic()
+                    self.full_reloads += 1
+
+    def _apply_rides(self, rows: list[dict], remove_missing: bool):
+        seen = set()
+        for row in rows:
+            ride_id = row["ride_id"]
+            if row.get("status") not in ACTIVE_RIDE_STATUSES:
+                if ride_id in self._rides:
+                    del self._rides[ride_id]
+                    self._emit("ride.remove", {"ride_id": ride_id})
+                continue
+            seen.add(ride_id)
+            prev = self._rides.get(ride_id)
+            if prev != row:
+                self._rides[ride_id] = row
+                self._emit("ride.add" if prev is None else "ride.update", row)
+        if remove_missing:
+            for ride_id in [r for r in self._rides if r not in seen]:
+                del self._rides[ride_id]
+                self._emit("ride.remove", {"ride_id": ride_id})
+
+    def _apply_drivers(self, rows: list[dict], now: datetime, remove_missing: bool):
+        seen = set()
+        for row in rows:
+            driver_id = row["driver_id"]
+            seen.add(driver_id)
+            last_seen = datetime.fromisoformat(row["last_seen_utc"]) if row.get("last_seen_utc") else None
+            self._last_seen[driver_id] = last_seen
+            if last_seen:
+                # Same overlap as location_store: fixes stamped earlier can commit later
+                # (buffered flushes, device timestamps); re-reading a few drivers is harmless
+                since = last_seen - timedelta(seconds=LOCATION_STORE_SYNC_OVERLAP_SECONDS)
+                if self._locations_since is None or since > self._locations_since:
+                    self._locations_since = since
+            self._put_driver(driver_id, {**row, "status": self._status_at(driver_id, now)})
+
+        if remove_missing:
+            for driver_id in [d for d in self._drivers if d not in seen]:
+                del self._drivers[driver_id]
+                self._last_seen.pop(driver_id, None)
+                self._emit("driver.remove", {"driver_id": driver_id})
+
+        # Time-based transitions (online -> stale -> offline) for drivers not in this batch
+        for driver_id, current in self._drivers.items():
+            if driver_id in seen:
+                continue
+            status = self._status_at(driver_id, now)
+            if status != current["status"]:
+                self._put_driver(driver_id, {**current, "status": status})
+
+    def _put_driver(self, driver_id: str, row: dict):
+        prev = self._drivers.get(driver_id)
+        self._drivers[driver_id] = row
+        if prev is None:
+            self._emit("driver.add", row)
+        elif any(prev.get(f) != row.get(f) for f in _DRIVER_EVENT_FIELDS):
+            self._emit("driver.update", row)
+
+    def _status_at(self, driver_id: str, now: datetime) -> str:
+        last_seen = self._last_seen.get(driver_id)
+        return self._presence_status((now - last_seen).total_seconds() if last_seen else None)
+
+    # ---- SSE ----
+    async def stream(self, request):
+        """Async generator of SSE frames for one console (use with StreamingResponse)."""
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue(maxsize=DISPATCH_BOARD_CLIENT_QUEUE)
+
+        def offer(item):
+            try:
+                queue.put_nowait(item)
+            except asyncio.QueueFull:
+                # Too slow to keep up: tell it to resync instead of buffering without bound
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(None)
+                self.dropped_clients += 1
+
+        def sink(seq: int, event: str, data: dict):
+            loop.call_soon_threadsafe(offer, (seq, event, data))
+
+        token, seq, snapshot = await run_in_threadpool(self.subscribe, sink)
+        try:
+            yield _sse("snapshot", snapshot, seq)
+            while not await request.is_disconnected():
+                try:
+                    item = await asyncio.wait_for(queue.get(), timeout=DISPATCH_BOARD_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if item is None:
+                    yield _sse("resync", {})
+                    break
+                yield _sse(item[1], item[2], item[0])
+        finally:
+            self.unsubscribe(token)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "subscribers": len(self._subscribers),
+                "running": bool(self._thread and self._thread.is_alive()),
+                "rides": len(self._rides),
+                "drivers": len(self._drivers),
+                "seq": self._seq,
+                "events_emitted": self.events_emitted,
+                "ticks": self.ticks,
+                "full_reloads": self.full_reloads,
+                "dropped_clients": self.dropped_clients,
+                "last_error": self.last_error,
+            }
@@ -1,31 +1,141 @@
+"""
+GlobApp dispatch worker
+Long-running auto-assignment loop. Each iteration claims up to --batch-size `requested` rides
+(SELECT ... FOR UPDATE SKIP LOCKED), locks the idle drivers near them the same way, and commits
+a min-cost assignment for the batch (batch_dispatch.py).
+
+Run as many copies as needed, on one host or many: rides and drivers held by one worker are
+skipped by the others, so nothing is assigned twice. Does nothing while auto-assignment is
+disabled in app settings. When idle it sleeps until the ride event bus reports a new ride or a
+driver freeing up (or --idle-sleep passes).
+
+Usage:
+    DATABASE_URL=... python dispatch_worker.py [--batch-size 50] [--idle-sleep 2] [--report-seconds 30] [--once]
+"""
+
+import argparse
 import os
-import psycopg2
+import signal
+import socket
+import threading
+import time
+
+from psycopg.errors import UniqueViolation
+
+from app import run_batch_dispatch, get_setting, DB_URL
+from db import close_pool
+from event_bus import event_bus
+from http_client import close_clients
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+DISPATCH_WORKER_BATCH_SIZE = int(_env("GLOBAPP_DISPATCH_WORKER_BATCH_SIZE", "50"))
+DISPATCH_WORKER_IDLE_SLEEP_SECONDS = float(_env("GLOBAPP_DISPATCH_WORKER_IDLE_SLEEP_SECONDS", "2"))
+DISPATCH_WORKER_REPORT_SECONDS = float(_env("GLOBAPP_DISPATCH_WORKER_REPORT_SECONDS", "30"))
+
+
+class Throughput:
+    """Claim/assign counters, reported as totals plus the rate since the previous report."""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.batches = 0
+        self.claimed = 0
+        self.assigned = 0
+        self.conflicts = 0
+        self.errors = 0
+        self._last_report = self.started
+        self._last_claimed = 0
+        self._last_assigned = 0
+
+    def add(self, result: dict):
+        self.batches += 1
+        self.claimed += result.get("rides_claimed", 0)
+        self.assigned += len(result.get("assignments", []))
+
+    def report(self, worker_id: str):
+        now = time.monotonic()
+        window = max(now - self._last_report, 1e-9)
+        print(
+            f"Info: dispatch_worker {worker_id}: "
+            f"claimed={self.claimed} ({(self.claimed - self._last_claimed) / window:.1f}/s) "
+            f"assigned={self.assigned} ({(self.assigned - self._last_assigned) / window:.1f}/s) "
+            f"batches={self.batches} conflicts={self.conflicts} errors={self.errors} "
+            f"uptime={now - self.started:.0f}s"
+        )
+        self._last_report = now
+        self._last_claimed = self.claimed
+        self._last_assigned = self.assigned
+
+
+def run(batch_size: int, idle_sleep: float, report_seconds: float, once: bool = False):
+    worker_id = f"{socket.gethostname()}:{os.getpid()}"
+    stop = threading.Event()
+    wake = threading.Event()
+
+    def on_signal(*_):
+        stop.set()
+        wake.set()
+
+    signal.signal(signal.SIGTERM, on_signal)
+    signal.signal(signal.SIGINT, on_signal)
+
+    # New rides and finished/cancelled rides (drivers freeing up) end an idle wait early
+    event_bus.start()
+    event_bus.subscribe(lambda _event: wake.set(), types=("ride.created", "ride.status_changed", "ride.cancelled"))
+
+    stats = Throughput()
+    next_report = time.monotonic() + report_seconds
+    print(f"Info: dispatch_worker {worker_id} started (batch_size={batch_size})")
+
+    while not stop.is_set():
+        wake.clear()
+        busy = False
+        try:
+            if get_setting("auto_assignment_enabled", False):
+                result = run_batch_dispatch(max_rides=batch_size, exclusive=False)
+                stats.add(result)
+                # Progress means more work is likely waiting: go again now. A batch that assigned
+                # nothing (no free drivers nearby) waits, or idle workers would spin on the same rides.
+                busy = bool(result["assignments"])
+        except UniqueViolation:
+            # A driver took a ride through another path mid-batch; the batch rolled back, retry
+            stats.conflicts += 1
+            busy = True
+        except Exception as e:
+            stats.errors += 1
+            print(f"Warning: dispatch_worker batch failed: {e}")
+
+        if time.monotonic() >= next_report:
+            stats.report(worker_id)
+            next_report = time.monotonic() + report_seconds
+        if once:
+            break
+        if not busy:
+            wake.wait(idle_sleep)
+
+    stats.report(worker_id)
+    event_bus.stop()
+    close_clients()
+    close_pool()
+
 
 def main():
-    dsn = os.environ["DATABASE_URL"]
-    conn = psycopg2.connect(dsn)
-    with conn:
-        with conn.cursor() as cur:
-            cur.execute("""
-                SELECT id, status
-                FROM rides
-                WHERE status IN ('requested','accepted','enroute')
-                ORDER BY created_at_utc ASC
-                LIMIT 1
-            """)
-            row = cur.fetchone()
-            if not row:
-                return
-            ride_id, status = row
-
-            next_status = {
-                "requested": "accepted",
-                "accepted": "enroute",
-                "enroute": "completed",
-            }[status]
-
-            cur.execute("UPDATE rides SET status=%s WHERE id=%s", (next_status, ride_id))
-    conn.close()
+    parser = argparse.ArgumentParser(description="GlobApp auto-assignment worker")
+    parser.add_argument("--batch-size", type=int, default=DISPATCH_WORKER_BATCH_SIZE, help="rides claimed per batch")
+    parser.add_argument("--idle-sleep", type=float, default=DISPATCH_WORKER_IDLE_SLEEP_SECONDS, help="seconds to wait when idle")
+    parser.add_argument("--report-seconds", type=float, default=DISPATCH_WORKER_REPORT_SECONDS, help="throughput log interval")
+    parser.add_argument("--once", action="store_true", help="run a single batch and exit")
+    args = parser.parse_args()
+
+    if not DB_URL:
+        raise SystemExit("DATABASE_URL is not set")
+    run(args.batch_size, args.idle_sleep, args.report_seconds, once=args.once)
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,304 @@
+"""
+Spatial index of driver positions for GlobApp dispatch
+A uniform lat/lng grid (cell -> driver ids) kept current by the driver location endpoint,
+with an incremental catch-up from driver_locations so every API worker converges on the same view.
+
+nearest() does an expanding ring search, so a k-nearest query only touches the cells around
+the pickup instead of every driver in the fleet. Once a ring would cost more than visiting every
+occupied cell (a sparse or far-flung fleet, or a search that can't fill k), the remaining occupied
+cells are scanned directly, so the search never walks empty rings across the map.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timezone, timedelta
+from math import radians, cos, floor
+from typing import Iterable, Optional
+
+from geo_distance import distances_from
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+DRIVER_INDEX_CELL_DEG = float(_env("GLOBAPP_DRIVER_INDEX_CELL_DEG", "0.01"))  # ~0.7 mi of latitude
+DRIVER_INDEX_SYNC_SECONDS = float(_env("GLOBAPP_DRIVER_INDEX_SYNC_SECONDS", "5"))
+DRIVER_INDEX_MAX_AGE_SECONDS = int(_env("GLOBAPP_DRIVER_INDEX_MAX_AGE_SECONDS", "3600"))  # drop positions older than 1h
+DRIVER_INDEX_SYNC_OVERLAP_SECONDS = float(_env("GLOBAPP_DRIVER_INDEX_SYNC_OVERLAP_SECONDS", "5"))
+
+_MILES_PER_DEG_LAT = 69.0
+
+
+def _to_epoch(ts) -> float:
+    """Naive-UTC datetime (as stored in Postgres) or epoch seconds -> epoch seconds."""
+    if ts is None:
+        return time.time()
+    if isinstance(ts, datetime):
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=timezone.utc)
+        return ts.timestamp()
+    return float(ts)
+
+
+class DriverGridIndex:
+    """driver_id -> (lat, lng, updated_at) with a grid for radius / k-nearest queries."""
+
+    def __init__(self, cell_deg: float = DRIVER_INDEX_CELL_DEG):
+        self.cell_deg = cell_deg
+        self._lock = threading.RLock()
+        self._positions: dict[str, tuple[float, float, float, tuple[int, int]]] = {}
+        self._cells: dict[tuple[int, int], set] = {}
+        self._bounds: Optional[list[int]] = None  # [min_i, max_i, min_j, max_j] of occupied cells
+        self._bounds_stale = False  # an edge cell emptied; recomputed on the next search
+        self._synced_until = None  # max updated_at_utc pulled from driver_locations
+        self._last_sync = 0.0
+
+    def _cell(self, lat: float, lng: float) -> tuple[int, int]:
+        return (floor(lat / self.cell_deg), floor(lng / self.cell_deg))
+
+    # ---- writes ----
+    def upsert(self, driver_id, lat: float, lng: float, updated_at=None):
+        key = str(driver_id)
+        ts = _to_epoch(updated_at)
+        cell = self._cell(lat, lng)
+        with self._lock:
+            prev = self._positions.get(key)
+            if prev is not None:
+                if prev[2] > ts:
+                    return  # out-of-order update; keep the newer fix
+                if prev[3] != cell:
+                    self._discard_from_cell(key, prev[3])
+            self._positions[key] = (float(lat), float(lng), ts, cell)
+            self._cells.setdefault(cell, set()).add(key)
+            if self._bounds is None:
+                self._bounds = [cell[0], cell[0], cell[1], cell[1]]
+            else:
+                b = self._bounds
+                b[0], b[1] = min(b[0], cell[0]), max(b[1], cell[0])
+                b[2], b[3] = min(b[2], cell[1]), max(b[3], cell[1])
+
+    def remove(self, driver_id):
+        key = str(driver_id)
+        with self._lock:
+            prev = self._positions.pop(key, None)
+            if prev is not None:
+                self._discard_from_cell(key, prev[3])
+
+    def _discard_from_cell(self, key: str, cell: tuple[int, int]):
+        members = self._cells.get(cell)
+        if members is not None:
+            members.discard(key)
+            if not members:
+                del self._cells[cell]
+                b = self._bounds
+                if b is not None and (cell[0] in (b[0], b[1]) or cell[1] in (b[2], b[3])):
+                    self._bounds_stale = True
+
+    def _refresh_bounds(self):
+        # Caller holds self._lock
+        if not self._cells:
+            self._bounds = None
+        else:
+            cells = self._cells.keys()
+            self._bounds = [
+                min(c[0] for c in cells), max(c[0] for c in cells),
+                min(c[1] for c in cells), max(c[1] for c in cells),
+            ]
+        self._bounds_stale = False
+
+    def prune(self, max_age_seconds: float = DRIVER_INDEX_MAX_AGE_SECONDS):
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            stale = [k for k, p in self._positions.items() if p[2] < cutoff]
+            for key in stale:
+                self.remove(key)
+            if not self._positions:
+                self._bounds = None
+                self._bounds_stale = False
+        return len(stale)
+
+    def load(self, rows: Iterable):
+        """Bulk upsert of (driver_id, lat, lng, updated_at_utc) rows."""
+        for driver_id, lat, lng, updated_at in rows:
+            if lat is None or lng is None:
+                continue
+            self.upsert(driver_id, lat, lng, updated_at)
+
+    # ---- reads ----
+    def get(self, driver_id) -> Optional[tuple[float, float, float]]:
+        p = self._positions.get(str(driver_id))
+        return (p[0], p[1], p[2]) if p else None
+
+    def nearest(
+        self,
+        lat: float,
+        lng: float,
+        k: int = 10,
+        radius_miles: Optional[float] = None,
+        max_age_seconds: Optional[float] = None,
+        exclude: Optional[set] = None,
+    ) -> list[dict]:
+        """
+        Up to k drivers closest to (lat, lng), nearest first.
+        radius_miles=None/0 means unbounded; max_age_seconds skips positions older than that.
+        """
+        if k <= 0:
+            return []
+        now = time.time()
+        min_ts = now - max_age_seconds if max_age_seconds else None
+        exclude = exclude or set()
+        ci, cj = self._cell(lat, lng)
+
+        with self._lock:
+            if self._bounds_stale:
+                self._refresh_bounds()
+            if not self._positions or self._bounds is None:
+                return []
+            b = self._bounds
+            max_ring = max(abs(ci - b[0]), abs(ci - b[1]), abs(cj - b[2]), abs(cj - b[3]))
+
+            found: list[tuple[float, str]] = []
+            for ring in range(0, max_ring + 1):
+                # Ring `ring` has 8 * ring cells; past the number of occupied cells, take every
+                # occupied cell not searched yet in one last pass instead
+                last = ring > 0 and 8 * ring >= len(self._cells)
+                if last:
+                    cells = [c for c in self._cells if max(abs(c[0] - ci), abs(c[1] - cj)) >= ring]
+                else:
+                    cells = self._ring_cells(ci, cj, ring)
+                # Gather the whole ring first so distances are one vectorized call
+                keys, lats, lngs = [], [], []
+                for cell in cells:
+                    members = self._cells.get(cell)
+                    if not members:
+                        continue
+                    for key in members:
+                        if key in exclude:
+                            continue
+                        p_lat, p_lng, p_ts, _ = self._positions[key]
+                        if min_ts is not None and p_ts < min_ts:
+                            continue
+                        keys.append(key)
+                        lats.append(p_lat)
+                        lngs.append(p_lng)
+                if keys:
+                    for key, d in zip(keys, distances_from(lat, lng, lats, lngs)):
+                        d = float(d)
+                        if radius_miles and d > radius_miles:
+                            continue
+                        found.append((d, key))
+                if last:
+                    break
+
+                # Anything in ring+1 or beyond is at least `ring` whole cells away
+                reach = ring * self._min_cell_miles(lat, ring + 1)
+                if len(found) >= k:
+                    found.sort()
+                    if found[k - 1][0] <= reach:
+                        break
+                if radius_miles and reach > radius_miles:
+                    break
+
+            found.sort()
+            out = []
+            for d, key in found[:k]:
+                p_lat, p_lng, p_ts, _ = self._positions[key]
+                out.append({
+                    "driver_id": key,
+                    "distance_miles": round(d, 2),
+                    "lat": p_lat,
+                    "lng": p_lng,
+                    "updated_at_utc": datetime.fromtimestamp(p_ts, tz=timezone.utc).replace(tzinfo=None),
+                })
+            return out
+
+    def _ring_cells(self, ci: int, cj: int, ring: int):
+        if ring == 0:
+            yield (ci, cj)
+            return
+        for dj in range(-ring, ring + 1):
+            yield (ci - ring, cj + dj)
+            yield (ci + ring, cj + dj)
+        for di in range(-ring + 1, ring):
+            yield (ci + di, cj - ring)
+            yield (ci + di, cj + ring)
+
+    def _min_cell_miles(self, lat: float, rings: int) -> float:
+        # Longitude cells shrink toward the poles: use the narrowest latitude the search can reach
+        worst_lat = min(89.9, abs(lat) + rings * self.cell_deg)
+        return self.cell_deg * _MILES_PER_DEG_LAT * max(cos(radians(worst_lat)), 0.01)
+
+    # ---- Postgres catch-up ----
+    def sync(self, cur, force: bool = False) -> int:
+        """
+        Pull positions written since the last sync (including by other API workers).
+        Throttled to once per DRIVER_INDEX_SYNC_SECONDS unless force=True. Uses the caller's cursor.
+        """
+        now = time.monotonic()
+        if not force and now - self._last_sync < DRIVER_INDEX_SYNC_SECONDS:
+            return 0
+        self._last_sync = now
+
+        if self._synced_until is None:
+            cur.execute(
+                """
+                SELECT dl.driver_id, dl.lat, dl.lng, dl.updated_at_utc
+                FROM driver_locations dl
+                JOIN drivers d ON d.id = dl.driver_id
+                WHERE d.is_active = true
+                  AND dl.updated_at_utc > NOW() - (%s || ' seconds')::interval
+                """,
+                (DRIVER_INDEX_MAX_AGE_SECONDS,),
+            )
+        else:
+            cur.execute(
+                """
+                SELECT dl.driver_id, dl.lat, dl.lng, dl.updated_at_utc
+                FROM driver_locations dl
+                JOIN drivers d ON d.id = dl.driver_id
+                WHERE d.is_active = true
+                  AND dl.updated_at_utc > %s
+                """,
+                (self._synced_until,),
+            )
+        rows = cur.fetchall()
+        self.load(rows)
+        self._advance(rows)
+        self.prune()
+        return len(rows)
+
+    def _advance(self, rows: list):
+        # Same overlap as location_store: a fix stamped earlier can commit later (buffered
+        # flushes, device timestamps), so the next pull starts a little before the newest row
+        newest = max((r[3] for r in rows if r[3] is not None), default=None)
+        if newest is None:
+            return
+        candidate = newest - timedelta(seconds=DRIVER_INDEX_SYNC_OVERLAP_SECONDS)
+        if self._synced_until is None or candidate > self._synced_until:
+            self._synced_until = candidate
+
+    def feed(self, rows: list):
+        """
+        Positions pulled by someone else (location_store's background sync): counts as a sync,
+        so sync() skips its own query for the next DRIVER_INDEX_SYNC_SECONDS.
+        Rows are (driver_id, lat, lng, updated_at_utc).
+        """
+        self.load(rows)
+        self._advance(rows)
+        self._last_sync = time.monotonic()
+        self.prune()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "drivers": len(self._positions),
+                "cells": len(self._cells),
+                "cell_deg": self.cell_deg,
+                "synced_until_utc": self._synced_until.isoformat() if self._synced_until else None,
+            }
+
+
+driver_index = DriverGridIndex()
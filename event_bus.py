@@ -0,0 +1,259 @@
+"""
+Event buses for GlobApp (Postgres LISTEN/NOTIFY)
+Ride write paths call publish() on their own cursor before commit, so an event is delivered
+only if the write commits. Every API worker (and dispatch_worker.py) runs one listener
+connection per bus that fans events out to in-process subscribers, so consumers react to
+changes instead of polling.
+
+event_bus carries ride state changes; location_bus carries driver position updates (only for
+drivers on an active ride) on its own channel, so ride consumers don't parse the location firehose.
+notification_bus says which recipients just got notifications (wakes notification long-polls).
+
+Event payload (JSON):
+    {"type": "ride.assigned", "ride_id": "...", "status": "assigned",
+     "driver_id": "..." | null, "at_utc": "...", ...extra}
+
+Types: ride.created, ride.assigned, ride.accepted, ride.status_changed, ride.cancelled,
+       ride.message, ride.payment, ride.fare_finalized
+
+Location payload (location_bus):
+    {"type": "driver.location", "driver_id": "...", "lat": ..., "lng": ..., "heading_deg": ...,
+     "speed_mph": ..., "accuracy_m": ..., "updated_at_utc": "..."}
+
+Notification payload (notification_bus; recipients omitted if too many = wake everyone):
+    {"type": "notifications.created", "recipients": [["rider", "<ride_id>"], ["admin", null], ...],
+     "at_utc": "..."}
+
+Subscriber callbacks run on the listener thread and must return quickly; async consumers
+should hand events to their loop with loop.call_soon_threadsafe().
+"""
+
+import json
+import os
+import threading
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Optional
+
+import psycopg
+from psycopg import sql
+
+from db import database_url
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+EVENT_BUS_ENABLED = _env("GLOBAPP_EVENT_BUS_ENABLED", "true").lower() == "true"
+EVENT_BUS_CHANNEL = _env("GLOBAPP_EVENT_BUS_CHANNEL", "globapp_ride_events")
+LOCATION_BUS_CHANNEL = _env("GLOBAPP_LOCATION_BUS_CHANNEL", "globapp_driver_locations")
+NOTIFICATION_BUS_CHANNEL = _env("GLOBAPP_NOTIFICATION_BUS_CHANNEL", "globapp_notifications")
+EVENT_BUS_RECONNECT_SECONDS = float(_env("GLOBAPP_EVENT_BUS_RECONNECT_SECONDS", "2"))
+
+_NOTIFY_MAX_BYTES = 7900  # Postgres NOTIFY payload limit is 8000 bytes
+
+
+def publish(cur, event_type: str, ride_id, status: Optional[str] = None, driver_id=None, **extra):
+    """
+    Queue a ride event on the caller's transaction (sent by Postgres at COMMIT, dropped on rollback).
+    Keep extra small: payloads over the NOTIFY limit are sent without extra fields.
+    """
+    event = {
+        "type": event_type,
+        "ride_id": str(ride_id),
+        "status": status,
+        "driver_id": str(driver_id) if driver_id else None,
+        "at_utc": datetime.now(timezone.utc).replace(tzinfo=None).isoformat(),
+    }
+    payload = json.dumps({**event, **extra}, default=str)
+    if len(payload.encode("utf-8")) > _NOTIFY_MAX_BYTES:
+        payload = json.dumps(event)
+    cur.execute("SELECT pg_notify(%s, %s)", (EVENT_BUS_CHANNEL, payload))
+    event_bus.published += 1
+
+
+def _location_payload(driver_id, lat, lng, heading_deg=None, speed_mph=None, accuracy_m=None,
+                      updated_at_utc: Optional[datetime] = None) -> str:
+    return json.dumps({
+        "type": "driver.location",
+        "driver_id": str(driver_id),
+        "lat": lat,
+        "lng": lng,
+        "heading_deg": heading_deg,
+        "speed_mph": speed_mph,
+        "accuracy_m": accuracy_m,
+        "updated_at_utc": updated_at_utc.isoformat() if updated_at_utc else None,
+    })
+
+
+def publish_driver_location(cur, driver_id, lat: float, lng: float, heading_deg=None, speed_mph=None,
+                            accuracy_m=None, updated_at_utc: Optional[datetime] = None):
+    """
+    Queue a driver.location event on the caller's transaction, but only if the driver has an
+    active ride (uses idx_rides_active_driver); idle drivers' updates cost no NOTIFY traffic.
+    """
+    publish_driver_locations(cur, [(driver_id, updated_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m)])
+
+
+def publish_driver_locations(cur, rows: Iterable[tuple]):
+    """
+    publish_driver_location() for many drivers in one statement.
+    rows: (driver_id, updated_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m), as returned by
+    location_history.ingest_bulk().
+    """
+    rows = list(rows)
+    if not rows:
+        return
+    cur.execute(
+        """
+        SELECT pg_notify(%s, t.payload)
+        FROM unnest(%s::uuid[], %s::text[]) AS t(driver_id, payload)
+        WHERE EXISTS (
+            SELECT 1 FROM rides
+            WHERE assigned_driver_id = t.driver_id
+            AND status IN ('assigned', 'enroute', 'arrived', 'in_progress')
+        )
+        """,
+        (
+            LOCATION_BUS_CHANNEL,
+            [str(r[0]) for r in rows],
+            [_location_payload(r[0], r[2], r[3], r[4], r[5], r[6], r[1]) for r in rows],
+        ),
+    )
+    if cur.rowcount > 0:
+        location_bus.published += cur.rowcount
+
+
+def publish_notifications(cur, recipients: Iterable[tuple]):
+    """
+    Queue one notifications.created event on the caller's transaction for the
+    (recipient_type, recipient_id) pairs that were just written.
+    """
+    now = datetime.now(timezone.utc).replace(tzinfo=None).isoformat()
+    unique = sorted({(t, str(i) if i else None) for t, i in recipients}, key=lambda k: (k[0], k[1] or ""))
+    if not unique:
+        return
+    payload = json.dumps({"type": "notifications.created", "recipients": unique, "at_utc": now})
+    if len(payload.encode("utf-8")) > _NOTIFY_MAX_BYTES:
+        payload = json.dumps({"type": "notifications.created", "recipients": None, "at_utc": now})
+    cur.execute("SELECT pg_notify(%s, %s)", (NOTIFICATION_BUS_CHANNEL, payload))
+    notification_bus.published += 1
+
+
+class EventBus:
+    """One LISTEN connection per process and channel, fanning events out to subscriber callbacks."""
+
+    def __init__(self, channel: str = EVENT_BUS_CHANNEL):
+        self.channel = channel
+        self._lock = threading.Lock()
+        self._subscribers: dict[int, tuple[Callable[[dict], None], Optional[frozenset]]] = {}
+        self._next_token = 1
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.listening = False
+        self.published = 0
+        self.received = 0
+        self.delivered = 0
+        self.callback_errors = 0
+        self.bad_payloads = 0
+        self.reconnects = 0
+        self.last_event_utc: Optional[str] = None
+        self.last_error: Optional[str] = None
+
+    # ---- subscribers ----
+    def subscribe(self, callback: Callable[[dict], None], types: Optional[Iterable[str]] = None) -> int:
+        """Register callback(event) for all events, or only the given types. Returns a token for unsubscribe()."""
+        with self._lock:
+            token = self._next_token
+            self._next_token += 1
+            self._subscribers[token] = (callback, frozenset(types) if types else None)
+        return token
+
+    def unsubscribe(self, token: int):
+        with self._lock:
+            self._subscribers.pop(token, None)
+
+    def dispatch(self, event: dict):
+        """Deliver one event to matching subscribers (called by the listener)."""
+        with self._lock:
+            targets = [cb for cb, types in self._subscribers.values() if types is None or event.get("type") in types]
+        for cb in targets:
+            try:
+                cb(event)
+                self.delivered += 1
+            except Exception as e:
+                self.callback_errors += 1
+                print(f"Warning: Event subscriber failed ({self.channel}): {e}")
+
+    # ---- listener ----
+    def start(self):
+        """Start the listener thread (no-op if disabled, already running, or DATABASE_URL is unset)."""
+        if not EVENT_BUS_ENABLED or (self._thread and self._thread.is_alive()):
+            return
+        if not os.getenv("DATABASE_URL"):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._listen_loop, name=f"event-bus-{self.channel}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def _listen_loop(self):
+        first = True
+        while not self._stop.is_set():
+            if not first:
+                self.reconnects += 1
+            first = False
+            try:
+                # Dedicated connection: LISTEN must stay on one session, so it can't come from the pool
+                with psycopg.connect(database_url(), autocommit=True) as conn:
+                    conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(self.channel)))
+                    self.listening = True
+                    self.last_error = None
+                    while not self._stop.is_set():
+                        for notify in conn.notifies(timeout=1.0):
+                            self._handle(notify.payload)
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Warning: Event listener disconnected ({self.channel}): {e}")
+            finally:
+                self.listening = False
+            self._stop.wait(EVENT_BUS_RECONNECT_SECONDS)
+
+    def _handle(self, payload: str):
+        self.received += 1
+        try:
+            event = json.loads(payload)
+        except ValueError:
+            self.bad_payloads += 1
+            return
+        self.last_event_utc = event.get("at_utc") or event.get("updated_at_utc")
+        self.dispatch(event)
+
+    def stats(self) -> dict:
+        with self._lock:
+            subscribers = len(self._subscribers)
+        return {
+            "enabled": EVENT_BUS_ENABLED,
+            "channel": self.channel,
+            "listening": self.listening,
+            "subscribers": subscribers,
+            "published": self.published,
+            "received": self.received,
+            "delivered": self.delivered,
+            "callback_errors": self.callback_errors,
+            "bad_payloads": self.bad_payloads,
+            "reconnects": self.reconnects,
+            "last_event_utc": self.last_event_utc,
+            "last_error": self.last_error,
+        }
+
+
+event_bus = EventBus(EVENT_BUS_CHANNEL)
+location_bus = EventBus(LOCATION_BUS_CHANNEL)
+notification_bus = EventBus(NOTIFICATION_BUS_CHANNEL)
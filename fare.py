@@ -0,0 +1,149 @@
+"""
+Fares for GlobApp
+Quotes price the estimated route distance. When a driver completes a ride, finalize_ride_fare()
+re-prices it on the distance actually driven, measured from the driver's GPS trail
+(driver_location_history) between pickup (in_progress) and completion, and stores it on the
+ride with the actual distance and duration (migration 014).
+
+The trail is fetched as three arrays and reduced with geo_distance.path_length_miles (one
+vectorized pass). Fixes less accurate than FARE_MAX_ACCURACY_M and legs implying more than
+FARE_MAX_SPEED_MPH (GPS jumps) are ignored. If the trail is too sparse to trust (fewer than
+FARE_MIN_TRAIL_POINTS fixes, or covering less than FARE_MIN_TRAIL_COVERAGE of the trip time,
+e.g. the driver app was offline), or the ride never reached arrived/in_progress (the trail would
+include the drive to the pickup), the quoted distance is used instead; fare_source records which.
+A ride with neither a trusted trail nor a quoted distance gets no final fare (fare_source
+'estimate', final_fare_usd NULL) and is left for admin review (POST .../finalize-fare).
+"""
+
+import os
+import time
+from datetime import datetime
+from typing import Optional
+
+from geo_distance import path_length_miles
+from location_history import trail_arrays
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+FARE_BASE_USD = 4.00
+FARE_PER_MILE_USD = 2.80
+
+FARE_MAX_ACCURACY_M = float(_env("GLOBAPP_FARE_MAX_ACCURACY_M", "50"))
+FARE_MAX_SPEED_MPH = float(_env("GLOBAPP_FARE_MAX_SPEED_MPH", "120"))
+FARE_MIN_TRAIL_POINTS = int(_env("GLOBAPP_FARE_MIN_TRAIL_POINTS", "10"))
+FARE_MIN_TRAIL_COVERAGE = float(_env("GLOBAPP_FARE_MIN_TRAIL_COVERAGE", "0.5"))
+
+_COLUMNS_RECHECK_SECONDS = 60
+
+_columns_ready: Optional[bool] = None
+_columns_checked_at = 0.0
+
+
+def fare_columns_available(cur) -> bool:
+    """Whether migration 014 has run (cached; a missing column is re-checked every minute)."""
+    global _columns_ready, _columns_checked_at
+    if _columns_ready or (_columns_ready is False and time.monotonic() - _columns_checked_at < _COLUMNS_RECHECK_SECONDS):
+        return _columns_ready
+    cur.execute(
+        """
+        SELECT EXISTS (
+            SELECT 1 FROM information_schema.columns
+            WHERE table_schema = current_schema() AND table_name = 'rides' AND column_name = 'fare_finalized_at_utc'
+        )
+        """
+    )
+    _columns_ready = bool(cur.fetchone()[0])
+    _columns_checked_at = time.monotonic()
+    if not _columns_ready:
+        print("Warning: rides fare columns missing; final fares not stored. Run migrations/014_ride_actual_fare.sql")
+    return _columns_ready
+
+
+def fare_for_distance(distance_miles: float) -> float:
+    return round(FARE_BASE_USD + FARE_PER_MILE_USD * (distance_miles or 0), 2)
+
+
+def measure_trip(cur, driver_id, started_at_utc: datetime, ended_at_utc: datetime) -> dict:
+    """Driven distance over the driver's trail for [started_at_utc, ended_at_utc]."""
+    times, lats, lngs = trail_arrays(cur, driver_id, started_at_utc, ended_at_utc, FARE_MAX_ACCURACY_M)
+    miles, legs = path_length_miles(lats, lngs, times, FARE_MAX_SPEED_MPH)
+    trip_seconds = max((ended_at_utc - started_at_utc).total_seconds(), 0.0)
+    covered_seconds = (times[-1] - times[0]) if len(times) >= 2 else 0.0
+    return {
+        "points": len(times),
+        "legs": legs,
+        "distance_miles": round(miles, 3),
+        "coverage": round(covered_seconds / trip_seconds, 3) if trip_seconds else 0.0,
+    }
+
+
+def finalize_ride_fare(cur, ride_id, completed_at_utc: Optional[datetime] = None) -> Optional[dict]:
+    """
+    Price a completed ride on its GPS trail and store the result on the ride.
+    completed_at_utc defaults to the ride's completed_at_utc (re-pricing later).
+    Runs on the caller's transaction. Returns the stored values (None if there is nothing to price).
+    """
+    cur.execute(
+        """
+        SELECT assigned_driver_id, in_progress_at_utc, arrived_at_utc, assigned_at_utc,
+               estimated_distance_miles, completed_at_utc
+        FROM rides
+        WHERE id = %s
+        """,
+        (str(ride_id),),
+    )
+    row = cur.fetchone()
+    if not row or not row[0]:
+        return None
+    driver_id, in_progress_at, arrived_at, assigned_at, estimated_miles, completed_at = row
+    completed_at_utc = completed_at_utc or completed_at
+    if completed_at_utc is None:
+        return None
+    # Trip starts at pickup. Without an in_progress (or at least arrived) time the trail would
+    # include the drive to the pickup, so it isn't billed on; the quoted distance is used instead
+    started_at = in_progress_at or arrived_at
+    if started_at is not None:
+        trip = measure_trip(cur, driver_id, started_at, completed_at_utc)
+        trusted = trip["points"] >= FARE_MIN_TRAIL_POINTS and trip["coverage"] >= FARE_MIN_TRAIL_COVERAGE
+    else:
+        started_at = assigned_at or completed_at_utc
+        trip = {"points": 0, "legs": 0, "distance_miles": None, "coverage": 0.0}
+        trusted = False
+    duration_min = round(max((completed_at_utc - started_at).total_seconds(), 0.0) / 60, 2)
+    if trusted:
+        distance, source = trip["distance_miles"], "trail"
+    elif estimated_miles is not None:
+        distance, source = float(estimated_miles), "estimate"
+    else:
+        # Nothing trustworthy to bill on (an empty trail would price at the base fare)
+        distance, source = None, "estimate"
+        print(f"Warning: Ride {ride_id} has no usable trail ({trip['points']} fixes from pickup) or quoted distance; final fare left for review")
+    fare = fare_for_distance(distance) if distance is not None else None
+
+    cur.execute(
+        """
+        UPDATE rides
+        SET actual_distance_miles = %s,
+            actual_duration_min = %s,
+            actual_trail_points = %s,
+            final_fare_usd = %s,
+            fare_source = %s,
+            fare_finalized_at_utc = %s
+        WHERE id = %s
+        """,
+        (trip["distance_miles"], duration_min, trip["points"], fare, source, completed_at_utc, str(ride_id)),
+    )
+    return {
+        "final_fare_usd": fare,
+        "fare_source": source,
+        "billed_distance_miles": distance,
+        "actual_distance_miles": trip["distance_miles"],
+        "actual_duration_min": duration_min,
+        "trail_points": trip["points"],
+        "trail_coverage": trip["coverage"],
+        "needs_review": fare is None,
+    }
@@ -0,0 +1,408 @@
+"""
+Geocode and route caches for GlobApp
+Two tiers each: an in-process LRU (with TTL) in front of a Postgres table
+(geocode_cache, route_cache).
+Failed geocodes are cached too (negative caching) so bad addresses don't hit the provider every quote.
+"""
+
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone, timedelta
+from typing import Any, Callable, Optional
+
+from psycopg.errors import UndefinedTable
+
+from db import pooled_conn
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+GEOCODE_CACHE_SIZE = int(_env("GLOBAPP_GEOCODE_CACHE_SIZE", "10000"))
+GEOCODE_CACHE_TTL_SECONDS = int(_env("GLOBAPP_GEOCODE_CACHE_TTL_SECONDS", str(30 * 24 * 3600)))  # 30 days
+GEOCODE_NEGATIVE_TTL_SECONDS = int(_env("GLOBAPP_GEOCODE_NEGATIVE_TTL_SECONDS", "3600"))  # 1 hour
+
+ROUTE_CACHE_SIZE = int(_env("GLOBAPP_ROUTE_CACHE_SIZE", "5000"))
+ROUTE_CACHE_TTL_SECONDS = int(_env("GLOBAPP_ROUTE_CACHE_TTL_SECONDS", str(24 * 3600)))  # 1 day
+# Straight-line fallback routes (Directions unavailable) expire soon so a real route replaces them
+ROUTE_CACHE_FALLBACK_TTL_SECONDS = int(_env("GLOBAPP_ROUTE_CACHE_FALLBACK_TTL_SECONDS", "600"))  # 10 minutes
+# 0 = ignore time of day. e.g. 60 => separate entries per hour of the day (UTC), for traffic-sensitive durations
+ROUTE_CACHE_BUCKET_MINUTES = int(_env("GLOBAPP_ROUTE_CACHE_BUCKET_MINUTES", "0"))
+
+_MISSING = object()
+
+
+class TTLCache:
+    """Thread-safe LRU cache with a per-entry expiry."""
+
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = max(1, int(maxsize))
+        self.ttl_seconds = ttl_seconds
+        self._data: "OrderedDict[Any, tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            expires_at, value = entry
+            if expires_at <= now:
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl_seconds: Optional[float] = None):
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        with self._lock:
+            self._data[key] = (time.monotonic() + ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        with self._lock:
+            entry = self._data.pop(key, _MISSING)
+        return default if entry is _MISSING else entry[1]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class CacheCounters:
+    """Hit/miss counters shared by the caches in this module."""
+
+    def __init__(self, *names: str):
+        self._lock = threading.Lock()
+        self._counts = {name: 0 for name in names}
+
+    def incr(self, name: str, n: int = 1):
+        with self._lock:
+            self._counts[name] = self._counts.get(name, 0) + n
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self._counts)
+
+
+def normalize_address(address: str) -> str:
+    """Cache key for an address: case/whitespace/punctuation-insensitive."""
+    s = (address or "").strip().lower()
+    s = re.sub(r"[.#]", "", s)
+    s = re.sub(r"\s*,\s*", ", ", s)
+    s = re.sub(r"\s+", " ", s)
+    return s.strip(", ")
+
+
+class GeocodeCache:
+    """
+    address -> (lat, lng) | None
+
+    `fetch(address)` is only called on a miss in both tiers. It must return (lat, lng),
+    or None when the provider has no result (cached as a negative entry).
+    Exceptions from fetch (network errors, 5xx) are not cached.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: int, negative_ttl_seconds: int):
+        self.ttl_seconds = ttl_seconds
+        self.negative_ttl_seconds = negative_ttl_seconds
+        self.memory = TTLCache(maxsize, ttl_seconds)
+        self.counters = CacheCounters(
+            "memory_hits", "db_hits", "misses", "negative_hits", "provider_calls", "provider_errors", "db_errors"
+        )
+        self._table_missing = False
+
+    def lookup(self, address: str, fetch: Callable[[str], Optional[tuple[float, float]]]) -> Optional[tuple[float, float]]:
+        key = normalize_address(address)
+        if not key:
+            return None
+
+        cached = self.memory.get(key, _MISSING)
+        if cached is not _MISSING:
+            self.counters.incr("memory_hits")
+            if cached is None:
+                self.counters.incr("negative_hits")
+            return cached
+
+        found, coords, ttl_left = self._db_get(key)
+        if found:
+            self.counters.incr("db_hits")
+            if coords is None:
+                self.counters.incr("negative_hits")
+            self.memory.set(key, coords, ttl_left)
+            return coords
+
+        self.counters.incr("misses")
+        self.counters.incr("provider_calls")
+        try:
+            coords = fetch(address)
+        except Exception:
+            self.counters.incr("provider_errors")
+            raise
+
+        self.put(address, coords)
+        return coords
+
+    def peek(self, address: str) -> Optional[tuple[float, float]]:
+        """Cached coordinates for an address (either tier), without calling the provider."""
+        key = normalize_address(address)
+        if not key:
+            return None
+        cached = self.memory.get(key, _MISSING)
+        if cached is not _MISSING:
+            return cached
+        found, coords, ttl_left = self._db_get(key)
+        if found:
+            self.memory.set(key, coords, ttl_left)
+        return coords
+
+    def prime(self, address: str, coords: tuple[float, float]):
+        """Seed the in-memory tier only (coordinates already known and persisted elsewhere)."""
+        key = normalize_address(address)
+        if key and coords:
+            self.memory.set(key, (float(coords[0]), float(coords[1])))
+
+    def put(self, address: str, coords: Optional[tuple[float, float]]):
+        """Store a provider result (or None for not-found) in both tiers."""
+        key = normalize_address(address)
+        if not key:
+            return
+        ttl = self.ttl_seconds if coords is not None else self.negative_ttl_seconds
+        self.memory.set(key, coords, ttl)
+        self._db_put(key, coords, ttl)
+
+    def stats(self) -> dict:
+        return {
+            "memory_entries": len(self.memory),
+            "memory_max": self.memory.maxsize,
+            "table_available": not self._table_missing,
+            **self.counters.snapshot(),
+        }
+
+    # ---- Postgres tier ----
+    def _db_get(self, key: str) -> tuple[bool, Optional[tuple[float, float]], float]:
+        if self._table_missing:
+            return (False, None, 0)
+        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT lat, lng, found, expires_at_utc
+                        FROM geocode_cache
+                        WHERE address_key = %s AND expires_at_utc > %s
+                        """,
+                        (key, now_utc),
+                    )
+                    row = cur.fetchone()
+        except UndefinedTable:
+            self._table_missing = True
+            print("Info: geocode_cache table not found. Run migration 009_geocode_cache.sql")
+            return (False, None, 0)
+        except Exception as e:
+            self.counters.incr("db_errors")
+            print(f"Warning: geocode cache read failed: {e}")
+            return (False, None, 0)
+
+        if not row:
+            return (False, None, 0)
+        lat, lng, found, expires_at_utc = row
+        ttl_left = min(self.ttl_seconds, max(1.0, (expires_at_utc - now_utc).total_seconds()))
+        coords = (float(lat), float(lng)) if found else None
+        return (True, coords, ttl_left)
+
+    def _db_put(self, key: str, coords: Optional[tuple[float, float]], ttl_seconds: float):
+        if self._table_missing:
+            return
+        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        expires_at_utc = now_utc + timedelta(seconds=ttl_seconds)
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO geocode_cache (address_key, lat, lng, found, created_at_utc, expires_at_utc)
+                        VALUES (%s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (address_key) DO UPDATE SET
+                            lat = EXCLUDED.lat,
+                            lng = EXCLUDED.lng,
+                            found = EXCLUDED.found,
+                            created_at_utc = EXCLUDED.created_at_utc,
+                            expires_at_utc = EXCLUDED.expires_at_utc
+                        """,
+                        (
+                            key,
+                            coords[0] if coords else None,
+                            coords[1] if coords else None,
+                            coords is not None,
+                            now_utc,
+                            expires_at_utc,
+                        ),
+                    )
+                    conn.commit()
+        except UndefinedTable:
+            self._table_missing = True
+            print("Info: geocode_cache table not found. Run migration 009_geocode_cache.sql")
+        except Exception as e:
+            self.counters.incr("db_errors")
+            print(f"Warning: geocode cache write failed: {e}")
+
+
+geocode_cache = GeocodeCache(
+    maxsize=GEOCODE_CACHE_SIZE,
+    ttl_seconds=GEOCODE_CACHE_TTL_SECONDS,
+    negative_ttl_seconds=GEOCODE_NEGATIVE_TTL_SECONDS,
+)
+
+
+class RouteCache:
+    """
+    (pickup, dropoff[, time-of-day bucket]) -> (distance_miles, duration_min)
+
+    Callers store only provider-computed routes (Directions / geocode + Haversine),
+    never the hard-coded approximations, so a cached value is always a real estimate.
+    Haversine fallbacks are stored with ROUTE_CACHE_FALLBACK_TTL_SECONDS, so Directions is
+    asked again soon and its route replaces them.
+    """
+
+    def __init__(self, maxsize: int, ttl_seconds: int, bucket_minutes: int):
+        self.ttl_seconds = ttl_seconds
+        self.bucket_minutes = bucket_minutes
+        self.memory = TTLCache(maxsize, ttl_seconds)
+        self.counters = CacheCounters("memory_hits", "db_hits", "misses", "stores", "db_errors")
+        self._table_missing = False
+
+    def _key(self, pickup: str, dropoff: str) -> Optional[tuple[str, str, int]]:
+        origin_key = normalize_address(pickup)
+        destination_key = normalize_address(dropoff)
+        if not origin_key or not destination_key:
+            return None
+        bucket = 0
+        if self.bucket_minutes > 0:
+            now = datetime.now(timezone.utc)
+            bucket = (now.hour * 60 + now.minute) // self.bucket_minutes
+        return (origin_key, destination_key, bucket)
+
+    def get(self, pickup: str, dropoff: str) -> Optional[tuple[float, float]]:
+        key = self._key(pickup, dropoff)
+        if key is None:
+            return None
+
+        cached = self.memory.get(key)
+        if cached is not None:
+            self.counters.incr("memory_hits")
+            return cached
+
+        route, ttl_left = self._db_get(key)
+        if route is not None:
+            self.counters.incr("db_hits")
+            self.memory.set(key, route, ttl_left)
+            return route
+
+        self.counters.incr("misses")
+        return None
+
+    def put(self, pickup: str, dropoff: str, distance_miles: float, duration_min: float, provider: str,
+            ttl_seconds: Optional[float] = None):
+        """ttl_seconds overrides the cache TTL (e.g. short-lived fallback routes)."""
+        key = self._key(pickup, dropoff)
+        if key is None:
+            return
+        route = (float(distance_miles), float(duration_min))
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self.memory.set(key, route, ttl)
+        self.counters.incr("stores")
+        self._db_put(key, route, provider, ttl)
+
+    def stats(self) -> dict:
+        return {
+            "memory_entries": len(self.memory),
+            "memory_max": self.memory.maxsize,
+            "ttl_seconds": self.ttl_seconds,
+            "bucket_minutes": self.bucket_minutes,
+            "table_available": not self._table_missing,
+            **self.counters.snapshot(),
+        }
+
+    # ---- Postgres tier ----
+    def _db_get(self, key: tuple[str, str, int]) -> tuple[Optional[tuple[float, float]], float]:
+        if self._table_missing:
+            return (None, 0)
+        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        SELECT distance_miles, duration_min, expires_at_utc
+                        FROM route_cache
+                        WHERE origin_key = %s AND destination_key = %s AND time_bucket = %s
+                          AND expires_at_utc > %s
+                        """,
+                        (key[0], key[1], key[2], now_utc),
+                    )
+                    row = cur.fetchone()
+        except UndefinedTable:
+            self._table_missing = True
+            print("Info: route_cache table not found. Run migration 010_route_cache.sql")
+            return (None, 0)
+        except Exception as e:
+            self.counters.incr("db_errors")
+            print(f"Warning: route cache read failed: {e}")
+            return (None, 0)
+
+        if not row:
+            return (None, 0)
+        ttl_left = min(self.ttl_seconds, max(1.0, (row[2] - now_utc).total_seconds()))
+        return ((float(row[0]), float(row[1])), ttl_left)
+
+    def _db_put(self, key: tuple[str, str, int], route: tuple[float, float], provider: str, ttl_seconds: float):
+        if self._table_missing:
+            return
+        now_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        expires_at_utc = now_utc + timedelta(seconds=ttl_seconds)
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    cur.execute(
+                        """
+                        INSERT INTO route_cache (
+                            origin_key, destination_key, time_bucket,
+                            distance_miles, duration_min, provider, created_at_utc, expires_at_utc
+                        )
+                        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                        ON CONFLICT (origin_key, destination_key, time_bucket) DO UPDATE SET
+                            distance_miles = EXCLUDED.distance_miles,
+                            duration_min = EXCLUDED.duration_min,
+                            provider = EXCLUDED.provider,
+                            created_at_utc = EXCLUDED.created_at_utc,
+                            expires_at_utc = EXCLUDED.expires_at_utc
+                        """,
+                        (key[0], key[1], key[2], route[0], route[1], provider, now_utc, expires_at_utc),
+                    )
+                    conn.commit()
+        except UndefinedTable:
+            self._table_missing = True
+            print("Info: route_cache table not found. Run migration 010_route_cache.sql")
+        except Exception as e:
+            self.counters.incr("db_errors")
+            print(f"Warning: route cache write failed: {e}")
+
+
+route_cache = RouteCache(
+    maxsize=ROUTE_CACHE_SIZE,
+    ttl_seconds=ROUTE_CACHE_TTL_SECONDS,
+    bucket_minutes=ROUTE_CACHE_BUCKET_MINUTES,
+)
@@ -0,0 +1,146 @@
+"""
+Great-circle (Haversine) distances for GlobApp
+One implementation for the whole app: a scalar helper for single pairs, and NumPy kernels for
+one-to-many (pickup -> every nearby driver), many-to-many (rides x drivers) distances and
+trail length (sum over consecutive GPS fixes).
+
+NumPy is optional. Without it the bulk functions fall back to a Python loop and return lists.
+Very small inputs also take the loop path, because NumPy call overhead outweighs the math
+below a few dozen points.
+
+Benchmark: python geo_distance.py
+"""
+
+from math import radians, sin, cos, sqrt, atan2
+
+# NumPy (optional - bulk functions fall back to pure Python)
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    np = None
+
+EARTH_RADIUS_MILES = 3959.0
+_VECTOR_MIN_POINTS = 32  # below this the scalar loop is faster than array setup
+
+
+def haversine_miles(lat1: float, lon1: float, lat2: float, lon2: float) -> float:
+    """Distance in miles between two lat/lng points (unrounded)."""
+    lat1_rad, lat2_rad = radians(lat1), radians(lat2)
+    dlat = lat2_rad - lat1_rad
+    dlon = radians(lon2) - radians(lon1)
+    a = sin(dlat / 2) ** 2 + cos(lat1_rad) * cos(lat2_rad) * sin(dlon / 2) ** 2
+    return EARTH_RADIUS_MILES * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+
+def distances_from(lat: float, lng: float, lats, lngs):
+    """
+    Miles from one point to each of lats/lngs (same length).
+    Returns a float64 ndarray when NumPy is available and the input is large enough, else a list.
+    """
+    n = len(lats)
+    if not NUMPY_AVAILABLE or n < _VECTOR_MIN_POINTS:
+        return [haversine_miles(lat, lng, la, lo) for la, lo in zip(lats, lngs)]
+
+    lat_r = radians(lat)
+    lats_r = np.radians(np.asarray(lats, dtype=np.float64))
+    lngs_r = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin((lats_r - lat_r) * 0.5) ** 2 + cos(lat_r) * np.cos(lats_r) * np.sin((lngs_r - radians(lng)) * 0.5) ** 2
+    return EARTH_RADIUS_MILES * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def distance_matrix(lats1, lngs1, lats2, lngs2):
+    """
+    Miles between every point in set 1 (rows) and set 2 (columns), shape (len1, len2).
+    ndarray with NumPy, list of lists without.
+    """
+    if not NUMPY_AVAILABLE:
+        return [distances_from(la, lo, lats2, lngs2) for la, lo in zip(lats1, lngs1)]
+
+    lat1 = np.radians(np.asarray(lats1, dtype=np.float64))[:, None]
+    lng1 = np.radians(np.asarray(lngs1, dtype=np.float64))[:, None]
+    lat2 = np.radians(np.asarray(lats2, dtype=np.float64))[None, :]
+    lng2 = np.radians(np.asarray(lngs2, dtype=np.float64))[None, :]
+    a = np.sin((lat2 - lat1) * 0.5) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) * 0.5) ** 2
+    return EARTH_RADIUS_MILES * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+
+
+def path_length_miles(lats, lngs, times_s=None, max_speed_mph: float | None = None) -> tuple[float, int]:
+    """
+    Length of a GPS trail (points in time order): sum of the legs between consecutive points.
+    With times_s (epoch seconds) and max_speed_mph, legs implying a faster speed are GPS jumps
+    and don't count. Returns (miles, legs counted).
+    """
+    n = len(lats)
+    if n < 2:
+        return 0.0, 0
+    if not NUMPY_AVAILABLE:
+        total, legs = 0.0, 0
+        for i in range(1, n):
+            d = haversine_miles(lats[i - 1], lngs[i - 1], lats[i], lngs[i])
+            if times_s is not None and max_speed_mph:
+                dt = times_s[i] - times_s[i - 1]
+                if dt <= 0 or d / dt * 3600 > max_speed_mph:
+                    continue
+            total += d
+            legs += 1
+        return total, legs
+
+    lat_r = np.radians(np.asarray(lats, dtype=np.float64))
+    lng_r = np.radians(np.asarray(lngs, dtype=np.float64))
+    a = np.sin(np.diff(lat_r) * 0.5) ** 2 + np.cos(lat_r[:-1]) * np.cos(lat_r[1:]) * np.sin(np.diff(lng_r) * 0.5) ** 2
+    legs = EARTH_RADIUS_MILES * 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    if times_s is not None and max_speed_mph:
+        dt = np.diff(np.asarray(times_s, dtype=np.float64))
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ok = (dt > 0) & (legs / dt * 3600 <= max_speed_mph)
+        legs = legs[ok]
+    return float(legs.sum()), int(legs.size)
+
+
+def _benchmark():
+    import random
+    import time
+
+    def best_of(fn, repeat=5):
+        best = float("inf")
+        for _ in range(repeat):
+            started = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - started)
+        return best
+
+    random.seed(7)
+    origin = (32.7767, -96.7970)  # Dallas
+    print(f"NumPy available: {NUMPY_AVAILABLE}")
+    print(f"{'points':>8} {'scalar loop':>14} {'vectorized':>14} {'speedup':>8}")
+    for n in (1_000, 10_000, 100_000):
+        lats = [origin[0] + random.uniform(-0.5, 0.5) for _ in range(n)]
+        lngs = [origin[1] + random.uniform(-0.5, 0.5) for _ in range(n)]
+        t_loop = best_of(lambda: [haversine_miles(origin[0], origin[1], la, lo) for la, lo in zip(lats, lngs)])
+        if NUMPY_AVAILABLE:
+            lats_a, lngs_a = np.asarray(lats), np.asarray(lngs)
+            t_vec = best_of(lambda: distances_from(origin[0], origin[1], lats_a, lngs_a))
+            print(f"{n:>8} {n / t_loop / 1e6:>9.2f} M/s {n / t_vec / 1e6:>9.2f} M/s {t_loop / t_vec:>7.1f}x")
+        else:
+            print(f"{n:>8} {n / t_loop / 1e6:>9.2f} M/s {'-':>14} {'-':>8}")
+
+    if NUMPY_AVAILABLE:
+        for rows, cols in ((100, 1_000), (200, 400), (1_000, 1_000)):
+            lat1 = origin[0] + np.random.uniform(-0.5, 0.5, rows)
+            lng1 = origin[1] + np.random.uniform(-0.5, 0.5, rows)
+            lat2 = origin[0] + np.random.uniform(-0.5, 0.5, cols)
+            lng2 = origin[1] + np.random.uniform(-0.5, 0.5, cols)
+            t = best_of(lambda: distance_matrix(lat1, lng1, lat2, lng2))
+            print(f"matrix {rows}x{cols}: {t * 1000:.2f} ms ({rows * cols / t / 1e6:.1f} M pairs/s)")
+        for n in (10_000, 50_000):
+            lats = origin[0] + np.cumsum(np.random.uniform(-1e-4, 1e-4, n))
+            lngs = origin[1] + np.cumsum(np.random.uniform(-1e-4, 1e-4, n))
+            times = np.arange(n, dtype=np.float64)
+            t = best_of(lambda: path_length_miles(lats, lngs, times, 100))
+            print(f"trail {n} points: {t * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    _benchmark()
@@ -0,0 +1,194 @@
+"""
+Outbound HTTP clients for GlobApp
+One keep-alive requests.Session per provider (Google Maps, Nominatim, Stripe, ...), with
+per-host connection pools, retries with capped backoff, configurable timeouts and latency metrics.
+Read timeouts are not retried by default, so a call costs at most about one read timeout plus
+connect retries (GLOBAPP_HTTP_READ_RETRIES to change).
+
+Usage:
+    from http_client import get_client
+    resp = get_client("nominatim").get(url, params=..., headers=...)
+
+Per-provider settings come from env, e.g. GLOBAPP_HTTP_NOMINATIM_TIMEOUT_SECONDS,
+falling back to the GLOBAPP_HTTP_* defaults.
+"""
+
+import os
+import threading
+import time
+from collections import deque
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+HTTP_CONNECT_TIMEOUT_SECONDS = float(_env("GLOBAPP_HTTP_CONNECT_TIMEOUT_SECONDS", "3"))
+HTTP_TIMEOUT_SECONDS = float(_env("GLOBAPP_HTTP_TIMEOUT_SECONDS", "10"))  # read timeout
+HTTP_RETRIES = int(_env("GLOBAPP_HTTP_RETRIES", "2"))  # connection errors and retryable statuses
+# Read timeouts are not replayed by default: the providers sit on the quote/booking request path,
+# and a replayed read would multiply the worst-case latency by the retry count
+HTTP_READ_RETRIES = int(_env("GLOBAPP_HTTP_READ_RETRIES", "0"))
+HTTP_BACKOFF_SECONDS = float(_env("GLOBAPP_HTTP_BACKOFF_SECONDS", "0.3"))  # 0.3s, 0.6s, 1.2s, ...
+HTTP_BACKOFF_MAX_SECONDS = float(_env("GLOBAPP_HTTP_BACKOFF_MAX_SECONDS", "2"))  # cap per retry sleep
+# Retry-After on a 429/503 can ask for minutes; by default it is ignored and the capped backoff used
+HTTP_RESPECT_RETRY_AFTER = _env("GLOBAPP_HTTP_RESPECT_RETRY_AFTER", "false").lower() == "true"
+HTTP_POOL_MAXSIZE = int(_env("GLOBAPP_HTTP_POOL_MAXSIZE", "20"))  # connections kept per host
+
+_RETRY_STATUSES = (429, 500, 502, 503, 504)
+_LATENCY_SAMPLES = 1000
+
+
+class ProviderMetrics:
+    """Request count, status/error counts and latency percentiles over the last N calls."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.status_counts: dict[str, int] = {}
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self._samples: deque = deque(maxlen=_LATENCY_SAMPLES)
+
+    def record(self, elapsed_ms: float, status_code: int | None):
+        with self._lock:
+            self.requests += 1
+            self.total_ms += elapsed_ms
+            self.max_ms = max(self.max_ms, elapsed_ms)
+            self._samples.append(elapsed_ms)
+            key = str(status_code) if status_code is not None else "error"
+            self.status_counts[key] = self.status_counts.get(key, 0) + 1
+            if status_code is None:
+                self.errors += 1
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            samples = sorted(self._samples)
+            requests_n = self.requests
+
+            def pct(p: float):
+                if not samples:
+                    return None
+                return round(samples[min(len(samples) - 1, int(p * len(samples)))], 1)
+
+            return {
+                "requests": requests_n,
+                "errors": self.errors,
+                "status_counts": dict(self.status_counts),
+                "avg_ms": round(self.total_ms / requests_n, 1) if requests_n else None,
+                "p50_ms": pct(0.50),
+                "p95_ms": pct(0.95),
+                "max_ms": round(self.max_ms, 1) if requests_n else None,
+            }
+
+
+class ProviderClient:
+    """A pooled, retrying Session for one outbound provider."""
+
+    def __init__(self, name: str):
+        self.name = name
+        prefix = f"GLOBAPP_HTTP_{name.upper()}_"
+        self.connect_timeout = float(_env(prefix + "CONNECT_TIMEOUT_SECONDS", str(HTTP_CONNECT_TIMEOUT_SECONDS)))
+        self.read_timeout = float(_env(prefix + "TIMEOUT_SECONDS", str(HTTP_TIMEOUT_SECONDS)))
+        self.retries = int(_env(prefix + "RETRIES", str(HTTP_RETRIES)))
+        self.read_retries = min(int(_env(prefix + "READ_RETRIES", str(HTTP_READ_RETRIES))), self.retries)
+        self.backoff = float(_env(prefix + "BACKOFF_SECONDS", str(HTTP_BACKOFF_SECONDS)))
+        self.backoff_max = float(_env(prefix + "BACKOFF_MAX_SECONDS", str(HTTP_BACKOFF_MAX_SECONDS)))
+        self.respect_retry_after = _env(
+            prefix + "RESPECT_RETRY_AFTER", "true" if HTTP_RESPECT_RETRY_AFTER else "false"
+        ).lower() == "true"
+        self.pool_maxsize = int(_env(prefix + "POOL_MAXSIZE", str(HTTP_POOL_MAXSIZE)))
+        self.metrics = ProviderMetrics()
+
+        retry_args = dict(
+            total=self.retries,
+            connect=self.retries,
+            read=self.read_retries,
+            status=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=_RETRY_STATUSES,
+            allowed_methods=frozenset(["GET", "HEAD", "OPTIONS"]),  # never replay POSTs
+            respect_retry_after_header=self.respect_retry_after,
+            raise_on_status=False,
+        )
+        try:
+            retry = Retry(backoff_max=self.backoff_max, **retry_args)
+        except TypeError:  # urllib3 < 2: the cap is a class attribute
+            retry = Retry(**retry_args)
+            retry.DEFAULT_BACKOFF_MAX = self.backoff_max
+        adapter = HTTPAdapter(pool_connections=10, pool_maxsize=self.pool_maxsize, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        # Latency is recorded by a hook so libraries handed this session (e.g. Stripe) are measured too
+        self.session.hooks["response"].append(self._on_response)
+
+    def _on_response(self, response, *args, **kwargs):
+        self.metrics.record(response.elapsed.total_seconds() * 1000.0, response.status_code)
+
+    def request(self, method: str, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", (self.connect_timeout, self.read_timeout))
+        started = time.perf_counter()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            self.metrics.record((time.perf_counter() - started) * 1000.0, None)
+            raise
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        return self.request("POST", url, **kwargs)
+
+    def stats(self) -> dict:
+        return {
+            "config": {
+                "connect_timeout_seconds": self.connect_timeout,
+                "timeout_seconds": self.read_timeout,
+                "retries": self.retries,
+                "read_retries": self.read_retries,
+                "backoff_seconds": self.backoff,
+                "backoff_max_seconds": self.backoff_max,
+                "respect_retry_after": self.respect_retry_after,
+                "pool_maxsize": self.pool_maxsize,
+            },
+            **self.metrics.snapshot(),
+        }
+
+    def close(self):
+        self.session.close()
+
+
+_clients: dict[str, ProviderClient] = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(name: str) -> ProviderClient:
+    """Shared client for a provider name (created on first use)."""
+    client = _clients.get(name)
+    if client is None:
+        with _clients_lock:
+            client = _clients.get(name)
+            if client is None:
+                client = ProviderClient(name)
+                _clients[name] = client
+    return client
+
+
+def http_stats() -> dict:
+    return {name: client.stats() for name, client in list(_clients.items())}
+
+
+def close_clients():
+    with _clients_lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
@@ -0,0 +1,267 @@
+"""
+Live driver location streaming for GlobApp riders (WebSocket)
+Instead of polling GET /rides/{ride_id}/driver-location, a rider opens one WebSocket per ride.
+Driver position updates arrive over location_bus (Postgres NOTIFY, see event_bus.py) and ride
+state changes over event_bus; both are pushed to the sockets watching that ride.
+
+Throttling is per connection: at most one location message every
+LIVE_LOCATION_MIN_INTERVAL_SECONDS (updates in between are coalesced to the newest), and updates
+that moved less than LIVE_LOCATION_MIN_MOVE_METERS with no other change are not sent.
+
+Messages (JSON):
+    {"type": "snapshot", "ride_id", "status", "driver_id", "location": {...} | null}
+    {"type": "location", "driver_id", "updated_at_utc", ...only the fields that changed}
+    {"type": "ride", "ride_id", "status", "driver_id"}    (socket closes after a terminal status)
+    {"type": "ping"}                                        (keepalive when idle)
+"""
+
+import asyncio
+import os
+import threading
+import time
+from typing import Optional
+
+from starlette.websockets import WebSocket, WebSocketDisconnect, WebSocketState
+
+from event_bus import event_bus, location_bus
+from geo_distance import haversine_miles
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+LIVE_LOCATION_MIN_INTERVAL_SECONDS = float(_env("GLOBAPP_LIVE_LOCATION_MIN_INTERVAL_SECONDS", "1"))
+LIVE_LOCATION_MIN_MOVE_METERS = float(_env("GLOBAPP_LIVE_LOCATION_MIN_MOVE_METERS", "3"))
+LIVE_LOCATION_KEEPALIVE_SECONDS = float(_env("GLOBAPP_LIVE_LOCATION_KEEPALIVE_SECONDS", "25"))
+LIVE_LOCATION_MAX_CONNECTIONS = int(_env("GLOBAPP_LIVE_LOCATION_MAX_CONNECTIONS", "5000"))
+
+TERMINAL_STATUSES = frozenset({"completed", "cancelled"})
+_LOCATION_FIELDS = ("lat", "lng", "heading_deg", "speed_mph", "accuracy_m")
+_METERS_PER_MILE = 1609.344
+
+
+def location_delta(prev: Optional[dict], cur: dict) -> Optional[dict]:
+    """Fields of cur that differ from prev (None = nothing worth sending)."""
+    if prev is None or prev.get("lat") is None or prev.get("lng") is None:
+        return {f: cur.get(f) for f in _LOCATION_FIELDS}
+    delta = {}
+    moved_m = haversine_miles(prev["lat"], prev["lng"], cur["lat"], cur["lng"]) * _METERS_PER_MILE
+    if moved_m >= LIVE_LOCATION_MIN_MOVE_METERS:
+        delta["lat"], delta["lng"] = cur["lat"], cur["lng"]
+    for f in ("heading_deg", "speed_mph", "accuracy_m"):
+        if cur.get(f) != prev.get(f):
+            delta[f] = cur.get(f)
+    return delta or None
+
+
+class _RideWatcher:
+    """One socket's mailbox. Bus callbacks (listener thread) hand events to the socket's loop."""
+
+    def __init__(self, ride_id: str, driver_id: Optional[str], loop: asyncio.AbstractEventLoop):
+        self.ride_id = ride_id
+        self.driver_id = driver_id
+        self.loop = loop
+        self.wakeup = asyncio.Event()
+        self.pending_location: Optional[dict] = None
+        self.pending_ride_events: list[dict] = []
+        self.closed = False
+
+    def offer_location(self, event: dict):
+        self.loop.call_soon_threadsafe(self._set_location, event)
+
+    def offer_ride_event(self, event: dict):
+        self.loop.call_soon_threadsafe(self._add_ride_event, event)
+
+    def _set_location(self, event: dict):
+        if self.pending_location is not None:
+            live_locations.coalesced += 1  # newer fix replaces one not yet sent
+        self.pending_location = event
+        self.wakeup.set()
+
+    def _add_ride_event(self, event: dict):
+        self.pending_ride_events.append(event)
+        self.wakeup.set()
+
+    def close(self):
+        self.closed = True
+        self.wakeup.set()
+
+
+class LiveLocationHub:
+    """Routes bus events to ride sockets and keeps connection / message metrics."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_driver: dict[str, set] = {}
+        self._by_ride: dict[str, set] = {}
+        self._subscribed = False
+        self.open_connections = 0
+        self.connections_total = 0
+        self.rejected = 0
+        self.messages_sent = 0
+        self.coalesced = 0
+        self.suppressed = 0
+
+    def _ensure_subscribed(self):
+        with self._lock:
+            if self._subscribed:
+                return
+            self._subscribed = True
+        location_bus.subscribe(self._on_location, types=("driver.location",))
+        event_bus.subscribe(self._on_ride_event, types=("ride.assigned", "ride.accepted", "ride.status_changed", "ride.cancelled"))
+
+    def _on_location(self, event: dict):
+        with self._lock:
+            watchers = list(self._by_driver.get(event.get("driver_id"), ()))
+        for w in watchers:
+            w.offer_location(event)
+
+    def _on_ride_event(self, event: dict):
+        with self._lock:
+            watchers = list(self._by_ride.get(event.get("ride_id"), ()))
+        for w in watchers:
+            w.offer_ride_event(event)
+
+    def _add(self, w: _RideWatcher):
+        with self._lock:
+            self._by_ride.setdefault(w.ride_id, set()).add(w)
+            if w.driver_id:
+                self._by_driver.setdefault(w.driver_id, set()).add(w)
+            self.open_connections += 1
+            self.connections_total += 1
+
+    def _remove(self, w: _RideWatcher):
+        with self._lock:
+            self._discard(self._by_ride, w.ride_id, w)
+            if w.driver_id:
+                self._discard(self._by_driver, w.driver_id, w)
+            self.open_connections -= 1
+
+    def _rebind(self, w: _RideWatcher, driver_id: Optional[str]):
+        with self._lock:
+            if w.driver_id:
+                self._discard(self._by_driver, w.driver_id, w)
+            w.driver_id = driver_id
+            if driver_id:
+                self._by_driver.setdefault(driver_id, set()).add(w)
+
+    @staticmethod
+    def _discard(index: dict, key: str, w: _RideWatcher):
+        members = index.get(key)
+        if members is not None:
+            members.discard(w)
+            if not members:
+                del index[key]
+
+    async def stream(self, websocket: WebSocket, ride_id: str, status: str, driver_id: Optional[str], location: Optional[dict]):
+        """Serve one ride socket until the ride ends or the client goes away."""
+        if self.open_connections >= LIVE_LOCATION_MAX_CONNECTIONS:
+            self.rejected += 1
+            await websocket.close(code=1013)  # try again later
+            return
+
+        self._ensure_subscribed()
+        await websocket.accept()
+        w = _RideWatcher(ride_id, driver_id, asyncio.get_running_loop())
+        self._add(w)
+        receiver = asyncio.create_task(self._watch_client(websocket, w))
+        try:
+            await websocket.send_json({
+                "type": "snapshot",
+                "ride_id": ride_id,
+                "status": status,
+                "driver_id": driver_id,
+                "location": location,
+            })
+            if status in TERMINAL_STATUSES:
+                return
+
+            last_sent = location
+            last_sent_at = 0.0
+            while not w.closed:
+                try:
+                    await asyncio.wait_for(w.wakeup.wait(), timeout=LIVE_LOCATION_KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    await websocket.send_json({"type": "ping"})
+                    continue
+                w.wakeup.clear()
+
+                ended = False
+                while w.pending_ride_events:
+                    event = w.pending_ride_events.pop(0)
+                    new_driver = event.get("driver_id")
+                    await websocket.send_json({
+                        "type": "ride",
+                        "ride_id": ride_id,
+                        "status": event.get("status"),
+                        "driver_id": new_driver,
+                    })
+                    self.messages_sent += 1
+                    if new_driver and new_driver != w.driver_id:
+                        self._rebind(w, new_driver)
+                        last_sent = None
+                    if event.get("status") in TERMINAL_STATUSES:
+                        ended = True
+                if ended:
+                    break
+
+                if w.pending_location is not None:
+                    wait = last_sent_at + LIVE_LOCATION_MIN_INTERVAL_SECONDS - time.monotonic()
+                    if wait > 0:
+                        await asyncio.sleep(wait)  # fixes arriving meanwhile replace pending_location
+                    event, w.pending_location = w.pending_location, None
+                    if event is None or event.get("driver_id") != w.driver_id:
+                        continue
+                    delta = location_delta(last_sent, event)
+                    if delta is None:
+                        self.suppressed += 1
+                        continue
+                    await websocket.send_json({
+                        "type": "location",
+                        "driver_id": w.driver_id,
+                        "updated_at_utc": event.get("updated_at_utc"),
+                        **delta,
+                    })
+                    self.messages_sent += 1
+                    last_sent = {f: event.get(f) for f in _LOCATION_FIELDS}
+                    last_sent_at = time.monotonic()
+        except (WebSocketDisconnect, RuntimeError):
+            pass  # client went away mid-send
+        finally:
+            receiver.cancel()
+            self._remove(w)
+            if websocket.client_state == WebSocketState.CONNECTED:
+                try:
+                    await websocket.close()
+                except RuntimeError:
+                    pass
+
+    @staticmethod
+    async def _watch_client(websocket: WebSocket, w: _RideWatcher):
+        # Riders don't send anything; reading is how a closed socket is noticed promptly
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+        except Exception:
+            pass
+        w.close()
+
+    def stats(self) -> dict:
+        return {
+            "open_connections": self.open_connections,
+            "connections_total": self.connections_total,
+            "rejected": self.rejected,
+            "messages_sent": self.messages_sent,
+            "coalesced": self.coalesced,
+            "suppressed": self.suppressed,
+            "watched_drivers": len(self._by_driver),
+            "min_interval_seconds": LIVE_LOCATION_MIN_INTERVAL_SECONDS,
+            "max_connections": LIVE_LOCATION_MAX_CONNECTIONS,
+        }
+
+
+live_locations = LiveLocationHub()
@@ -0,0 +1,241 @@
+"""
+Write-behind buffer for driver location fixes
+PUT /api/v1/driver/location hands fixes to location_buffer and answers immediately. A background
+thread flushes every LOCATION_BUFFER_FLUSH_MS (sooner once LOCATION_BUFFER_FLUSH_ROWS fixes are
+waiting) in one transaction: one multi-row upsert of each driver's newest fix into
+driver_locations, the trail rows into driver_location_history, and one NOTIFY statement for the
+drivers on an active ride (location_history.ingest_bulk + event_bus.publish_driver_locations).
+
+Thousands of single-row UPSERT+COMMITs per second become one commit per interval, and a driver
+sending several fixes within an interval costs one driver_locations row version instead of several.
+
+The newest buffered fix per driver is readable with get() until its flush commits, so current
+location reads on this worker never go backwards. A failed flush is merged back and retried; if
+the database stays down, the oldest trail rows beyond LOCATION_BUFFER_MAX_PENDING are dropped
+(the newest fix per driver is always kept), a tenth of the cap at a time so a full buffer costs one
+pass per many fixes rather than one per fix. stop() flushes what is left.
+"""
+
+import os
+import threading
+import time
+from datetime import datetime, timezone
+from typing import Optional
+
+from db import pooled_conn
+from event_bus import publish_driver_locations
+from location_history import ingest_bulk
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+LOCATION_BUFFER_ENABLED = _env("GLOBAPP_LOCATION_BUFFER_ENABLED", "true").lower() == "true"
+LOCATION_BUFFER_FLUSH_MS = int(_env("GLOBAPP_LOCATION_BUFFER_FLUSH_MS", "1000"))
+LOCATION_BUFFER_FLUSH_ROWS = int(_env("GLOBAPP_LOCATION_BUFFER_FLUSH_ROWS", "5000"))
+LOCATION_BUFFER_MAX_PENDING = int(_env("GLOBAPP_LOCATION_BUFFER_MAX_PENDING", "200000"))
+
+_DROP_CHUNK = max(LOCATION_BUFFER_MAX_PENDING // 10, 1)  # trail rows dropped at once when full
+
+
+class LocationWriteBuffer:
+    """
+    Rows are (driver_id, recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m) with
+    driver_id as str; the same shape ingest_bulk() takes and returns.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()  # one flush at a time (background thread vs stop())
+        self._pending: list[tuple] = []             # every fix since the last flush (trail)
+        self._latest: dict[str, tuple] = {}         # newest pending fix per driver
+        self._inflight: dict[str, tuple] = {}       # newest fixes of the flush in progress
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.received = 0
+        self.coalesced = 0
+        self.flushes = 0
+        self.rows_written = 0
+        self.history_rows = 0
+        self.dropped = 0
+        self.errors = 0
+        self.last_flush_ms: Optional[float] = None
+        self.last_flush_rows = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    def add(self, driver_id, fix: tuple) -> bool:
+        """
+        Buffer one fix (recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m).
+        Returns False when the buffer isn't running; the caller should write directly.
+        """
+        if not self.running:
+            return False
+        row = (str(driver_id), *fix)
+        with self._lock:
+            self.received += 1
+            self._pending.append(row)
+            prev = self._latest.get(row[0])
+            if prev is not None:
+                self.coalesced += 1
+            if prev is None or prev[1] <= row[1]:
+                self._latest[row[0]] = row
+            overflow = len(self._pending) - LOCATION_BUFFER_MAX_PENDING
+            if overflow > 0:
+                self._drop_oldest(max(overflow, _DROP_CHUNK))
+            full = len(self._pending) >= LOCATION_BUFFER_FLUSH_ROWS
+        if full:
+            self._wake.set()
+        return True
+
+    def get(self, driver_id) -> Optional[tuple]:
+        """Newest fix for a driver not yet committed to driver_locations (None if nothing pending)."""
+        key = str(driver_id)
+        with self._lock:
+            return self._latest.get(key) or self._inflight.get(key)
+
+    def _drop_oldest(self, n: int):
+        # Caller holds self._lock. Trail rows go first; each driver's newest fix survives.
+        keep_latest = {id(r) for r in self._latest.values()}
+        kept = []
+        for row in self._pending:
+            if n > 0 and id(row) not in keep_latest:
+                n -= 1
+                self.dropped += 1
+                continue
+            kept.append(row)
+        self._pending = kept
+
+    # ---- flushing ----
+    def flush(self) -> int:
+        """Write everything pending in one transaction. Returns rows flushed (0 if nothing pending)."""
+        with self._flush_lock:
+            with self._lock:
+                if not self._pending:
+                    return 0
+                rows, self._pending = self._pending, []
+                self._inflight, self._latest = self._latest, {}
+            return self._write(rows)
+
+    def flush_driver(self, driver_id) -> int:
+        """
+        Write one driver's pending fixes now (e.g. before pricing their trip from the trail);
+        everyone else's wait for the next flush. Returns rows flushed.
+        """
+        key = str(driver_id)
+        with self._flush_lock:
+            with self._lock:
+                rows = [r for r in self._pending if r[0] == key]
+                if not rows:
+                    return 0
+                self._pending = [r for r in self._pending if r[0] != key]
+                latest = self._latest.pop(key, None)
+                self._inflight = {key: latest} if latest else {}
+            return self._write(rows)
+
+    def _write(self, rows: list[tuple]) -> int:
+        # Caller holds self._flush_lock and has moved rows (and their newest fixes) to _inflight
+        started = time.perf_counter()
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    received_at_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+                    inserted, applied = ingest_bulk(cur, rows, received_at_utc)
+                    publish_driver_locations(cur, applied)
+                conn.commit()
+        except Exception as e:
+            self.errors += 1
+            self.last_error = str(e)
+            print(f"Warning: Location buffer flush failed ({len(rows)} fixes, will retry): {e}")
+            self._requeue(rows)
+            return 0
+
+        with self._lock:
+            self._inflight = {}
+        self.flushes += 1
+        self.rows_written += len(applied)
+        self.history_rows += inserted
+        self.last_flush_rows = len(rows)
+        self.last_flush_ms = round((time.perf_counter() - started) * 1000, 2)
+        self.last_error = None
+        return len(rows)
+
+    def _requeue(self, rows: list[tuple]):
+        with self._lock:
+            self._pending = rows + self._pending
+            for key, row in self._inflight.items():
+                current = self._latest.get(key)
+                if current is None or current[1] < row[1]:
+                    self._latest[key] = row
+            self._inflight = {}
+            overflow = len(self._pending) - LOCATION_BUFFER_MAX_PENDING
+            if overflow > 0:
+                self._drop_oldest(max(overflow, _DROP_CHUNK))
+
+    def _run(self):
+        interval = LOCATION_BUFFER_FLUSH_MS / 1000.0
+        while not self._stop.is_set():
+            self._wake.wait(interval)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"Warning: Location buffer flush failed: {e}")
+
+    def start(self):
+        """Start the flush thread (no-op if disabled, already running, or DATABASE_URL is unset)."""
+        if not LOCATION_BUFFER_ENABLED or self.running:
+            return
+        if not os.getenv("DATABASE_URL"):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="location-buffer", daemon=True)
+        self._thread.start()
+        print(f"Info: Location write-behind buffer started (flush every {LOCATION_BUFFER_FLUSH_MS} ms)")
+
+    def stop(self):
+        """Stop the flush thread and write out whatever is still buffered."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+        try:
+            flushed = self.flush()
+            if flushed:
+                print(f"Info: Location buffer flushed {flushed} fixes on shutdown")
+        except Exception as e:
+            print(f"Warning: Location buffer final flush failed: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+            drivers = len(self._latest)
+        return {
+            "enabled": LOCATION_BUFFER_ENABLED,
+            "running": self.running,
+            "pending_fixes": pending,
+            "pending_drivers": drivers,
+            "received": self.received,
+            "coalesced": self.coalesced,
+            "flushes": self.flushes,
+            "rows_written": self.rows_written,
+            "history_rows": self.history_rows,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "last_flush_rows": self.last_flush_rows,
+            "last_flush_ms": self.last_flush_ms,
+            "flush_interval_ms": LOCATION_BUFFER_FLUSH_MS,
+            "last_error": self.last_error,
+        }
+
+
+location_buffer = LocationWriteBuffer()
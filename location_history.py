@@ -0,0 +1,474 @@
+"""
+Driver location ingest + GPS trail for GlobApp
+ingest_bulk() writes fixes for any number of drivers in one statement: the whole trail is
+appended to driver_location_history and only each driver's newest fix lands in driver_locations
+(and only if it is newer than what is stored, so a late backlog upload or a delayed buffer flush
+never rewinds a driver's position). That position is timestamped at most received_at_utc, so a
+device clock running ahead can't pin it; the trail keeps the device's recorded_at_utc.
+
+History rows are keyed by (driver_id, recorded_at_utc); re-sent fixes are skipped, which makes
+batch uploads safe to retry. Until migration 012 has run, only driver_locations is written.
+
+Since migration 013 the trail is partitioned by UTC day (driver_location_history_YYYYMMDD).
+history_maintainer creates partitions LOCATION_HISTORY_PRECREATE_DAYS ahead and drops those
+older than LOCATION_HISTORY_RETENTION_DAYS. Ingest does no DDL: the known days are loaded when the
+maintainer starts, and trail rows for a day without a partition are handed to the maintainer, which
+creates the day right away and writes them (up to LOCATION_HISTORY_HOLD_MAX_ROWS held; beyond
+that, and for rows already past retention, they are dropped and counted). read_trail() is the
+range read for trip replay: it hits the primary key and only the partitions in range.
+
+A fix is (recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m), naive UTC.
+"""
+
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Iterable, Optional, Sequence
+
+from psycopg import sql
+
+from db import pooled_conn
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+LOCATION_HISTORY_RETENTION_DAYS = int(_env("GLOBAPP_LOCATION_HISTORY_RETENTION_DAYS", "90"))
+LOCATION_HISTORY_PRECREATE_DAYS = int(_env("GLOBAPP_LOCATION_HISTORY_PRECREATE_DAYS", "2"))
+LOCATION_HISTORY_MAINTENANCE_SECONDS = float(_env("GLOBAPP_LOCATION_HISTORY_MAINTENANCE_SECONDS", "3600"))
+LOCATION_HISTORY_HOLD_MAX_ROWS = int(_env("GLOBAPP_LOCATION_HISTORY_HOLD_MAX_ROWS", "100000"))
+
+_HISTORY_RECHECK_SECONDS = 60
+_PARTITION_PREFIX = "driver_location_history_"
+_PARTITION_LOCK_KEY = 7301002  # pg advisory lock id for "creating/dropping history partitions"
+
+_history_ready: Optional[bool] = None
+_history_partitioned = False
+_history_checked_at = 0.0
+_partition_days: Optional[set] = None  # days known to have a partition (None = not loaded yet)
+_partition_lock = threading.Lock()
+
+
+def history_available(cur) -> bool:
+    """Whether driver_location_history exists (cached; a missing table is re-checked every minute)."""
+    global _history_ready, _history_partitioned, _history_checked_at
+    if _history_ready or (_history_ready is False and time.monotonic() - _history_checked_at < _HISTORY_RECHECK_SECONDS):
+        return _history_ready
+    cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass('driver_location_history')")
+    row = cur.fetchone()
+    _history_ready = row is not None
+    _history_partitioned = bool(row) and row[0] == "p"
+    _history_checked_at = time.monotonic()
+    if not _history_ready:
+        print("Warning: driver_location_history table missing; GPS trail not recorded. Run migrations/012_driver_location_history.sql")
+    elif not _history_partitioned:
+        print("Warning: driver_location_history is not partitioned; no retention. Run migrations/013_partition_driver_location_history.sql")
+    return _history_ready
+
+
+def _utc_today() -> date:
+    return datetime.now(timezone.utc).date()
+
+
+def _partition_name(day: date) -> str:
+    return f"{_PARTITION_PREFIX}{day:%Y%m%d}"
+
+
+def _existing_partition_days(cur) -> set:
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('driver_location_history')
+        """
+    )
+    days = set()
+    for (name,) in cur.fetchall():
+        try:
+            days.add(datetime.strptime(name[len(_PARTITION_PREFIX):], "%Y%m%d").date())
+        except ValueError:
+            pass  # not one of ours
+    return days
+
+
+def _known_partition_days(cur) -> set:
+    """Days with a partition, loaded once on the caller's cursor if the maintainer hasn't yet."""
+    global _partition_days
+    with _partition_lock:
+        if _partition_days is not None:
+            return _partition_days
+    existing = _existing_partition_days(cur)
+    with _partition_lock:
+        if _partition_days is None:
+            _partition_days = existing
+        return _partition_days
+
+
+def ensure_partitions(days: Iterable[date]) -> int:
+    """
+    Create missing day partitions. Runs in its own short transaction (partition DDL locks the
+    parent table; it must not be held for the caller's whole write). Returns partitions created.
+    """
+    global _partition_days
+    days = set(days)
+    with _partition_lock:
+        if _partition_days is not None and days <= _partition_days:
+            return 0
+    created = 0
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            # Serialize with other workers so concurrent CREATE ... IF NOT EXISTS can't collide
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (_PARTITION_LOCK_KEY,))
+            existing = _existing_partition_days(cur)
+            for day in sorted(days - existing):
+                cur.execute(
+                    sql.SQL(
+                        "CREATE TABLE IF NOT EXISTS {} PARTITION OF driver_location_history "
+                        "FOR VALUES FROM ({}) TO ({})"
+                    ).format(sql.Identifier(_partition_name(day)), sql.Literal(day), sql.Literal(day + timedelta(days=1)))
+                )
+                existing.add(day)
+                created += 1
+        conn.commit()
+    with _partition_lock:
+        _partition_days = existing
+    return created
+
+
+def drop_expired_partitions(retention_days: int = LOCATION_HISTORY_RETENTION_DAYS) -> list[str]:
+    """Drop day partitions entirely older than the retention window. Returns dropped table names."""
+    global _partition_days
+    cutoff = _utc_today() - timedelta(days=retention_days)
+    dropped = []
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_xact_lock(%s)", (_PARTITION_LOCK_KEY,))
+            existing = _existing_partition_days(cur)
+            for day in sorted(d for d in existing if d < cutoff):
+                cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(_partition_name(day))))
+                existing.discard(day)
+                dropped.append(_partition_name(day))
+        conn.commit()
+    with _partition_lock:
+        _partition_days = existing
+    return dropped
+
+
+_UPSERT_LATEST = """
+    INSERT INTO driver_locations (driver_id, lat, lng, heading_deg, speed_mph, accuracy_m, updated_at_utc)
+    SELECT * FROM unnest(
+        %(l_driver_ids)s::uuid[], %(l_lats)s::float8[], %(l_lngs)s::float8[],
+        %(l_headings)s::float8[], %(l_speeds)s::float8[], %(l_accuracies)s::float8[], %(l_ts)s::timestamp[]
+    )
+    ON CONFLICT (driver_id) DO UPDATE SET
+      lat = EXCLUDED.lat,
+      lng = EXCLUDED.lng,
+      heading_deg = EXCLUDED.heading_deg,
+      speed_mph = EXCLUDED.speed_mph,
+      accuracy_m = EXCLUDED.accuracy_m,
+      updated_at_utc = EXCLUDED.updated_at_utc
+    WHERE driver_locations.updated_at_utc IS NULL
+       OR driver_locations.updated_at_utc <= EXCLUDED.updated_at_utc
+    RETURNING driver_id
+"""
+
+_APPEND_HISTORY = """
+    INSERT INTO driver_location_history
+        (driver_id, recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m, received_at_utc)
+    SELECT t.*, %(received_at_utc)s
+    FROM unnest(
+        %(h_driver_ids)s::uuid[], %(h_ts)s::timestamp[], %(h_lats)s::float8[], %(h_lngs)s::float8[],
+        %(h_headings)s::float8[], %(h_speeds)s::float8[], %(h_accuracies)s::float8[]
+    ) AS t(driver_id, recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m)
+    ON CONFLICT (driver_id, recorded_at_utc) DO NOTHING
+    RETURNING 1
+"""
+
+
+_APPEND_HELD = """
+    INSERT INTO driver_location_history
+        (driver_id, recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m, received_at_utc)
+    SELECT * FROM unnest(
+        %s::uuid[], %s::timestamp[], %s::float8[], %s::float8[],
+        %s::float8[], %s::float8[], %s::float8[], %s::timestamp[]
+    )
+    ON CONFLICT (driver_id, recorded_at_utc) DO NOTHING
+"""
+
+
+def ingest_bulk(cur, rows: Sequence[tuple], received_at_utc: datetime) -> tuple[int, list[tuple]]:
+    """
+    rows: (driver_id, *fix) tuples for any drivers, any order.
+    Returns (history rows inserted, [(driver_id, *fix)] that became drivers' current positions,
+    as stored: timestamps capped at received_at_utc). One round trip; runs on the caller's transaction.
+    """
+    if not rows:
+        return 0, []
+    latest: dict[str, tuple] = {}
+    for row in rows:
+        key = str(row[0])
+        prev = latest.get(key)
+        if prev is None or prev[1] <= row[1]:
+            latest[key] = (key, *row[1:])
+    # The current position is stamped no later than receipt: a fix from a device clock running
+    # ahead would otherwise win the newer-than guard against every live update until then
+    newest = [(r[0], min(r[1], received_at_utc), *r[2:]) for r in latest.values()]
+    params = {
+        "l_driver_ids": [r[0] for r in newest],
+        "l_ts": [r[1] for r in newest],
+        "l_lats": [r[2] for r in newest],
+        "l_lngs": [r[3] for r in newest],
+        "l_headings": [r[4] for r in newest],
+        "l_speeds": [r[5] for r in newest],
+        "l_accuracies": [r[6] for r in newest],
+    }
+
+    if history_available(cur) and _history_partitioned:
+        # Trail rows already past retention would only be dropped again; skip them
+        oldest_kept = _utc_today() - timedelta(days=LOCATION_HISTORY_RETENTION_DAYS)
+        rows = [r for r in rows if r[1].date() >= oldest_kept]
+        if rows:
+            # Partition DDL (and the extra connection it needs) stays off the write path: rows
+            # for a day without a partition are held by the maintainer, which creates the day
+            # and writes them
+            missing = {r[1].date() for r in rows} - _known_partition_days(cur)
+            if missing:
+                history_maintainer.hold_rows([r for r in rows if r[1].date() in missing], received_at_utc)
+                rows = [r for r in rows if r[1].date() not in missing]
+
+    if history_available(cur) and rows:
+        params.update({
+            "received_at_utc": received_at_utc,
+            "h_driver_ids": [str(r[0]) for r in rows],
+            "h_ts": [r[1] for r in rows],
+            "h_lats": [r[2] for r in rows],
+            "h_lngs": [r[3] for r in rows],
+            "h_headings": [r[4] for r in rows],
+            "h_speeds": [r[5] for r in rows],
+            "h_accuracies": [r[6] for r in rows],
+        })
+        cur.execute(
+            f"""
+            WITH hist AS ({_APPEND_HISTORY}), latest AS ({_UPSERT_LATEST})
+            SELECT (SELECT count(*) FROM hist), ARRAY(SELECT driver_id FROM latest)
+            """,
+            params,
+        )
+        inserted, applied_ids = cur.fetchone()
+    else:
+        cur.execute(_UPSERT_LATEST, params)
+        inserted, applied_ids = 0, [r[0] for r in cur.fetchall()]
+
+    applied = {str(d) for d in applied_ids}
+    return int(inserted), [r for r in newest if r[0] in applied]
+
+
+def ingest_fixes(cur, driver_id, fixes: Sequence[tuple], received_at_utc: datetime) -> tuple[int, Optional[tuple]]:
+    """
+    One driver's fixes. Returns (history rows inserted, newest fix if it became the driver's
+    current position else None).
+    """
+    inserted, applied = ingest_bulk(cur, [(driver_id, *f) for f in fixes], received_at_utc)
+    return inserted, (applied[0][1:] if applied else None)
+
+
+def read_trail(cur, driver_id, start_utc: datetime, end_utc: datetime, limit: int) -> list[tuple]:
+    """
+    A driver's fixes with start_utc <= recorded_at_utc < end_utc, oldest first, at most limit.
+    Rows are fixes (see module docstring). Page by passing the last recorded_at_utc (+1us) as start.
+    """
+    cur.execute(
+        """
+        SELECT recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m
+        FROM driver_location_history
+        WHERE driver_id = %s
+          AND recorded_at_utc >= %s
+          AND recorded_at_utc < %s
+        ORDER BY recorded_at_utc
+        LIMIT %s
+        """,
+        (str(driver_id), start_utc, end_utc, limit),
+    )
+    return cur.fetchall()
+
+
+def trail_arrays(cur, driver_id, start_utc: datetime, end_utc: datetime,
+                 max_accuracy_m: Optional[float] = None) -> tuple[list, list, list]:
+    """
+    (epoch_seconds, lats, lngs) of a driver's fixes in [start_utc, end_utc], oldest first,
+    optionally skipping fixes less accurate than max_accuracy_m. One row of three float8 arrays
+    in binary, so tens of thousands of points cost one round trip and no per-row tuples.
+    """
+    with cur.connection.cursor(binary=True) as bcur:
+        bcur.execute(
+            """
+            SELECT
+                array_agg(extract(epoch FROM recorded_at_utc)::float8 ORDER BY recorded_at_utc),
+                array_agg(lat ORDER BY recorded_at_utc),
+                array_agg(lng ORDER BY recorded_at_utc)
+            FROM driver_location_history
+            WHERE driver_id = %s
+              AND recorded_at_utc >= %s
+              AND recorded_at_utc <= %s
+              AND (%s::float8 IS NULL OR accuracy_m IS NULL OR accuracy_m <= %s::float8)
+            """,
+            (str(driver_id), start_utc, end_utc, max_accuracy_m, max_accuracy_m),
+        )
+        times, lats, lngs = bcur.fetchone()
+    return times or [], lats or [], lngs or []
+
+
+class HistoryMaintainer:
+    """Background partition upkeep: create upcoming days, drop expired ones."""
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._pending_lock = threading.Lock()
+        self._pending_days: set = set()  # days ingest found without a partition
+        self._held: list[tuple] = []     # their trail rows: (driver_id, *fix, received_at_utc)
+        self.runs = 0
+        self.partitions_created = 0
+        self.partitions_dropped = 0
+        self.rows_held = 0
+        self.rows_held_written = 0
+        self.rows_skipped = 0
+        self.errors = 0
+        self.last_run_utc: Optional[datetime] = None
+        self.last_error: Optional[str] = None
+
+    def run_once(self) -> dict:
+        with pooled_conn() as conn:
+            with conn.cursor() as cur:
+                if not history_available(cur) or not _history_partitioned:
+                    return {"created": 0, "dropped": []}
+        today = _utc_today()
+        with self._pending_lock:
+            pending, self._pending_days = self._pending_days, set()
+        days = {today + timedelta(days=i) for i in range(LOCATION_HISTORY_PRECREATE_DAYS + 1)} | pending
+        try:
+            created = ensure_partitions(days)
+        except Exception:
+            with self._pending_lock:
+                self._pending_days |= pending
+            raise
+        self._write_held()
+        dropped = drop_expired_partitions()
+        self.runs += 1
+        self.partitions_created += created
+        self.partitions_dropped += len(dropped)
+        self.last_run_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+        if created or dropped:
+            print(f"Info: Location history partitions: created {created}, dropped {len(dropped)}")
+        return {"created": created, "dropped": dropped}
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"Warning: Location history maintenance failed: {e}")
+            self._wake.wait(LOCATION_HISTORY_MAINTENANCE_SECONDS)
+            self._wake.clear()
+
+    def hold_rows(self, rows: Sequence[tuple], received_at_utc: datetime):
+        """
+        Trail rows whose day has no partition yet: the next (immediate) run creates the day and
+        writes them. Past LOCATION_HISTORY_HOLD_MAX_ROWS held, further rows are dropped.
+        """
+        with self._pending_lock:
+            self._pending_days.update(r[1].date() for r in rows)
+            room = max(LOCATION_HISTORY_HOLD_MAX_ROWS - len(self._held), 0)
+            self._held.extend((str(r[0]), *r[1:7], received_at_utc) for r in rows[:room])
+            self.rows_held += min(len(rows), room)
+            self.rows_skipped += max(len(rows) - room, 0)
+        self._wake.set()
+
+    def _write_held(self) -> int:
+        with self._pending_lock:
+            held, self._held = self._held, []
+        if not held:
+            return 0
+        oldest_kept = _utc_today() - timedelta(days=LOCATION_HISTORY_RETENTION_DAYS)
+        with _partition_lock:
+            known = set(_partition_days or ())
+        ready = [r for r in held if r[1].date() in known]
+        waiting = [r for r in held if r[1].date() not in known and r[1].date() >= oldest_kept]
+        expired = len(held) - len(ready) - len(waiting)
+        try:
+            if ready:
+                with pooled_conn() as conn:
+                    with conn.cursor() as cur:
+                        cur.execute(_APPEND_HELD, [list(col) for col in zip(*ready)])
+                    conn.commit()
+        except Exception:
+            with self._pending_lock:
+                self._held = ready + waiting + self._held
+            raise
+        with self._pending_lock:
+            self._held = waiting + self._held
+            self._pending_days.update(r[1].date() for r in waiting)
+            self.rows_held_written += len(ready)
+            self.rows_skipped += expired
+        return len(ready)
+
+    def start(self):
+        """
+        Load the known partition days (so ingest never has to), then start the maintenance
+        thread. No-op if already running or DATABASE_URL is unset.
+        """
+        if (self._thread and self._thread.is_alive()) or not os.getenv("DATABASE_URL"):
+            return
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    if history_available(cur) and _history_partitioned:
+                        _known_partition_days(cur)
+        except Exception as e:
+            print(f"Warning: Could not load location history partitions: {e}")
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="location-history-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> dict:
+        with _partition_lock:
+            partitions = sorted(_partition_days) if _partition_days is not None else None
+        with self._pending_lock:
+            pending_days = len(self._pending_days)
+            held = len(self._held)
+        return {
+            "partitioned": _history_partitioned,
+            "partitions": len(partitions) if partitions is not None else None,
+            "oldest_partition": partitions[0].isoformat() if partitions else None,
+            "newest_partition": partitions[-1].isoformat() if partitions else None,
+            "retention_days": LOCATION_HISTORY_RETENTION_DAYS,
+            "runs": self.runs,
+            "partitions_created": self.partitions_created,
+            "partitions_dropped": self.partitions_dropped,
+            "pending_days": pending_days,
+            "rows_held": held,
+            "rows_held_total": self.rows_held,
+            "rows_held_written": self.rows_held_written,
+            "rows_skipped_no_partition": self.rows_skipped,
+            "errors": self.errors,
+            "last_run_utc": self.last_run_utc.isoformat() if self.last_run_utc else None,
+            "last_error": self.last_error,
+        }
+
+
+history_maintainer = HistoryMaintainer()
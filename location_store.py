@@ -0,0 +1,340 @@
+"""
+Live location store for GlobApp
+Current driver positions (driver_locations) and rider positions (rider_locations, by ride) held
+in memory, so location reads on an API worker are served without a database round trip.
+
+Each table gives every id a slot; lat, lng, heading, speed, accuracy and updated_at live in
+typed arrays (array('d'), NaN = null) indexed by that slot. That's 48 bytes per position instead
+of a dict of Python floats, and with NumPy the age filters run over the arrays directly.
+
+Postgres stays the durable copy and the source of truth across workers:
+- write paths put() here as well as writing the database (or the write-behind buffer)
+- location_bus events (drivers on an active ride) are applied as they arrive
+- a background thread pulls rows changed since the last pull (with a small overlap for
+  late commits) every LOCATION_STORE_SYNC_SECONDS and reloads everything every
+  LOCATION_STORE_RELOAD_SECONDS; the first load runs at startup
+- the same rows feed driver_index, which then needs no queries of its own
+
+Until the first load completes (or in processes that don't start() it, such as
+dispatch_worker.py) `ready` is False and callers read Postgres as before.
+"""
+
+import os
+import threading
+import time
+from array import array
+from datetime import datetime, timezone, timedelta
+from math import isnan, nan
+from typing import Iterable, Optional
+
+# NumPy (optional - array scans fall back to a Python loop)
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+    np = None
+
+from psycopg.errors import UndefinedTable
+
+from db import pooled_conn
+from driver_index import driver_index
+from event_bus import location_bus
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+LOCATION_STORE_ENABLED = _env("GLOBAPP_LOCATION_STORE_ENABLED", "true").lower() == "true"
+LOCATION_STORE_SYNC_SECONDS = float(_env("GLOBAPP_LOCATION_STORE_SYNC_SECONDS", "2"))
+LOCATION_STORE_SYNC_OVERLAP_SECONDS = float(_env("GLOBAPP_LOCATION_STORE_SYNC_OVERLAP_SECONDS", "5"))
+LOCATION_STORE_RELOAD_SECONDS = float(_env("GLOBAPP_LOCATION_STORE_RELOAD_SECONDS", "300"))
+LOCATION_STORE_RIDER_MAX_AGE_SECONDS = int(_env("GLOBAPP_LOCATION_STORE_RIDER_MAX_AGE_SECONDS", "86400"))
+
+_FIELDS = ("lat", "lng", "heading_deg", "speed_mph", "accuracy_m")
+
+
+def _epoch(ts: Optional[datetime]) -> float:
+    """Naive-UTC datetime -> epoch seconds (NaN for None)."""
+    if ts is None:
+        return nan
+    if ts.tzinfo is None:
+        ts = ts.replace(tzinfo=timezone.utc)
+    return ts.timestamp()
+
+
+def _naive_utc(epoch: float) -> Optional[datetime]:
+    return None if isnan(epoch) else datetime.fromtimestamp(epoch, tz=timezone.utc).replace(tzinfo=None)
+
+
+def _num(v) -> float:
+    return nan if v is None else float(v)
+
+
+def _opt(v: float) -> Optional[float]:
+    return None if isnan(v) else v
+
+
+class PositionTable:
+    """id -> slot, with one typed array per field. Freed slots are reused."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._slots: dict[str, int] = {}
+        self._ids: list[Optional[str]] = []
+        self._free: list[int] = []
+        self._cols = {f: array("d") for f in _FIELDS}
+        self._ts = array("d")
+
+    def __len__(self) -> int:
+        return len(self._slots)
+
+    def put(self, key, lat: float, lng: float, heading_deg=None, speed_mph=None, accuracy_m=None,
+            updated_at_utc: Optional[datetime] = None) -> bool:
+        """Store a position unless a newer one is already held. Returns whether it was applied."""
+        key = str(key)
+        ts = _epoch(updated_at_utc)
+        values = (float(lat), float(lng), _num(heading_deg), _num(speed_mph), _num(accuracy_m))
+        with self._lock:
+            slot = self._slots.get(key)
+            if slot is None:
+                if self._free:
+                    slot = self._free.pop()
+                    self._ids[slot] = key
+                else:
+                    slot = len(self._ids)
+                    self._ids.append(key)
+                    for col in self._cols.values():
+                        col.append(nan)
+                    self._ts.append(nan)
+                self._slots[key] = slot
+            elif self._ts[slot] > ts:
+                return False  # out of order; keep the newer fix
+            for f, v in zip(_FIELDS, values):
+                self._cols[f][slot] = v
+            self._ts[slot] = ts
+            return True
+
+    def get(self, key) -> Optional[dict]:
+        with self._lock:
+            slot = self._slots.get(str(key))
+            return None if slot is None else self._row(slot)
+
+    def get_many(self, keys: Iterable) -> dict[str, dict]:
+        with self._lock:
+            out = {}
+            for key in keys:
+                slot = self._slots.get(str(key))
+                if slot is not None:
+                    out[str(key)] = self._row(slot)
+            return out
+
+    def updated_since(self, cutoff: Optional[datetime]) -> dict[str, dict]:
+        """Positions updated after cutoff (all if None), keyed by id."""
+        with self._lock:
+            slots = self._slots_after(_epoch(cutoff) if cutoff else None)
+            return {self._ids[s]: self._row(s) for s in slots}
+
+    def remove(self, key):
+        with self._lock:
+            slot = self._slots.pop(str(key), None)
+            if slot is not None:
+                self._ids[slot] = None
+                self._ts[slot] = nan
+                self._free.append(slot)
+
+    def prune(self, max_age_seconds: float) -> int:
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            fresh = set(self._slots_after(cutoff))
+            stale = [k for k, s in self._slots.items() if s not in fresh]
+        for key in stale:
+            self.remove(key)
+        return len(stale)
+
+    def _slots_after(self, cutoff: Optional[float]) -> list[int]:
+        # Caller holds self._lock
+        if cutoff is None:
+            return list(self._slots.values())
+        if NUMPY_AVAILABLE and len(self._ts) >= 64:
+            ts = np.frombuffer(self._ts, dtype=np.float64)
+            slots = np.flatnonzero(ts > cutoff).tolist()  # NaN (free / unknown) compares False
+            del ts  # release the buffer export so the array can grow again
+            return slots
+        return [s for s, t in enumerate(self._ts) if t > cutoff]
+
+    def _row(self, slot: int) -> dict:
+        row = {f: _opt(self._cols[f][slot]) for f in _FIELDS}
+        row["updated_at_utc"] = _naive_utc(self._ts[slot])
+        return row
+
+    def nbytes(self) -> int:
+        return sum(c.itemsize * len(c) for c in self._cols.values()) + self._ts.itemsize * len(self._ts)
+
+
+class LiveLocationStore:
+    def __init__(self):
+        self.drivers = PositionTable()
+        self.riders = PositionTable()  # keyed by ride_id
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._bus_token: Optional[int] = None
+        self._drivers_since: Optional[datetime] = None
+        self._riders_since: Optional[datetime] = None
+        self._riders_available = True
+        self._last_reload = 0.0
+        self.loaded = False
+        self.syncs = 0
+        self.reloads = 0
+        self.rows_pulled = 0
+        self.bus_updates = 0
+        self.errors = 0
+        self.last_sync_ms: Optional[float] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def ready(self) -> bool:
+        """True when reads can be served from memory."""
+        return self.loaded and bool(self._thread and self._thread.is_alive())
+
+    # ---- writes ----
+    def put_driver(self, driver_id, lat: float, lng: float, heading_deg=None, speed_mph=None,
+                   accuracy_m=None, updated_at_utc: Optional[datetime] = None) -> bool:
+        return self.drivers.put(driver_id, lat, lng, heading_deg, speed_mph, accuracy_m, updated_at_utc)
+
+    def put_rider(self, ride_id, lat: float, lng: float, accuracy_m=None,
+                  updated_at_utc: Optional[datetime] = None) -> bool:
+        return self.riders.put(ride_id, lat, lng, None, None, accuracy_m, updated_at_utc)
+
+    def _on_location(self, event: dict):
+        try:
+            updated = datetime.fromisoformat(event["updated_at_utc"]) if event.get("updated_at_utc") else None
+            self.put_driver(
+                event["driver_id"], event["lat"], event["lng"],
+                event.get("heading_deg"), event.get("speed_mph"), event.get("accuracy_m"), updated,
+            )
+            self.bus_updates += 1
+        except (KeyError, TypeError, ValueError):
+            pass
+
+    # ---- Postgres ----
+    def sync(self, full: bool = False) -> int:
+        """Pull positions written by anyone (this or other workers) since the last pull."""
+        started = time.perf_counter()
+        pulled = 0
+        with pooled_conn() as conn:
+            with conn.cursor() as cur:
+                since = None if full or self._drivers_since is None else self._drivers_since
+                cur.execute(
+                    """
+                    SELECT driver_id, lat, lng, heading_deg, speed_mph, accuracy_m, updated_at_utc
+                    FROM driver_locations
+                    """ + ("" if since is None else "WHERE updated_at_utc > %s"),
+                    () if since is None else (since,),
+                )
+                rows = cur.fetchall()
+                for r in rows:
+                    self.drivers.put(*r)
+                self._drivers_since = self._advance(self._drivers_since, rows, 6)
+                driver_index.feed([(r[0], r[1], r[2], r[6]) for r in rows])
+                pulled += len(rows)
+
+                if self._riders_available:
+                    since = None if full or self._riders_since is None else self._riders_since
+                    try:
+                        cur.execute(
+                            """
+                            SELECT ride_id, lat, lng, accuracy_m, updated_at_utc
+                            FROM rider_locations
+                            WHERE updated_at_utc > %s
+                            """,
+                            (since or datetime.now(timezone.utc).replace(tzinfo=None)
+                             - timedelta(seconds=LOCATION_STORE_RIDER_MAX_AGE_SECONDS),),
+                        )
+                        rows = cur.fetchall()
+                    except UndefinedTable:
+                        conn.rollback()
+                        self._riders_available = False
+                        rows = []
+                        print("Warning: rider_locations table missing; rider positions not cached. Run migrations/008_rider_locations.sql")
+                    for r in rows:
+                        self.riders.put(r[0], r[1], r[2], None, None, r[3], r[4])
+                    self._riders_since = self._advance(self._riders_since, rows, 4)
+                    pulled += len(rows)
+
+        if full:
+            self.riders.prune(LOCATION_STORE_RIDER_MAX_AGE_SECONDS)
+            self._last_reload = time.monotonic()
+            self.reloads += 1
+        self.syncs += 1
+        self.rows_pulled += pulled
+        self.last_sync_ms = round((time.perf_counter() - started) * 1000, 2)
+        return pulled
+
+    @staticmethod
+    def _advance(since: Optional[datetime], rows: list, ts_index: int) -> Optional[datetime]:
+        # Next pull starts a little before the newest row seen: a write stamped earlier can
+        # commit later (buffered flushes, slow transactions); re-reading a few rows is harmless.
+        newest = max((r[ts_index] for r in rows if r[ts_index] is not None), default=None)
+        if newest is None:
+            return since
+        candidate = newest - timedelta(seconds=LOCATION_STORE_SYNC_OVERLAP_SECONDS)
+        return candidate if since is None or candidate > since else since
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                full = not self.loaded or time.monotonic() - self._last_reload >= LOCATION_STORE_RELOAD_SECONDS
+                self.sync(full=full)
+                if not self.loaded:
+                    self.loaded = True
+                    print(f"Info: Location store loaded ({len(self.drivers)} drivers, {len(self.riders)} riders)")
+                self.last_error = None
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"Warning: Location store sync failed: {e}")
+            self._stop.wait(LOCATION_STORE_SYNC_SECONDS)
+
+    def start(self):
+        """Start loading + syncing (no-op if disabled, already running, or DATABASE_URL is unset)."""
+        if not LOCATION_STORE_ENABLED or (self._thread and self._thread.is_alive()):
+            return
+        if not os.getenv("DATABASE_URL"):
+            return
+        if self._bus_token is None:
+            self._bus_token = location_bus.subscribe(self._on_location, types=("driver.location",))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="location-store", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._bus_token is not None:
+            location_bus.unsubscribe(self._bus_token)
+            self._bus_token = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": LOCATION_STORE_ENABLED,
+            "ready": self.ready,
+            "drivers": len(self.drivers),
+            "riders": len(self.riders),
+            "array_bytes": self.drivers.nbytes() + self.riders.nbytes(),
+            "syncs": self.syncs,
+            "reloads": self.reloads,
+            "rows_pulled": self.rows_pulled,
+            "bus_updates": self.bus_updates,
+            "errors": self.errors,
+            "last_sync_ms": self.last_sync_ms,
+            "drivers_synced_until_utc": self._drivers_since.isoformat() if self._drivers_since else None,
+            "last_error": self.last_error,
+        }
+
+
+location_store = LiveLocationStore()
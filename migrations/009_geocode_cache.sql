@@ -0,0 +1,14 @@
+-- Migration: Add geocode_cache table
+-- Description: Persistent tier of the geocode cache (geo_cache.py). Keyed by normalized address.
+-- found = false rows are negative entries (provider returned no result) with a short expiry.
+
+CREATE TABLE IF NOT EXISTS geocode_cache (
+    address_key TEXT PRIMARY KEY,
+    lat DOUBLE PRECISION,
+    lng DOUBLE PRECISION,
+    found BOOLEAN NOT NULL,
+    created_at_utc TIMESTAMP NOT NULL,
+    expires_at_utc TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_geocode_cache_expires ON geocode_cache(expires_at_utc);
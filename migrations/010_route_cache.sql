@@ -0,0 +1,17 @@
+-- Migration: Add route_cache table
+-- Description: Persistent tier of the route (Directions) cache (geo_cache.py).
+-- Keyed by normalized pickup/dropoff and an optional time-of-day bucket (0 when bucketing is off).
+
+CREATE TABLE IF NOT EXISTS route_cache (
+    origin_key TEXT NOT NULL,
+    destination_key TEXT NOT NULL,
+    time_bucket INTEGER NOT NULL DEFAULT 0,
+    distance_miles DOUBLE PRECISION NOT NULL,
+    duration_min DOUBLE PRECISION NOT NULL,
+    provider VARCHAR(50) NOT NULL, -- 'google_directions', 'nominatim_haversine'
+    created_at_utc TIMESTAMP NOT NULL,
+    expires_at_utc TIMESTAMP NOT NULL,
+    PRIMARY KEY (origin_key, destination_key, time_bucket)
+);
+
+CREATE INDEX IF NOT EXISTS idx_route_cache_expires ON route_cache(expires_at_utc);
@@ -0,0 +1,11 @@
+-- Migration: Partial index for "does this driver have an active ride?"
+-- Description: Backs the anti-join in auto-assign (and the active-ride checks on driver endpoints)
+-- so it only touches the small set of in-flight rides instead of every ride a driver ever had.
+
+CREATE INDEX IF NOT EXISTS idx_rides_active_driver
+    ON rides(assigned_driver_id)
+    WHERE status IN ('assigned', 'enroute', 'arrived', 'in_progress');
+
+CREATE INDEX IF NOT EXISTS idx_rides_requested_created
+    ON rides(created_at_utc)
+    WHERE status = 'requested';
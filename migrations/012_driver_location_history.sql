@@ -0,0 +1,18 @@
+-- Migration: Add driver_location_history table
+-- Description: Full GPS trail per driver (latest position stays in driver_locations).
+-- Written by PUT /driver/location and the batched POST /driver/location/batch.
+-- (driver_id, recorded_at_utc) is the primary key so re-uploaded backlog is ignored, not duplicated.
+
+CREATE TABLE IF NOT EXISTS driver_location_history (
+    driver_id UUID NOT NULL REFERENCES drivers(id) ON DELETE CASCADE,
+    recorded_at_utc TIMESTAMP NOT NULL,
+    lat DOUBLE PRECISION NOT NULL,
+    lng DOUBLE PRECISION NOT NULL,
+    heading_deg DOUBLE PRECISION,
+    speed_mph DOUBLE PRECISION,
+    accuracy_m DOUBLE PRECISION,
+    received_at_utc TIMESTAMP NOT NULL,
+    PRIMARY KEY (driver_id, recorded_at_utc)
+);
+
+CREATE INDEX IF NOT EXISTS idx_driver_location_history_recorded ON driver_location_history(recorded_at_utc);
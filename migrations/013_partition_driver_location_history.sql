@@ -0,0 +1,64 @@
+-- Migration: Partition driver_location_history by day
+-- Description: Recreates the GPS trail table from 012 as RANGE-partitioned on recorded_at_utc,
+-- one partition per UTC day (driver_location_history_YYYYMMDD). Retention then drops whole
+-- partitions instead of DELETE + vacuum, and a driver/ride range read only touches its days.
+-- Partitions are created ahead of time by the API (location_history.HistoryMaintainer); ingest
+-- does no DDL and holds rows for a missing day until the maintainer has created it. Rows from the
+-- 012 table are copied over and the old table is dropped.
+-- Safe to re-run.
+
+DO $$
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = 'driver_location_history' AND n.nspname = current_schema() AND c.relkind = 'r'
+    ) THEN
+        ALTER TABLE driver_location_history RENAME TO driver_location_history_012;
+        ALTER TABLE driver_location_history_012 RENAME CONSTRAINT driver_location_history_pkey TO driver_location_history_012_pkey;
+        ALTER INDEX IF EXISTS idx_driver_location_history_recorded RENAME TO idx_driver_location_history_012_recorded;
+    END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS driver_location_history (
+    driver_id UUID NOT NULL REFERENCES drivers(id) ON DELETE CASCADE,
+    recorded_at_utc TIMESTAMP NOT NULL,
+    lat DOUBLE PRECISION NOT NULL,
+    lng DOUBLE PRECISION NOT NULL,
+    heading_deg DOUBLE PRECISION,
+    speed_mph DOUBLE PRECISION,
+    accuracy_m DOUBLE PRECISION,
+    received_at_utc TIMESTAMP NOT NULL,
+    PRIMARY KEY (driver_id, recorded_at_utc)
+) PARTITION BY RANGE (recorded_at_utc);
+
+-- Today and tomorrow (so writes work before the API's maintainer first runs), plus every day
+-- that has rows in the 012 table
+DO $$
+DECLARE
+    today DATE := (now() AT TIME ZONE 'utc')::date;
+    days DATE[] := ARRAY[today, today + 1];
+    old_days DATE[];
+    d DATE;
+BEGIN
+    IF to_regclass('driver_location_history_012') IS NOT NULL THEN
+        EXECUTE 'SELECT array_agg(DISTINCT recorded_at_utc::date) FROM driver_location_history_012' INTO old_days;
+        days := days || coalesce(old_days, '{}');
+    END IF;
+    FOREACH d IN ARRAY days LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF driver_location_history FOR VALUES FROM (%L) TO (%L)',
+            'driver_location_history_' || to_char(d, 'YYYYMMDD'), d, d + 1
+        );
+    END LOOP;
+END $$;
+
+DO $$
+BEGIN
+    IF to_regclass('driver_location_history_012') IS NOT NULL THEN
+        INSERT INTO driver_location_history
+        SELECT driver_id, recorded_at_utc, lat, lng, heading_deg, speed_mph, accuracy_m, received_at_utc
+        FROM driver_location_history_012
+        ON CONFLICT DO NOTHING;
+        DROP TABLE driver_location_history_012;
+    END IF;
+END $$;
@@ -0,0 +1,11 @@
+-- Migration: Actual trip distance + final fare on rides
+-- Description: Filled when the driver marks a ride completed (fare.finalize_ride_fare):
+-- distance driven per the GPS trail (migrations 012/013), trip duration, and the fare priced on it.
+-- fare_source is 'trail' or 'estimate' (trail too sparse; quoted distance used).
+
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS actual_distance_miles NUMERIC;
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS actual_duration_min NUMERIC;
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS actual_trail_points INTEGER;
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS final_fare_usd NUMERIC;
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS fare_source TEXT;
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS fare_finalized_at_utc TIMESTAMP;
@@ -0,0 +1,21 @@
+-- Migration: Notification outbox
+-- Description: Ride write paths insert one outbox row per event (ride_booked, ride_assigned,
+-- ride_status) in the same transaction as the ride change. A background dispatcher
+-- (notification_outbox.py) claims due rows with SKIP LOCKED, writes the notifications in batches
+-- and deletes the rows; failures are retried with exponential backoff (next_attempt_at_utc) and
+-- parked with dead_at_utc after the last attempt. The table only holds undelivered events.
+
+CREATE TABLE IF NOT EXISTS notification_outbox (
+    id BIGSERIAL PRIMARY KEY,
+    kind VARCHAR(50) NOT NULL,
+    ride_id UUID,
+    payload_json JSONB NOT NULL,
+    created_at_utc TIMESTAMP NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at_utc TIMESTAMP NOT NULL,
+    last_error TEXT,
+    dead_at_utc TIMESTAMP
+);
+
+-- Due rows, oldest first (the dispatcher's claim query)
+CREATE INDEX IF NOT EXISTS idx_notification_outbox_due ON notification_outbox(next_attempt_at_utc) WHERE dead_at_utc IS NULL;
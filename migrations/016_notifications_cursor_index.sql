@@ -0,0 +1,6 @@
+-- Migration: Notifications cursor index
+-- Description: Incremental reads (GET /api/v1/notifications?after=<cursor>, see notification_feed.py)
+-- page a recipient's notifications in (created_at_utc, id) order from a cursor; this index serves
+-- them as a range scan.
+
+CREATE INDEX IF NOT EXISTS idx_notifications_recipient_cursor ON notifications(recipient_type, recipient_id, created_at_utc, id);
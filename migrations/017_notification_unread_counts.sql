@@ -0,0 +1,39 @@
+-- Migration: Notification unread counters
+-- Description: One row per recipient holding its number of unread notifications (status != 'read'),
+-- kept in step by the application (notification_counts.py): +n when notifications are written, -n
+-- in the same statement that marks them read. GET /api/v1/notifications/unread-count reads one row
+-- instead of counting. Broadcast notifications (recipient_id NULL, e.g. admin) use the nil UUID as
+-- recipient_key.
+
+CREATE TABLE IF NOT EXISTS notification_unread_counts (
+    recipient_type VARCHAR(20) NOT NULL,
+    recipient_key UUID NOT NULL,
+    unread_count INTEGER NOT NULL DEFAULT 0,
+    updated_at_utc TIMESTAMP NOT NULL,
+    PRIMARY KEY (recipient_type, recipient_key)
+);
+
+-- Backfill from existing notifications. Re-running this file recomputes every counter (e.g. after
+-- notifications were written by an app version that didn't count them); writes that race the
+-- recount can leave a counter off by those rows until the next recount.
+INSERT INTO notification_unread_counts (recipient_type, recipient_key, unread_count, updated_at_utc)
+SELECT recipient_type,
+       COALESCE(recipient_id, '00000000-0000-0000-0000-000000000000'::uuid),
+       count(*),
+       (now() AT TIME ZONE 'utc')
+FROM notifications
+WHERE status != 'read'
+GROUP BY 1, 2
+ON CONFLICT (recipient_type, recipient_key) DO UPDATE
+SET unread_count = EXCLUDED.unread_count,
+    updated_at_utc = EXCLUDED.updated_at_utc;
+
+UPDATE notification_unread_counts c
+SET unread_count = 0, updated_at_utc = (now() AT TIME ZONE 'utc')
+WHERE c.unread_count != 0
+  AND NOT EXISTS (
+      SELECT 1 FROM notifications n
+      WHERE n.status != 'read'
+        AND n.recipient_type = c.recipient_type
+        AND COALESCE(n.recipient_id, '00000000-0000-0000-0000-000000000000'::uuid) = c.recipient_key
+  );
@@ -0,0 +1,119 @@
+-- Migration: Partition notifications by month + archive
+-- Description: Recreates notifications (005) as RANGE-partitioned on created_at_utc, one partition
+-- per UTC month (notifications_YYYYMM) plus notifications_default, which only catches rows for a
+-- month whose partition wasn't created yet. notification_retention.py (started by the API) creates
+-- months ahead, moves read notifications older than the hot window (and anything past the max age)
+-- to notifications_archive in small batches, and drops old monthly partitions once they are empty,
+-- so the live table only holds recent months.
+--
+-- The partitioned table keeps the indexes the API reads use (recipient cursor/list, unread per
+-- recipient, ride, created_at) and drops the single-column recipient_type / recipient_id / status /
+-- driver_id indexes and the older unread index. The primary key becomes (id, created_at_utc)
+-- because the partition key has to be part of it. Rows from the 005 table are copied over and the
+-- old table is dropped. Safe to re-run.
+
+DO $$
+DECLARE
+    idx RECORD;
+BEGIN
+    IF EXISTS (
+        SELECT 1 FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE c.relname = 'notifications' AND n.nspname = current_schema() AND c.relkind = 'r'
+    ) THEN
+        ALTER TABLE notifications RENAME TO notifications_005;
+        ALTER TABLE notifications_005 RENAME CONSTRAINT notifications_pkey TO notifications_005_pkey;
+        -- Free the index names for the partitioned table (the old ones go with the table below)
+        FOR idx IN
+            SELECT indexname FROM pg_indexes
+            WHERE schemaname = current_schema() AND tablename = 'notifications_005' AND indexname LIKE 'idx_notifications_%'
+        LOOP
+            EXECUTE format('ALTER INDEX %I RENAME TO %I', idx.indexname, left(idx.indexname, 55) || '_005');
+        END LOOP;
+    END IF;
+END $$;
+
+CREATE TABLE IF NOT EXISTS notifications (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    ride_id UUID REFERENCES rides(id) ON DELETE CASCADE,
+    driver_id UUID REFERENCES drivers(id) ON DELETE SET NULL,
+    recipient_type VARCHAR(20) NOT NULL CHECK (recipient_type IN ('rider', 'driver', 'admin')),
+    recipient_id UUID, -- rider_id (from rides), driver_id, or NULL for admin (broadcast)
+    notification_type VARCHAR(50) NOT NULL,
+    title VARCHAR(255) NOT NULL,
+    message TEXT NOT NULL,
+    channel VARCHAR(20) NOT NULL DEFAULT 'in_app' CHECK (channel IN ('in_app', 'sms', 'email', 'push')),
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed', 'read')),
+    metadata_json JSONB DEFAULT '{}',
+    created_at_utc TIMESTAMP WITHOUT TIME ZONE NOT NULL DEFAULT NOW(),
+    sent_at_utc TIMESTAMP WITHOUT TIME ZONE,
+    read_at_utc TIMESTAMP WITHOUT TIME ZONE,
+    error_message TEXT,
+    PRIMARY KEY (id, created_at_utc)
+) PARTITION BY RANGE (created_at_utc);
+
+CREATE INDEX IF NOT EXISTS idx_notifications_recipient_cursor ON notifications(recipient_type, recipient_id, created_at_utc, id);
+CREATE INDEX IF NOT EXISTS idx_notifications_recipient_unread ON notifications(recipient_type, recipient_id, created_at_utc DESC) WHERE status != 'read';
+CREATE INDEX IF NOT EXISTS idx_notifications_ride_id ON notifications(ride_id);
+CREATE INDEX IF NOT EXISTS idx_notifications_created_at ON notifications(created_at_utc);
+
+-- This month and the next two (so writes work before the API's retention job first runs), every
+-- month that has rows in the 005 table, and the default partition
+DO $$
+DECLARE
+    this_month DATE := date_trunc('month', now() AT TIME ZONE 'utc')::date;
+    months DATE[] := ARRAY[this_month, (this_month + interval '1 month')::date, (this_month + interval '2 months')::date];
+    old_months DATE[];
+    m DATE;
+BEGIN
+    IF to_regclass('notifications_005') IS NOT NULL THEN
+        EXECUTE 'SELECT array_agg(DISTINCT date_trunc(''month'', created_at_utc)::date) FROM notifications_005' INTO old_months;
+        months := months || coalesce(old_months, '{}');
+    END IF;
+    FOREACH m IN ARRAY months LOOP
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF notifications FOR VALUES FROM (%L) TO (%L)',
+            'notifications_' || to_char(m, 'YYYYMM'), m, (m + interval '1 month')::date
+        );
+    END LOOP;
+END $$;
+
+CREATE TABLE IF NOT EXISTS notifications_default PARTITION OF notifications DEFAULT;
+
+DO $$
+BEGIN
+    IF to_regclass('notifications_005') IS NOT NULL THEN
+        INSERT INTO notifications (
+            id, ride_id, driver_id, recipient_type, recipient_id, notification_type, title, message,
+            channel, status, metadata_json, created_at_utc, sent_at_utc, read_at_utc, error_message
+        )
+        SELECT id, ride_id, driver_id, recipient_type, recipient_id, notification_type, title, message,
+               channel, status, metadata_json, created_at_utc, sent_at_utc, read_at_utc, error_message
+        FROM notifications_005
+        ON CONFLICT DO NOTHING;
+        DROP TABLE notifications_005;
+    END IF;
+END $$;
+
+-- Read/aged-out notifications moved out of the live table. No foreign keys: archived rows outlive
+-- their ride and driver.
+CREATE TABLE IF NOT EXISTS notifications_archive (
+    id UUID PRIMARY KEY,
+    ride_id UUID,
+    driver_id UUID,
+    recipient_type VARCHAR(20) NOT NULL,
+    recipient_id UUID,
+    notification_type VARCHAR(50) NOT NULL,
+    title VARCHAR(255) NOT NULL,
+    message TEXT NOT NULL,
+    channel VARCHAR(20) NOT NULL,
+    status VARCHAR(20) NOT NULL,
+    metadata_json JSONB,
+    created_at_utc TIMESTAMP NOT NULL,
+    sent_at_utc TIMESTAMP,
+    read_at_utc TIMESTAMP,
+    error_message TEXT,
+    archived_at_utc TIMESTAMP NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_notifications_archive_recipient ON notifications_archive(recipient_type, recipient_id, created_at_utc);
+CREATE INDEX IF NOT EXISTS idx_notifications_archive_created_at ON notifications_archive(created_at_utc);
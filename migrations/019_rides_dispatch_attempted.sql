@@ -0,0 +1,11 @@
+-- Migration: Last batch-dispatch attempt on rides
+-- Description: batch_dispatch.py stamps dispatch_attempted_at_utc on rides it claimed but could not
+-- assign (no free driver in reach). The next batches skip them for GLOBAPP_BATCH_DISPATCH_RETRY_SECONDS
+-- and then take never-tried rides first, so a few unassignable old rides can't be reclaimed on every
+-- tick and starve newer ones. Safe to re-run.
+
+ALTER TABLE rides ADD COLUMN IF NOT EXISTS dispatch_attempted_at_utc TIMESTAMP;
+
+CREATE INDEX IF NOT EXISTS idx_rides_requested_dispatch
+    ON rides(dispatch_attempted_at_utc NULLS FIRST, created_at_utc)
+    WHERE status = 'requested';
@@ -0,0 +1,32 @@
+-- Migration: Drop the notifications default partition
+-- Description: notification_retention.py drops old month partitions with
+-- ALTER TABLE ... DETACH PARTITION ... CONCURRENTLY (PostgreSQL 14+), which doesn't block reads and
+-- writes on notifications but is refused while the table has a default partition. Rows in
+-- notifications_default (018) get a partition for their month and are moved there, then the default
+-- partition is dropped. From here on a notification for a month without a partition fails to insert
+-- (outbox events are retried); the retention job keeps GLOBAPP_NOTIFICATIONS_PRECREATE_MONTHS ahead.
+-- Safe to re-run.
+
+DO $$
+DECLARE
+    m DATE;
+BEGIN
+    IF to_regclass('notifications_default') IS NOT NULL THEN
+        ALTER TABLE notifications DETACH PARTITION notifications_default;
+        FOR m IN SELECT DISTINCT date_trunc('month', created_at_utc)::date FROM notifications_default LOOP
+            EXECUTE format(
+                'CREATE TABLE IF NOT EXISTS %I PARTITION OF notifications FOR VALUES FROM (%L) TO (%L)',
+                'notifications_' || to_char(m, 'YYYYMM'), m, (m + interval '1 month')::date
+            );
+        END LOOP;
+        INSERT INTO notifications (
+            id, ride_id, driver_id, recipient_type, recipient_id, notification_type, title, message,
+            channel, status, metadata_json, created_at_utc, sent_at_utc, read_at_utc, error_message
+        )
+        SELECT id, ride_id, driver_id, recipient_type, recipient_id, notification_type, title, message,
+               channel, status, metadata_json, created_at_utc, sent_at_utc, read_at_utc, error_message
+        FROM notifications_default
+        ON CONFLICT DO NOTHING;
+        DROP TABLE notifications_default;
+    END IF;
+END $$;
@@ -0,0 +1,182 @@
+"""
+Per-recipient unread notification counters for GlobApp
+notification_unread_counts (migration 017) holds one row per recipient, so a badge refresh
+(GET /api/v1/notifications/unread-count) is a primary-key read instead of fetching and counting
+notifications. Counters move with the writes that change them:
+    add_unread()     +n per recipient, on the transaction that inserts the notifications
+                     (notifications.insert_notifications)
+    mark_read()      one notification, -1 if it was unread, in the same statement as the UPDATE
+    mark_all_read()  every unread notification of a recipient up to a cursor, -n, one statement
+Broadcast notifications (recipient_id NULL, e.g. admin) are counted under the nil UUID.
+
+Until migration 017 has run, counts fall back to COUNT(*) over the unread index.
+"""
+
+import time
+from datetime import datetime
+from typing import Iterable, Optional
+from uuid import UUID
+
+
+_TABLE_RECHECK_SECONDS = 60
+_BROADCAST_KEY = "00000000-0000-0000-0000-000000000000"
+
+_table_ready: Optional[bool] = None
+_table_checked_at = 0.0
+
+
+def unread_counts_available(cur) -> bool:
+    """Whether migration 017 has run (cached; a missing table is re-checked every minute)."""
+    global _table_ready, _table_checked_at
+    if _table_ready or (_table_ready is False and time.monotonic() - _table_checked_at < _TABLE_RECHECK_SECONDS):
+        return _table_ready
+    cur.execute("SELECT to_regclass('notification_unread_counts') IS NOT NULL")
+    _table_ready = bool(cur.fetchone()[0])
+    _table_checked_at = time.monotonic()
+    if not _table_ready:
+        print("Warning: notification_unread_counts table missing; unread counts computed per request. Run migrations/017_notification_unread_counts.sql")
+    return _table_ready
+
+
+def _recipient_key(recipient_id) -> str:
+    return str(recipient_id) if recipient_id else _BROADCAST_KEY
+
+
+def _recipient_filter(recipient_id) -> tuple[str, tuple]:
+    if recipient_id:
+        return "recipient_id = %s", (str(recipient_id),)
+    return "recipient_id IS NULL", ()
+
+
+def add_unread(cur, recipients: Iterable[tuple], now_utc: datetime):
+    """Count newly written unread notifications, given their (recipient_type, recipient_id)."""
+    counts: dict[tuple, int] = {}
+    for recipient_type, recipient_id in recipients:
+        key = (recipient_type, _recipient_key(recipient_id))
+        counts[key] = counts.get(key, 0) + 1
+    if not counts or not unread_counts_available(cur):
+        return
+    # Sorted so concurrent writers lock shared counters (e.g. admin) in the same order
+    keys = sorted(counts)
+    cur.execute(
+        """
+        INSERT INTO notification_unread_counts (recipient_type, recipient_key, unread_count, updated_at_utc)
+        SELECT t, k, n, %s
+        FROM unnest(%s::text[], %s::uuid[], %s::int[]) AS u(t, k, n)
+        ORDER BY t, k
+        ON CONFLICT (recipient_type, recipient_key) DO UPDATE
+        SET unread_count = notification_unread_counts.unread_count + EXCLUDED.unread_count,
+            updated_at_utc = EXCLUDED.updated_at_utc
+        """,
+        (now_utc, [k[0] for k in keys], [k[1] for k in keys], [counts[k] for k in keys]),
+    )
+
+
+def unread_count(cur, recipient_type: str, recipient_id=None) -> int:
+    if unread_counts_available(cur):
+        cur.execute(
+            "SELECT unread_count FROM notification_unread_counts WHERE recipient_type = %s AND recipient_key = %s",
+            (recipient_type, _recipient_key(recipient_id)),
+        )
+        row = cur.fetchone()
+        return max(int(row[0]), 0) if row else 0
+    recipient_sql, recipient_params = _recipient_filter(recipient_id)
+    cur.execute(
+        f"SELECT count(*) FROM notifications WHERE recipient_type = %s AND {recipient_sql} AND status != 'read'",
+        (recipient_type, *recipient_params),
+    )
+    return int(cur.fetchone()[0])
+
+
+def mark_read(cur, notification_id: UUID, now_utc: datetime) -> bool:
+    """Mark one notification read (read_at_utc is refreshed if it already was). False if not found."""
+    if not unread_counts_available(cur):
+        cur.execute(
+            """
+            UPDATE notifications
+            SET status = 'read',
+                read_at_utc = %s
+            WHERE id = %s
+            """,
+            (now_utc, str(notification_id)),
+        )
+        return cur.rowcount > 0
+    cur.execute(
+        """
+        WITH prev AS (
+            SELECT id, status FROM notifications WHERE id = %s FOR UPDATE
+        ), marked AS (
+            UPDATE notifications n
+            SET status = 'read',
+                read_at_utc = %s
+            FROM prev
+            WHERE n.id = prev.id
+            RETURNING n.recipient_type, n.recipient_id, prev.status AS previous_status
+        ), counted AS (
+            UPDATE notification_unread_counts c
+            SET unread_count = GREATEST(c.unread_count - 1, 0),
+                updated_at_utc = %s
+            FROM marked
+            WHERE marked.previous_status != 'read'
+              AND c.recipient_type = marked.recipient_type
+              AND c.recipient_key = COALESCE(marked.recipient_id, %s::uuid)
+        )
+        SELECT count(*) FROM marked
+        """,
+        (str(notification_id), now_utc, now_utc, _BROADCAST_KEY),
+    )
+    return cur.fetchone()[0] > 0
+
+
+def mark_all_read(
+    cur,
+    recipient_type: str,
+    recipient_id,
+    now_utc: datetime,
+    up_to: Optional[tuple] = None,
+    up_to_id: Optional[UUID] = None,
+) -> tuple[int, int]:
+    """
+    Mark a recipient's unread notifications read, optionally only those at or before up_to
+    ((created_at_utc, id), see notification_feed.decode_cursor) or notification up_to_id.
+    Returns (marked, unread_count after).
+    """
+    recipient_sql, recipient_params = _recipient_filter(recipient_id)
+    where_sql = f"recipient_type = %s AND {recipient_sql} AND status != 'read'"
+    where_params = [recipient_type, *recipient_params]
+    if up_to is not None:
+        where_sql += " AND (created_at_utc, id) <= (%s, %s)"
+        where_params.extend([up_to[0], str(up_to[1])])
+    if up_to_id is not None:
+        where_sql += " AND (created_at_utc, id) <= (SELECT created_at_utc, id FROM notifications WHERE id = %s)"
+        where_params.append(str(up_to_id))
+
+    if not unread_counts_available(cur):
+        cur.execute(
+            f"UPDATE notifications SET status = 'read', read_at_utc = %s WHERE {where_sql}",
+            (now_utc, *where_params),
+        )
+        marked = cur.rowcount
+        return marked, unread_count(cur, recipient_type, recipient_id)
+
+    cur.execute(
+        f"""
+        WITH marked AS (
+            UPDATE notifications
+            SET status = 'read',
+                read_at_utc = %s
+            WHERE {where_sql}
+            RETURNING 1
+        ), counted AS (
+            UPDATE notification_unread_counts
+            SET unread_count = GREATEST(unread_count - (SELECT count(*) FROM marked), 0),
+                updated_at_utc = %s
+            WHERE recipient_type = %s AND recipient_key = %s
+            RETURNING unread_count
+        )
+        SELECT (SELECT count(*) FROM marked), (SELECT unread_count FROM counted)
+        """,
+        (now_utc, *where_params, now_utc, recipient_type, _recipient_key(recipient_id)),
+    )
+    marked, unread = cur.fetchone()
+    return int(marked), int(unread or 0)
@@ -0,0 +1,177 @@
+"""
+Incremental notification reads for GlobApp (cursor + long-poll)
+GET /api/v1/notifications?after=<cursor> returns only notifications newer than the cursor,
+oldest first, ordered by (created_at_utc, id) (idx_notifications_recipient_cursor, migration 016),
+and hands out the next cursor in the X-Next-Cursor header. With wait=<seconds> the request
+parks until a notification for that recipient commits or the wait runs out.
+
+Parked requests cost no database work: they wait on an asyncio.Event, and notification_bus
+(Postgres NOTIFY sent by notifications.insert_notifications at commit) wakes the ones whose
+recipient got something. Without the listener, waits fall back to re-checking every
+NOTIFICATIONS_FALLBACK_POLL_SECONDS.
+
+Notifications are stamped before their transaction commits, so a reader could pass a row that
+commits a moment later with an earlier timestamp. Cursor reads therefore only return rows at
+least NOTIFICATIONS_CURSOR_SETTLE_MS old; a woken long-poll waits out that window before reading.
+"""
+
+import asyncio
+import base64
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Optional
+from uuid import UUID
+
+from event_bus import notification_bus
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+NOTIFICATIONS_LONGPOLL_MAX_SECONDS = float(_env("GLOBAPP_NOTIFICATIONS_LONGPOLL_MAX_SECONDS", "30"))
+NOTIFICATIONS_LONGPOLL_MAX_WAITERS = int(_env("GLOBAPP_NOTIFICATIONS_LONGPOLL_MAX_WAITERS", "10000"))
+NOTIFICATIONS_CURSOR_SETTLE_MS = int(_env("GLOBAPP_NOTIFICATIONS_CURSOR_SETTLE_MS", "500"))
+NOTIFICATIONS_FALLBACK_POLL_SECONDS = float(_env("GLOBAPP_NOTIFICATIONS_FALLBACK_POLL_SECONDS", "3"))
+
+_NIL_UUID = UUID(int=0)
+
+
+def encode_cursor(created_at_utc: datetime, notification_id) -> str:
+    raw = f"{created_at_utc.isoformat()}|{notification_id}".encode("ascii")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Optional[tuple[datetime, UUID]]:
+    """(created_at_utc, id) from encode_cursor(); None if malformed."""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("ascii")
+        ts, nid = raw.split("|", 1)
+        return datetime.fromisoformat(ts), UUID(nid)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def cursor_floor(created_at_utc: datetime) -> str:
+    """Cursor positioned before every notification stamped after created_at_utc."""
+    return encode_cursor(created_at_utc, _NIL_UUID)
+
+
+def recipient_key(recipient_type: str, recipient_id: Optional[str]) -> tuple[str, Optional[str]]:
+    return recipient_type, (str(recipient_id) if recipient_id else None)
+
+
+class _Waiter:
+    __slots__ = ("owner", "loop", "event")
+
+    def __init__(self, owner, loop: asyncio.AbstractEventLoop):
+        self.owner = owner
+        self.loop = loop
+        self.event = asyncio.Event()
+
+    def wake(self):
+        self.loop.call_soon_threadsafe(self.event.set)
+
+    async def wait(self, timeout: float) -> bool:
+        """Block until woken (True) or timeout passes (False)."""
+        try:
+            await asyncio.wait_for(self.event.wait(), timeout=max(timeout, 0.0))
+        except asyncio.TimeoutError:
+            self.owner.timeouts += 1
+            return False
+        self.event.clear()
+        self.owner.woken += 1
+        return True
+
+
+class NotificationWaiters:
+    """Long-polling requests, keyed by (recipient_type, recipient_id)."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_key: dict[tuple, set] = {}
+        self._count = 0
+        self._bus_token: Optional[int] = None
+        self.waits = 0
+        self.woken = 0
+        self.timeouts = 0
+        self.rejected = 0
+        self.events = 0
+
+    @property
+    def live(self) -> bool:
+        return self._bus_token is not None and notification_bus.listening
+
+    @property
+    def full(self) -> bool:
+        return self._count >= NOTIFICATIONS_LONGPOLL_MAX_WAITERS
+
+    def _on_notifications(self, event: dict):
+        self.events += 1
+        recipients = event.get("recipients")
+        with self._lock:
+            if recipients is None:
+                targets = [w for members in self._by_key.values() for w in members]
+            else:
+                targets = []
+                for recipient_type, recipient_id in recipients:
+                    targets.extend(self._by_key.get((recipient_type, recipient_id), ()))
+                    if recipient_id is not None:
+                        # Waiters on a whole recipient type (no recipient_id filter)
+                        targets.extend(self._by_key.get((recipient_type, None), ()))
+        for w in targets:
+            w.wake()
+
+    @contextmanager
+    def watch(self, key: tuple):
+        """
+        Register a waiter for key for the duration of the block. Register before the first read:
+        anything committed after that wakes the waiter, anything before is visible to the read.
+        """
+        w = _Waiter(self, asyncio.get_running_loop())
+        with self._lock:
+            self._by_key.setdefault(key, set()).add(w)
+            self._count += 1
+            self.waits += 1
+        try:
+            yield w
+        finally:
+            with self._lock:
+                members = self._by_key.get(key)
+                if members is not None:
+                    members.discard(w)
+                    if not members:
+                        del self._by_key[key]
+                self._count -= 1
+
+    def start(self):
+        """Subscribe to notification_bus (the caller starts the bus listener)."""
+        if self._bus_token is None:
+            self._bus_token = notification_bus.subscribe(self._on_notifications, types=("notifications.created",))
+
+    def stop(self):
+        if self._bus_token is not None:
+            notification_bus.unsubscribe(self._bus_token)
+            self._bus_token = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            waiting = self._count
+            keys = len(self._by_key)
+        return {
+            "live": self.live,
+            "waiting": waiting,
+            "recipients_waiting": keys,
+            "max_waiters": NOTIFICATIONS_LONGPOLL_MAX_WAITERS,
+            "waits": self.waits,
+            "woken": self.woken,
+            "timeouts": self.timeouts,
+            "rejected": self.rejected,
+            "bus_events": self.events,
+        }
+
+
+notification_waiters = NotificationWaiters()
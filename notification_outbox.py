@@ -0,0 +1,348 @@
+"""
+Transactional outbox for ride notifications
+Ride write paths call enqueue() on their own cursor: one small notification_outbox row per event
+(migration 015), committed or rolled back with the ride change, so a notification is never lost
+after a commit and never sent for a write that rolled back. The request does no rendering and
+writes no notification rows.
+
+OutboxDispatcher (one thread per API worker; any number of processes can run one) claims due rows
+with SELECT ... FOR UPDATE SKIP LOCKED, renders every event's recipients and writes them with one
+multi-row INSERT (notifications.insert_notifications), then deletes the claimed rows, all in one
+transaction. It wakes on ride events (event_bus: every enqueueing write also publishes one) or
+every NOTIFICATION_OUTBOX_POLL_SECONDS.
+
+Failures: if a batch insert fails, events are retried one by one (savepoints) so a bad event
+can't hold back the rest. A failed event is retried after BACKOFF_BASE * 2^(attempts - 1)
+seconds (capped at BACKOFF_MAX); after NOTIFICATION_OUTBOX_MAX_ATTEMPTS it is parked with
+dead_at_utc set (left in the table for inspection).
+
+Without the table (or with GLOBAPP_NOTIFICATION_OUTBOX_ENABLED=false) enqueue() writes the
+notifications directly on the caller's transaction, as before.
+"""
+
+import json
+import os
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone, timedelta
+from typing import Iterable, Optional
+
+from db import pooled_conn
+from event_bus import event_bus
+from notifications import (
+    create_notifications,
+    insert_notifications,
+    ride_assigned_notifications,
+    ride_booked_notifications,
+    ride_status_notifications,
+)
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+NOTIFICATION_OUTBOX_ENABLED = _env("GLOBAPP_NOTIFICATION_OUTBOX_ENABLED", "true").lower() == "true"
+NOTIFICATION_OUTBOX_BATCH_SIZE = int(_env("GLOBAPP_NOTIFICATION_OUTBOX_BATCH_SIZE", "500"))
+NOTIFICATION_OUTBOX_POLL_SECONDS = float(_env("GLOBAPP_NOTIFICATION_OUTBOX_POLL_SECONDS", "2"))
+NOTIFICATION_OUTBOX_MAX_ATTEMPTS = int(_env("GLOBAPP_NOTIFICATION_OUTBOX_MAX_ATTEMPTS", "8"))
+NOTIFICATION_OUTBOX_BACKOFF_BASE_SECONDS = float(_env("GLOBAPP_NOTIFICATION_OUTBOX_BACKOFF_BASE_SECONDS", "2"))
+NOTIFICATION_OUTBOX_BACKOFF_MAX_SECONDS = float(_env("GLOBAPP_NOTIFICATION_OUTBOX_BACKOFF_MAX_SECONDS", "300"))
+
+# kind -> builder taking the enqueued fields and returning notification rows
+_BUILDERS = {
+    "ride_booked": ride_booked_notifications,
+    "ride_assigned": ride_assigned_notifications,
+    "ride_status": ride_status_notifications,
+}
+
+_TABLE_RECHECK_SECONDS = 60
+_BACKLOG_REFRESH_SECONDS = 10
+_RATE_WINDOW_SECONDS = 60
+
+_table_ready: Optional[bool] = None
+_table_checked_at = 0.0
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def outbox_available(cur) -> bool:
+    """Whether migration 015 has run (cached; a missing table is re-checked every minute)."""
+    global _table_ready, _table_checked_at
+    if _table_ready or (_table_ready is False and time.monotonic() - _table_checked_at < _TABLE_RECHECK_SECONDS):
+        return _table_ready
+    cur.execute("SELECT to_regclass('notification_outbox') IS NOT NULL")
+    _table_ready = bool(cur.fetchone()[0])
+    _table_checked_at = time.monotonic()
+    if not _table_ready:
+        print("Warning: notification_outbox table missing; notifications written inline. Run migrations/015_notification_outbox.sql")
+    return _table_ready
+
+
+def enqueue(cur, kind: str, **fields):
+    """Queue one notification event on the caller's transaction (fields are the builder's arguments)."""
+    enqueue_many(cur, kind, [fields])
+
+
+def enqueue_many(cur, kind: str, items: Iterable[dict]):
+    """Queue several events of one kind with a single INSERT on the caller's transaction."""
+    if kind not in _BUILDERS:
+        raise ValueError(f"Unknown notification kind: {kind}")
+    items = list(items)
+    if not items:
+        return
+    if not (NOTIFICATION_OUTBOX_ENABLED and outbox_available(cur)):
+        rows = []
+        for fields in items:
+            rows.extend(_BUILDERS[kind](**fields))
+        create_notifications(rows, cur=cur)
+        notification_outbox.inline += len(items)
+        return
+    now_utc = _utcnow()
+    cur.execute(
+        """
+        INSERT INTO notification_outbox (kind, ride_id, payload_json, created_at_utc, next_attempt_at_utc)
+        SELECT %s, t.ride_id, t.payload, %s, %s
+        FROM unnest(%s::uuid[], %s::jsonb[]) AS t(ride_id, payload)
+        """,
+        (
+            kind,
+            now_utc,
+            now_utc,
+            [str(f["ride_id"]) if f.get("ride_id") else None for f in items],
+            [json.dumps(f, default=str) for f in items],
+        ),
+    )
+    notification_outbox.enqueued += len(items)
+
+
+def _backoff_seconds(attempts: int) -> float:
+    return min(NOTIFICATION_OUTBOX_BACKOFF_BASE_SECONDS * (2 ** max(attempts - 1, 0)), NOTIFICATION_OUTBOX_BACKOFF_MAX_SECONDS)
+
+
+class OutboxDispatcher:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._bus_token: Optional[int] = None
+        self._recent: deque = deque()  # (monotonic, events delivered) per batch, for the rate
+        self._backlog_at = 0.0
+        self.enqueued = 0      # by this process' requests
+        self.inline = 0        # written directly (outbox disabled or table missing)
+        self.batches = 0
+        self.delivered = 0     # events
+        self.notifications = 0
+        self.retried = 0
+        self.dead = 0
+        self.errors = 0
+        self.last_batch_ms: Optional[float] = None
+        self.last_lag_seconds: Optional[float] = None
+        self.max_lag_seconds = 0.0
+        self.backlog: Optional[int] = None
+        self.oldest_pending_seconds: Optional[float] = None
+        self.dead_total: Optional[int] = None
+        self.last_error: Optional[str] = None
+
+    @property
+    def running(self) -> bool:
+        return bool(self._thread and self._thread.is_alive())
+
+    # ---- draining ----
+    def drain_once(self, limit: int = NOTIFICATION_OUTBOX_BATCH_SIZE) -> int:
+        """Claim and deliver up to limit due events in one transaction. Returns events processed."""
+        started = time.perf_counter()
+        with pooled_conn() as conn:
+            with conn.cursor() as cur:
+                now_utc = _utcnow()
+                cur.execute(
+                    """
+                    SELECT id, kind, payload_json, attempts, created_at_utc
+                    FROM notification_outbox
+                    WHERE dead_at_utc IS NULL AND next_attempt_at_utc <= %s
+                    ORDER BY next_attempt_at_utc, id
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                    """,
+                    (now_utc, limit),
+                )
+                claimed = cur.fetchall()
+                if not claimed:
+                    conn.rollback()
+                    return 0
+
+                rendered = []  # (outbox id, rows)
+                failed = []    # (outbox id, attempts, error)
+                for outbox_id, kind, payload, attempts, _ in claimed:
+                    try:
+                        builder = _BUILDERS[kind]
+                        fields = payload if isinstance(payload, dict) else json.loads(payload)
+                        rendered.append((outbox_id, [r for r in builder(**fields) if r is not None]))
+                    except Exception as e:
+                        failed.append((outbox_id, attempts, f"render failed: {e}"))
+
+                done = []
+                try:
+                    with conn.transaction():
+                        insert_notifications(cur, [r for _, rows in rendered for r in rows])
+                    done = [outbox_id for outbox_id, _ in rendered]
+                except Exception:
+                    # Isolate the event(s) that fail so the rest of the batch still goes out
+                    attempts_by_id = {c[0]: c[3] for c in claimed}
+                    for outbox_id, rows in rendered:
+                        try:
+                            with conn.transaction():
+                                insert_notifications(cur, rows)
+                            done.append(outbox_id)
+                        except Exception as e:
+                            failed.append((outbox_id, attempts_by_id[outbox_id], str(e)))
+
+                if done:
+                    cur.execute("DELETE FROM notification_outbox WHERE id = ANY(%s)", (done,))
+                if failed:
+                    self._schedule_retries(cur, failed, now_utc)
+                conn.commit()
+
+        done_ids = set(done)
+        lag = max(((now_utc - c[4]).total_seconds() for c in claimed if c[0] in done_ids), default=None)
+        with self._lock:
+            self.batches += 1
+            self.delivered += len(done)
+            self.notifications += sum(len(rows) for outbox_id, rows in rendered if outbox_id in done_ids)
+            self._recent.append((time.monotonic(), len(done)))
+            if lag is not None:
+                self.last_lag_seconds = round(lag, 3)
+                self.max_lag_seconds = max(self.max_lag_seconds, self.last_lag_seconds)
+            self.last_batch_ms = round((time.perf_counter() - started) * 1000, 2)
+        return len(claimed)
+
+    def _schedule_retries(self, cur, failed: list[tuple], now_utc: datetime):
+        ids, next_at, dead_at, errors = [], [], [], []
+        for outbox_id, attempts, error in failed:
+            attempts += 1
+            ids.append(outbox_id)
+            next_at.append(now_utc + timedelta(seconds=_backoff_seconds(attempts)))
+            dead_at.append(now_utc if attempts >= NOTIFICATION_OUTBOX_MAX_ATTEMPTS else None)
+            errors.append(error[:1000])
+        cur.execute(
+            """
+            UPDATE notification_outbox o
+            SET attempts = o.attempts + 1,
+                next_attempt_at_utc = f.next_at,
+                dead_at_utc = f.dead_at,
+                last_error = f.error
+            FROM unnest(%s::bigint[], %s::timestamp[], %s::timestamp[], %s::text[]) AS f(id, next_at, dead_at, error)
+            WHERE o.id = f.id
+            """,
+            (ids, next_at, dead_at, errors),
+        )
+        parked = sum(1 for d in dead_at if d is not None)
+        with self._lock:
+            self.retried += len(ids) - parked
+            self.dead += parked
+            self.last_error = errors[-1]
+        for outbox_id, _, error in failed:
+            print(f"Warning: Notification outbox event {outbox_id} failed: {error}")
+
+    def _refresh_backlog(self):
+        with pooled_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    """
+                    SELECT count(*) FILTER (WHERE dead_at_utc IS NULL),
+                           min(created_at_utc) FILTER (WHERE dead_at_utc IS NULL),
+                           count(*) FILTER (WHERE dead_at_utc IS NOT NULL)
+                    FROM notification_outbox
+                    """
+                )
+                pending, oldest, dead = cur.fetchone()
+            conn.rollback()
+        self.backlog = pending
+        self.dead_total = dead
+        self.oldest_pending_seconds = round((_utcnow() - oldest).total_seconds(), 3) if oldest else None
+        self._backlog_at = time.monotonic()
+
+    def _run(self):
+        while not self._stop.is_set():
+            busy = False
+            try:
+                busy = self.drain_once() >= NOTIFICATION_OUTBOX_BATCH_SIZE
+                if time.monotonic() - self._backlog_at >= _BACKLOG_REFRESH_SECONDS:
+                    self._refresh_backlog()
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"Warning: Notification outbox dispatch failed: {e}")
+            if not busy:
+                # A full batch means more is waiting: go again now
+                self._wake.wait(NOTIFICATION_OUTBOX_POLL_SECONDS)
+                self._wake.clear()
+
+    # ---- lifecycle ----
+    def start(self):
+        """Start the dispatcher thread (no-op if disabled, already running, or DATABASE_URL is unset)."""
+        if not NOTIFICATION_OUTBOX_ENABLED or self.running:
+            return
+        if not os.getenv("DATABASE_URL"):
+            return
+        try:
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    available = outbox_available(cur)
+                conn.rollback()
+        except Exception as e:
+            print(f"Warning: Notification outbox not started: {e}")
+            return
+        if not available:
+            return
+        if self._bus_token is None:
+            self._bus_token = event_bus.subscribe(lambda _event: self._wake.set())
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="notification-outbox", daemon=True)
+        self._thread.start()
+        print(f"Info: Notification outbox dispatcher started (batch {NOTIFICATION_OUTBOX_BATCH_SIZE})")
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._bus_token is not None:
+            event_bus.unsubscribe(self._bus_token)
+            self._bus_token = None
+        if self._thread:
+            self._thread.join(timeout=10)
+            self._thread = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            cutoff = time.monotonic() - _RATE_WINDOW_SECONDS
+            while self._recent and self._recent[0][0] < cutoff:
+                self._recent.popleft()
+            recent = sum(n for _, n in self._recent)
+            return {
+                "enabled": NOTIFICATION_OUTBOX_ENABLED,
+                "running": self.running,
+                "enqueued": self.enqueued,
+                "inline": self.inline,
+                "batches": self.batches,
+                "delivered": self.delivered,
+                "notifications_created": self.notifications,
+                "delivered_per_second": round(recent / _RATE_WINDOW_SECONDS, 2),
+                "retried": self.retried,
+                "dead": self.dead,
+                "errors": self.errors,
+                "last_batch_ms": self.last_batch_ms,
+                "last_lag_seconds": self.last_lag_seconds,
+                "max_lag_seconds": self.max_lag_seconds,
+                "backlog": self.backlog,
+                "oldest_pending_seconds": self.oldest_pending_seconds,
+                "dead_total": self.dead_total,
+                "last_error": self.last_error,
+            }
+
+
+notification_outbox = OutboxDispatcher()
@@ -0,0 +1,457 @@
+"""
+Notification retention for GlobApp
+Since migration 018, notifications is partitioned by UTC month (notifications_YYYYMM; migration 020
+drops the notifications_default catch-all). notification_retention keeps the live table down to
+recent, hot months:
+    - creates month partitions NOTIFICATIONS_PRECREATE_MONTHS ahead (if a default partition is
+      still there, rows that landed in it for that month are moved into the new partition)
+    - moves read notifications older than NOTIFICATIONS_HOT_DAYS, and any notification older than
+      NOTIFICATIONS_MAX_AGE_DAYS, to notifications_archive (unread ones leave their recipient's
+      unread counter, see notification_counts.py)
+    - detaches month partitions that are past the hot window and empty with DETACH PARTITION
+      ... CONCURRENTLY (PostgreSQL 14+, needs no default partition), then drops them
+    - deletes archived rows older than NOTIFICATIONS_ARCHIVE_RETENTION_DAYS (0 = keep)
+Creating partitions ahead is not optional since migration 020 (a month without a partition
+rejects inserts), so the thread runs even with NOTIFICATIONS_RETENTION_ENABLED=false; the flag
+only turns off archiving, purging and dropping.
+
+Rows move in batches of NOTIFICATIONS_RETENTION_BATCH_SIZE, one short transaction each (at most
+NOTIFICATIONS_RETENTION_MAX_BATCHES per run), so row locks are held for one batch and a backlog
+drains over several runs. Creating a partition locks the parent table; it runs with
+NOTIFICATIONS_DDL_LOCK_TIMEOUT_MS and is retried on the next run rather than queueing behind
+readers. A concurrent detach never blocks readers or writers; one that times out is finalized on
+the next run.
+"""
+
+import os
+import threading
+import time
+from datetime import date, datetime, timedelta, timezone
+from typing import Optional
+
+from psycopg import sql
+from psycopg.errors import LockNotAvailable
+
+from db import pooled_conn
+from notification_counts import unread_counts_available
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+NOTIFICATIONS_RETENTION_ENABLED = _env("GLOBAPP_NOTIFICATIONS_RETENTION_ENABLED", "true").lower() == "true"
+NOTIFICATIONS_HOT_DAYS = int(_env("GLOBAPP_NOTIFICATIONS_HOT_DAYS", "30"))
+NOTIFICATIONS_MAX_AGE_DAYS = int(_env("GLOBAPP_NOTIFICATIONS_MAX_AGE_DAYS", "90"))
+NOTIFICATIONS_ARCHIVE_RETENTION_DAYS = int(_env("GLOBAPP_NOTIFICATIONS_ARCHIVE_RETENTION_DAYS", "0"))
+NOTIFICATIONS_PRECREATE_MONTHS = int(_env("GLOBAPP_NOTIFICATIONS_PRECREATE_MONTHS", "2"))
+NOTIFICATIONS_RETENTION_BATCH_SIZE = int(_env("GLOBAPP_NOTIFICATIONS_RETENTION_BATCH_SIZE", "1000"))
+NOTIFICATIONS_RETENTION_MAX_BATCHES = int(_env("GLOBAPP_NOTIFICATIONS_RETENTION_MAX_BATCHES", "50"))
+NOTIFICATIONS_RETENTION_PAUSE_MS = int(_env("GLOBAPP_NOTIFICATIONS_RETENTION_PAUSE_MS", "100"))
+NOTIFICATIONS_RETENTION_INTERVAL_SECONDS = float(_env("GLOBAPP_NOTIFICATIONS_RETENTION_INTERVAL_SECONDS", "3600"))
+NOTIFICATIONS_DDL_LOCK_TIMEOUT_MS = int(_env("GLOBAPP_NOTIFICATIONS_DDL_LOCK_TIMEOUT_MS", "2000"))
+
+_TABLE_RECHECK_SECONDS = 60
+_PARTITION_PREFIX = "notifications_"
+_PARTITION_LOCK_KEY = 7301003  # pg advisory lock id for "creating/dropping notification partitions"
+_BROADCAST_KEY = "00000000-0000-0000-0000-000000000000"
+
+_COLUMNS = (
+    "id, ride_id, driver_id, recipient_type, recipient_id, notification_type, title, message, "
+    "channel, status, metadata_json, created_at_utc, sent_at_utc, read_at_utc, error_message"
+)
+_MOVED_COLUMNS = ", ".join(f"n.{c.strip()}" for c in _COLUMNS.split(","))
+
+_partitioned: Optional[bool] = None
+_checked_at = 0.0
+
+
+def notifications_partitioned(cur) -> bool:
+    """Whether migration 018 has run (cached; re-checked every minute until it has)."""
+    global _partitioned, _checked_at
+    if _partitioned or (_partitioned is False and time.monotonic() - _checked_at < _TABLE_RECHECK_SECONDS):
+        return _partitioned
+    cur.execute(
+        "SELECT (SELECT relkind FROM pg_class WHERE oid = to_regclass('notifications')) = 'p' "
+        "AND to_regclass('notifications_archive') IS NOT NULL"
+    )
+    _partitioned = bool(cur.fetchone()[0])
+    _checked_at = time.monotonic()
+    if not _partitioned:
+        print("Warning: notifications is not partitioned; no retention. Run migrations/018_partition_notifications.sql")
+    return _partitioned
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _month_start(d: date) -> date:
+    return date(d.year, d.month, 1)
+
+
+def _add_months(month: date, n: int) -> date:
+    y, m = divmod(month.month - 1 + n, 12)
+    return date(month.year + y, m + 1, 1)
+
+
+def _partition_name(month: date) -> str:
+    return f"{_PARTITION_PREFIX}{month:%Y%m}"
+
+
+def _existing_partition_months(cur) -> set:
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('notifications')
+        """
+    )
+    months = set()
+    for (name,) in cur.fetchall():
+        try:
+            months.add(datetime.strptime(name[len(_PARTITION_PREFIX):], "%Y%m").date())
+        except ValueError:
+            pass  # notifications_default, or not one of ours
+    return months
+
+
+def _has_default_partition(cur) -> bool:
+    cur.execute("SELECT to_regclass('notifications_default') IS NOT NULL")
+    return bool(cur.fetchone()[0])
+
+
+def _detach_pending(cur) -> set:
+    """Partitions left half-detached by an interrupted DETACH ... CONCURRENTLY."""
+    cur.execute(
+        """
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = to_regclass('notifications') AND i.inhdetachpending
+        """
+    )
+    return {r[0] for r in cur.fetchall()}
+
+
+def _ddl_transaction(cur):
+    cur.execute("SELECT pg_advisory_xact_lock(%s)", (_PARTITION_LOCK_KEY,))
+    cur.execute(f"SET LOCAL lock_timeout = {int(NOTIFICATIONS_DDL_LOCK_TIMEOUT_MS)}")
+
+
+def _create_month_partition(cur, month: date):
+    name = sql.Identifier(_partition_name(month))
+    bounds = (month, _add_months(month, 1))
+    in_default = False
+    if _has_default_partition(cur):
+        cur.execute(
+            "SELECT EXISTS (SELECT 1 FROM notifications_default WHERE created_at_utc >= %s AND created_at_utc < %s)",
+            bounds,
+        )
+        in_default = cur.fetchone()[0]
+    if not in_default:
+        cur.execute(
+            sql.SQL("CREATE TABLE IF NOT EXISTS {} PARTITION OF notifications FOR VALUES FROM ({}) TO ({})").format(
+                name, sql.Literal(bounds[0]), sql.Literal(bounds[1])
+            )
+        )
+        return
+    # The month already has rows in the default partition: build the partition beside the table,
+    # move them in, then attach it (attaching checks the default no longer holds any of the month)
+    cur.execute(sql.SQL("CREATE TABLE {} (LIKE notifications INCLUDING DEFAULTS INCLUDING CONSTRAINTS)").format(name))
+    cur.execute(
+        sql.SQL(
+            "WITH moved AS (DELETE FROM notifications_default WHERE created_at_utc >= %s AND created_at_utc < %s "
+            "RETURNING {columns}) INSERT INTO {name} ({columns}) SELECT {columns} FROM moved"
+        ).format(columns=sql.SQL(_COLUMNS), name=name),
+        bounds,
+    )
+    print(f"Info: Moved {cur.rowcount} notification(s) from notifications_default to {_partition_name(month)}")
+    cur.execute(
+        sql.SQL("ALTER TABLE notifications ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+            name, sql.Literal(bounds[0]), sql.Literal(bounds[1])
+        )
+    )
+
+
+def ensure_month_partitions(months_ahead: int = NOTIFICATIONS_PRECREATE_MONTHS) -> int:
+    """Create this month's and the next months_ahead partitions if missing. Returns partitions created."""
+    this_month = _month_start(_utcnow().date())
+    wanted = {_add_months(this_month, i) for i in range(months_ahead + 1)}
+    created = 0
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            _ddl_transaction(cur)
+            existing = _existing_partition_months(cur)
+            for month in sorted(wanted - existing):
+                _create_month_partition(cur, month)
+                created += 1
+        conn.commit()
+    return created
+
+
+def drop_empty_partitions(hot_days: int = NOTIFICATIONS_HOT_DAYS) -> tuple[list[str], bool]:
+    """
+    Drop month partitions that end before the hot window and hold no rows. Each is detached with
+    DETACH PARTITION ... CONCURRENTLY, which runs outside a transaction and only waits for queries
+    already using the partition, then the detached table is dropped.
+    Returns (dropped names, whether a detach gave up on the lock timeout).
+    """
+    hot_cutoff = (_utcnow() - timedelta(days=hot_days)).date()
+    dropped = []
+    with pooled_conn() as conn:
+        with conn.cursor() as cur:
+            existing = _existing_partition_months(cur)
+            has_default = _has_default_partition(cur)
+        conn.rollback()
+        due = sorted(m for m in existing if _add_months(m, 1) <= hot_cutoff)
+        if not due:
+            return dropped, False
+        if has_default:
+            print("Warning: notifications_default exists; old notification partitions are not dropped. Run migrations/020_notifications_drop_default_partition.sql")
+            return dropped, False
+
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT pg_advisory_lock(%s)", (_PARTITION_LOCK_KEY,))
+                try:
+                    cur.execute(f"SET lock_timeout = {int(NOTIFICATIONS_DDL_LOCK_TIMEOUT_MS)}")
+                    # A detach interrupted last run blocks any other until it is finalized
+                    pending = _detach_pending(cur)
+                    due.sort(key=lambda m: _partition_name(m) not in pending)
+                    for month in due:
+                        name = sql.Identifier(_partition_name(month))
+                        if _partition_name(month) in pending:
+                            cur.execute(sql.SQL("ALTER TABLE notifications DETACH PARTITION {} FINALIZE").format(name))
+                        else:
+                            cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(name))
+                            if cur.fetchone()[0]:
+                                continue
+                            cur.execute(sql.SQL("ALTER TABLE notifications DETACH PARTITION {} CONCURRENTLY").format(name))
+                        cur.execute(sql.SQL("SELECT EXISTS (SELECT 1 FROM {})").format(name))
+                        if cur.fetchone()[0]:
+                            # A row landed between the check and the detach: put the month back
+                            cur.execute(
+                                sql.SQL("ALTER TABLE notifications ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})").format(
+                                    name, sql.Literal(month), sql.Literal(_add_months(month, 1))
+                                )
+                            )
+                            continue
+                        cur.execute(sql.SQL("DROP TABLE {}").format(name))
+                        dropped.append(_partition_name(month))
+                except LockNotAvailable:
+                    # A timed-out concurrent detach stays pending; the next run finalizes it
+                    return dropped, True
+                finally:
+                    cur.execute("RESET lock_timeout")
+                    cur.execute("SELECT pg_advisory_unlock(%s)", (_PARTITION_LOCK_KEY,))
+        finally:
+            conn.autocommit = False
+    return dropped, False
+
+
+def archive_batch(cur, now_utc: datetime, batch_size: int = NOTIFICATIONS_RETENTION_BATCH_SIZE) -> int:
+    """
+    Move one batch of notifications past the hot window (read) or the max age (any) to
+    notifications_archive, oldest first, on the caller's transaction. Rows locked by a concurrent
+    mark-read are skipped. Returns rows moved.
+    """
+    hot_cutoff = now_utc - timedelta(days=NOTIFICATIONS_HOT_DAYS)
+    max_age_cutoff = now_utc - timedelta(days=NOTIFICATIONS_MAX_AGE_DAYS)
+    counted_sql = ""
+    if unread_counts_available(cur):
+        # Unread rows aged out of the live table leave their recipient's unread count
+        counted_sql = """
+        , uncounted AS (
+            SELECT recipient_type, COALESCE(recipient_id, %(broadcast)s::uuid) AS recipient_key, count(*) AS n
+            FROM moved
+            WHERE status != 'read'
+            GROUP BY 1, 2
+        ), counted AS (
+            UPDATE notification_unread_counts c
+            SET unread_count = GREATEST(c.unread_count - u.n, 0),
+                updated_at_utc = %(now)s
+            FROM uncounted u
+            WHERE c.recipient_type = u.recipient_type AND c.recipient_key = u.recipient_key
+        )
+        """
+    cur.execute(
+        f"""
+        WITH batch AS (
+            SELECT id, created_at_utc
+            FROM notifications
+            WHERE created_at_utc < %(hot_cutoff)s
+              AND (status = 'read' OR created_at_utc < %(max_age_cutoff)s)
+            ORDER BY created_at_utc
+            LIMIT %(batch_size)s
+            FOR UPDATE SKIP LOCKED
+        ), moved AS (
+            DELETE FROM notifications n
+            USING batch b
+            WHERE n.id = b.id AND n.created_at_utc = b.created_at_utc
+            RETURNING {_MOVED_COLUMNS}
+        ), archived AS (
+            INSERT INTO notifications_archive ({_COLUMNS}, archived_at_utc)
+            SELECT {_COLUMNS}, %(now)s FROM moved
+            ON CONFLICT (id) DO NOTHING
+        ){counted_sql}
+        SELECT count(*) FROM moved
+        """,
+        {
+            "hot_cutoff": hot_cutoff,
+            "max_age_cutoff": max_age_cutoff,
+            "batch_size": batch_size,
+            "now": now_utc,
+            "broadcast": _BROADCAST_KEY,
+        },
+    )
+    return int(cur.fetchone()[0])
+
+
+def purge_archive_batch(cur, now_utc: datetime, batch_size: int = NOTIFICATIONS_RETENTION_BATCH_SIZE) -> int:
+    """Delete one batch of archived notifications past NOTIFICATIONS_ARCHIVE_RETENTION_DAYS. Returns rows deleted."""
+    cur.execute(
+        """
+        DELETE FROM notifications_archive
+        WHERE id IN (
+            SELECT id FROM notifications_archive
+            WHERE created_at_utc < %s
+            ORDER BY created_at_utc
+            LIMIT %s
+        )
+        """,
+        (now_utc - timedelta(days=NOTIFICATIONS_ARCHIVE_RETENTION_DAYS), batch_size),
+    )
+    return cur.rowcount
+
+
+class NotificationRetention:
+    """Background retention for notifications: partitions ahead, batched archive moves, empty partition drops."""
+
+    def __init__(self):
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.runs = 0
+        self.archived = 0
+        self.purged = 0
+        self.batches = 0
+        self.partitions_created = 0
+        self.partitions_dropped = 0
+        self.lock_timeouts = 0
+        self.errors = 0
+        self.last_run_utc: Optional[datetime] = None
+        self.last_run_seconds: Optional[float] = None
+        self.last_error: Optional[str] = None
+        self.backlog_left = False  # last run stopped at MAX_BATCHES with rows still due
+
+    def _batches(self, step) -> tuple[int, bool]:
+        """Run step(cur, now) one transaction at a time until a short batch. Returns (rows, more left)."""
+        total = 0
+        for _ in range(NOTIFICATIONS_RETENTION_MAX_BATCHES):
+            if self._stop.is_set():
+                return total, True
+            with pooled_conn() as conn:
+                with conn.cursor() as cur:
+                    n = step(cur, _utcnow(), NOTIFICATIONS_RETENTION_BATCH_SIZE)
+                conn.commit()
+            self.batches += 1
+            total += n
+            if n < NOTIFICATIONS_RETENTION_BATCH_SIZE:
+                return total, False
+            self._stop.wait(NOTIFICATIONS_RETENTION_PAUSE_MS / 1000.0)
+        return total, True
+
+    def run_once(self) -> dict:
+        started = time.monotonic()
+        with pooled_conn() as conn:
+            with conn.cursor() as cur:
+                if not notifications_partitioned(cur):
+                    return {"created": 0, "archived": 0, "purged": 0, "dropped": []}
+        created = 0
+        try:
+            created = ensure_month_partitions()
+        except LockNotAvailable:
+            self.lock_timeouts += 1
+        if not NOTIFICATIONS_RETENTION_ENABLED:
+            self.runs += 1
+            self.partitions_created += created
+            self.last_run_utc = _utcnow()
+            self.last_run_seconds = round(time.monotonic() - started, 3)
+            return {"created": created, "archived": 0, "purged": 0, "dropped": []}
+        archived, more_archive = self._batches(archive_batch)
+        purged, more_purge = 0, False
+        if NOTIFICATIONS_ARCHIVE_RETENTION_DAYS > 0:
+            purged, more_purge = self._batches(purge_archive_batch)
+        dropped, busy = drop_empty_partitions()
+        if busy:
+            self.lock_timeouts += 1
+        self.runs += 1
+        self.archived += archived
+        self.purged += purged
+        self.partitions_created += created
+        self.partitions_dropped += len(dropped)
+        self.backlog_left = more_archive or more_purge
+        self.last_run_utc = _utcnow()
+        self.last_run_seconds = round(time.monotonic() - started, 3)
+        if created or archived or purged or dropped:
+            print(
+                f"Info: Notification retention: archived {archived}, purged {purged}, "
+                f"partitions created {created}, dropped {len(dropped)}"
+            )
+        return {"created": created, "archived": archived, "purged": purged, "dropped": dropped}
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                self.run_once()
+                self.last_error = None
+            except Exception as e:
+                self.errors += 1
+                self.last_error = str(e)
+                print(f"Warning: Notification retention failed: {e}")
+            # A run that hit MAX_BATCHES comes back sooner to keep draining
+            self._stop.wait(min(NOTIFICATIONS_RETENTION_INTERVAL_SECONDS, 60) if self.backlog_left else NOTIFICATIONS_RETENTION_INTERVAL_SECONDS)
+
+    def start(self):
+        """
+        Start the retention thread (no-op if already running or DATABASE_URL is unset). It runs even
+        when retention is disabled, to keep creating month partitions.
+        """
+        if (self._thread and self._thread.is_alive()) or not os.getenv("DATABASE_URL"):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="notification-retention", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "enabled": NOTIFICATIONS_RETENTION_ENABLED,
+            "partitioned": _partitioned,
+            "hot_days": NOTIFICATIONS_HOT_DAYS,
+            "max_age_days": NOTIFICATIONS_MAX_AGE_DAYS,
+            "archive_retention_days": NOTIFICATIONS_ARCHIVE_RETENTION_DAYS,
+            "runs": self.runs,
+            "archived": self.archived,
+            "purged": self.purged,
+            "batches": self.batches,
+            "backlog_left": self.backlog_left,
+            "partitions_created": self.partitions_created,
+            "partitions_dropped": self.partitions_dropped,
+            "lock_timeouts": self.lock_timeouts,
+            "errors": self.errors,
+            "last_run_utc": self.last_run_utc.isoformat() if self.last_run_utc else None,
+            "last_run_seconds": self.last_run_seconds,
+            "last_error": self.last_error,
+        }
+
+
+notification_retention = NotificationRetention()
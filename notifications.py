@@ -1,23 +1,27 @@
 """
 Notification Service for GlobApp
 Handles sending notifications for ride events (booking, assignment, status updates)
+
+All of an event's recipients (rider, driver, admin) are rendered first and written with one
+multi-row INSERT. Ride write paths pass their cursor so the notifications commit atomically with
+the ride change instead of costing a connection and a commit per recipient.
 """
 
 from uuid import UUID, uuid4
 from datetime import datetime, timezone
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, Iterable, List
 import json
-import psycopg
 from psycopg.errors import UndefinedTable
-import os
 
-# Database connection helper (import from app.py or define here)
+from db import pooled_conn
+from event_bus import publish_notifications
+from notification_counts import add_unread
+
+
+# Database connection helper (shares the process-wide pool with app.py, see db.py)
 def db_conn():
-    """Get database connection"""
-    database_url = os.getenv("DATABASE_URL")
-    if not database_url:
-        raise ValueError("DATABASE_URL environment variable is not set")
-    return psycopg.connect(database_url)
+    """Borrow a database connection from the shared pool"""
+    return pooled_conn()
 
 
 # Notification types
@@ -61,7 +65,7 @@ NOTIFICATION_TYPES = {
 }
 
 
-def create_notification(
+def build_notification(
     ride_id: UUID,
     recipient_type: str,  # 'rider', 'driver', 'admin'
     notification_type: str,
@@ -69,9 +73,9 @@ def create_notification(
     driver_id: Optional[UUID] = None,
     channel: str = "in_app",
     metadata: Optional[Dict[str, Any]] = None,
-) -> Optional[UUID]:
+) -> Optional[tuple]:
     """
-    Create a notification record in the database
+    Render one notification row (not written yet; pass a list of these to create_notifications)
     
     Args:
         ride_id: UUID of the ride
@@ -83,7 +87,7 @@ def create_notification(
         metadata: Additional data for the notification
     
     Returns:
-        UUID of the created notification, or None if creation failed
+        Row tuple in _NOTIFICATION_COLUMNS order, or None for an unknown notification type
     """
     if notification_type not in NOTIFICATION_TYPES:
         print(f"Warning: Unknown notification type: {notification_type}")
@@ -108,120 +112,150 @@ def create_notification(
             # Use unformatted message if formatting fails
             pass
     
-    title = notification_config["title"]
-    notification_id = uuid4()
-    created_at_utc = datetime.now(timezone.utc).replace(tzinfo=None)
+    return (
+        str(uuid4()),
+        str(ride_id),
+        str(driver_id) if driver_id else None,
+        recipient_type,
+        str(recipient_id) if recipient_id else None,
+        notification_type,
+        notification_config["title"],
+        message,
+        channel,
+        "pending",
+        json.dumps(metadata or {}),
+        datetime.now(timezone.utc).replace(tzinfo=None),
+    )
+
+
+_NOTIFICATION_COLUMNS = (
+    "id", "ride_id", "driver_id", "recipient_type", "recipient_id", "notification_type",
+    "title", "message", "channel", "status", "metadata_json", "created_at_utc",
+)
+_NOTIFICATION_TYPES_SQL = (
+    "uuid[]", "uuid[]", "uuid[]", "text[]", "uuid[]", "text[]",
+    "text[]", "text[]", "text[]", "text[]", "jsonb[]", "timestamp[]",
+)
+_INSERT_NOTIFICATIONS_SQL = (
+    f"INSERT INTO notifications ({', '.join(_NOTIFICATION_COLUMNS)}) "
+    f"SELECT * FROM unnest({', '.join('%s::' + t for t in _NOTIFICATION_TYPES_SQL)})"
+)
+
+
+def insert_notifications(cur, rows: List[tuple]):
+    """
+    One INSERT for any number of built rows (each column goes over as one array), the recipients'
+    unread counters, and one notification_bus event so long-polling recipients wake at commit.
+    No rows is a no-op. Raises on error.
+    """
+    if not rows:
+        return
+    recipients = [(r[3], r[4]) for r in rows]
+    cur.execute(_INSERT_NOTIFICATIONS_SQL, [list(col) for col in zip(*rows)])
+    add_unread(cur, recipients, datetime.now(timezone.utc).replace(tzinfo=None))
+    publish_notifications(cur, recipients)
+
+
+def create_notifications(rows: Iterable[Optional[tuple]], cur=None) -> List[UUID]:
+    """
+    Write notifications built with build_notification() in one multi-row INSERT.
+    
+    With cur, the insert joins the caller's transaction (committed or rolled back with the ride
+    write) inside a savepoint, so a notification failure never aborts the caller's transaction.
+    Without cur, a pooled connection is borrowed and committed.
     
+    Returns:
+        UUIDs of the created notifications (empty if nothing was written)
+    """
+    rows = [r for r in rows if r is not None]
+    if not rows:
+        return []
     try:
-        with db_conn() as conn:
-            with conn.cursor() as cur:
-                cur.execute(
-                    """
-                    INSERT INTO notifications (
-                        id, ride_id, driver_id, recipient_type, recipient_id,
-                        notification_type, title, message, channel, status,
-                        metadata_json, created_at_utc
-                    )
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-                    """,
-                    (
-                        str(notification_id),
-                        str(ride_id),
-                        str(driver_id) if driver_id else None,
-                        recipient_type,
-                        str(recipient_id) if recipient_id else None,
-                        notification_type,
-                        title,
-                        message,
-                        channel,
-                        "pending",
-                        json.dumps(metadata or {}),
-                        created_at_utc,
-                    ),
-                )
+        if cur is not None:
+            with cur.connection.transaction():
+                insert_notifications(cur, rows)
+        else:
+            with db_conn() as conn:
+                with conn.cursor() as own_cur:
+                    insert_notifications(own_cur, rows)
                 conn.commit()
-        return notification_id
+        return [UUID(r[0]) for r in rows]
     except UndefinedTable:
         print("Info: notifications table not found. Run migration 005_add_notifications_table.sql")
-        return None
+        return []
     except Exception as e:
-        print(f"Warning: Failed to create notification: {e}")
-        return None
+        print(f"Warning: Failed to create {len(rows)} notification(s): {e}")
+        return []
+
+
+def create_notification(
+    ride_id: UUID,
+    recipient_type: str,  # 'rider', 'driver', 'admin'
+    notification_type: str,
+    recipient_id: Optional[UUID] = None,
+    driver_id: Optional[UUID] = None,
+    channel: str = "in_app",
+    metadata: Optional[Dict[str, Any]] = None,
+    cur=None,
+) -> Optional[UUID]:
+    """
+    Create a single notification record (see build_notification for the arguments)
+    
+    Returns:
+        UUID of the created notification, or None if creation failed
+    """
+    row = build_notification(ride_id, recipient_type, notification_type, recipient_id, driver_id, channel, metadata)
+    created = create_notifications([row], cur=cur)
+    return created[0] if created else None
 
 
-def notify_ride_booked(ride_id: UUID, rider_name: str, pickup: str, dropoff: str, rider_phone: Optional[str] = None):
-    """Send notifications when a ride is booked"""
+def ride_booked_notifications(ride_id: UUID, rider_name: str, pickup: str, dropoff: str) -> List[Optional[tuple]]:
+    """Rider + admin rows for a booked ride"""
     metadata = {
         "rider_name": rider_name,
         "pickup": pickup,
         "dropoff": dropoff,
     }
-    
-    # Notify rider (use ride_id as recipient_id for riders - they can query by ride_id)
-    create_notification(
-        ride_id=ride_id,
-        recipient_type="rider",
-        notification_type="ride_booked",
-        recipient_id=ride_id,  # Use ride_id as recipient_id for riders
-        channel="in_app",
-        metadata=metadata,
-    )
-    
-    # Notify admin (broadcast)
-    create_notification(
-        ride_id=ride_id,
-        recipient_type="admin",
-        notification_type="ride_booked",
-        recipient_id=None,  # Admin notifications are broadcast
-        channel="in_app",
-        metadata=metadata,
-    )
+    return [
+        # Riders are addressed by ride_id (they can query by ride_id)
+        build_notification(ride_id, "rider", "ride_booked", recipient_id=ride_id, metadata=metadata),
+        # Admin notifications are broadcast
+        build_notification(ride_id, "admin", "ride_booked", recipient_id=None, metadata=metadata),
+    ]
 
 
-def notify_ride_assigned(ride_id: UUID, driver_id: UUID, driver_name: str, rider_name: str, pickup: str, dropoff: str):
-    """Send notifications when a ride is assigned to a driver"""
+def ride_assigned_notifications(
+    ride_id: UUID, driver_id: UUID, driver_name: str, rider_name: str, pickup: str, dropoff: str
+) -> List[Optional[tuple]]:
+    """Rider + driver + admin rows for an assignment"""
     metadata = {
         "driver_name": driver_name,
         "rider_name": rider_name,
         "pickup": pickup,
         "dropoff": dropoff,
     }
-    
-    # Notify rider (use ride_id as recipient_id for riders)
-    create_notification(
-        ride_id=ride_id,
-        recipient_type="rider",
-        notification_type="ride_assigned",
-        recipient_id=ride_id,  # Use ride_id as recipient_id for riders
-        driver_id=driver_id,
-        channel="in_app",
-        metadata=metadata,
-    )
-    
-    # Notify driver
-    create_notification(
-        ride_id=ride_id,
-        recipient_type="driver",
-        notification_type="ride_assigned",
-        recipient_id=driver_id,
-        driver_id=driver_id,
-        channel="in_app",
-        metadata=metadata,
-    )
-    
-    # Notify admin
-    create_notification(
-        ride_id=ride_id,
-        recipient_type="admin",
-        notification_type="ride_assigned",
-        recipient_id=None,
-        driver_id=driver_id,
-        channel="in_app",
-        metadata=metadata,
-    )
+    return [
+        build_notification(ride_id, "rider", "ride_assigned", recipient_id=ride_id, driver_id=driver_id, metadata=metadata),
+        build_notification(ride_id, "driver", "ride_assigned", recipient_id=driver_id, driver_id=driver_id, metadata=metadata),
+        build_notification(ride_id, "admin", "ride_assigned", recipient_id=None, driver_id=driver_id, metadata=metadata),
+    ]
 
 
-def notify_ride_status_update(
+_STATUS_TO_NOTIFICATION_TYPE = {
+    "enroute": "ride_enroute",
+    "arrived": "ride_arrived",
+    "in_progress": "ride_in_progress",
+    "completed": "ride_completed",
+    "cancelled": "ride_cancelled",
+}
+
+
+def notifies_status(status: str) -> bool:
+    """Whether a ride status change produces notifications (e.g. "assigned" is sent on its own path)."""
+    return status in _STATUS_TO_NOTIFICATION_TYPE
+
+
+def ride_status_notifications(
     ride_id: UUID,
     driver_id: UUID,
     driver_name: str,
@@ -229,19 +263,11 @@ def notify_ride_status_update(
     pickup: str,
     dropoff: str,
     status: str,
-):
-    """Send notifications when ride status is updated"""
-    status_to_notification_type = {
-        "enroute": "ride_enroute",
-        "arrived": "ride_arrived",
-        "in_progress": "ride_in_progress",
-        "completed": "ride_completed",
-        "cancelled": "ride_cancelled",
-    }
-    
-    notification_type = status_to_notification_type.get(status)
+) -> List[Optional[tuple]]:
+    """Rider + driver rows for a status change (+ admin for completed/cancelled)"""
+    notification_type = _STATUS_TO_NOTIFICATION_TYPE.get(status)
     if not notification_type:
-        return  # Unknown status, skip notification
+        return []  # Unknown status, skip notification
     
     metadata = {
         "driver_name": driver_name,
@@ -249,38 +275,43 @@ def notify_ride_status_update(
         "pickup": pickup,
         "dropoff": dropoff,
     }
-    
-    # Notify rider (use ride_id as recipient_id for riders)
-    create_notification(
-        ride_id=ride_id,
-        recipient_type="rider",
-        notification_type=notification_type,
-        recipient_id=ride_id,  # Use ride_id as recipient_id for riders
-        driver_id=driver_id,
-        channel="in_app",
-        metadata=metadata,
-    )
-    
-    # Notify driver
-    create_notification(
-        ride_id=ride_id,
-        recipient_type="driver",
-        notification_type=notification_type,
-        recipient_id=driver_id,
-        driver_id=driver_id,
-        channel="in_app",
-        metadata=metadata,
-    )
-    
+    rows = [
+        build_notification(ride_id, "rider", notification_type, recipient_id=ride_id, driver_id=driver_id, metadata=metadata),
+        build_notification(ride_id, "driver", notification_type, recipient_id=driver_id, driver_id=driver_id, metadata=metadata),
+    ]
     # Notify admin for important status changes
     if status in ("completed", "cancelled"):
-        create_notification(
-            ride_id=ride_id,
-            recipient_type="admin",
-            notification_type=notification_type,
-            recipient_id=None,
-            driver_id=driver_id,
-            channel="in_app",
-            metadata=metadata,
-        )
+        rows.append(build_notification(ride_id, "admin", notification_type, recipient_id=None, driver_id=driver_id, metadata=metadata))
+    return rows
+
+
+def notify_ride_booked(
+    ride_id: UUID, rider_name: str, pickup: str, dropoff: str, rider_phone: Optional[str] = None, cur=None
+):
+    """Send notifications when a ride is booked (pass cur to write on the booking transaction)"""
+    create_notifications(ride_booked_notifications(ride_id, rider_name, pickup, dropoff), cur=cur)
+
 
+def notify_ride_assigned(
+    ride_id: UUID, driver_id: UUID, driver_name: str, rider_name: str, pickup: str, dropoff: str, cur=None
+):
+    """Send notifications when a ride is assigned to a driver (pass cur to write on the assignment transaction)"""
+    create_notifications(
+        ride_assigned_notifications(ride_id, driver_id, driver_name, rider_name, pickup, dropoff), cur=cur
+    )
+
+
+def notify_ride_status_update(
+    ride_id: UUID,
+    driver_id: UUID,
+    driver_name: str,
+    rider_name: str,
+    pickup: str,
+    dropoff: str,
+    status: str,
+    cur=None,
+):
+    """Send notifications when ride status is updated (pass cur to write on the status transaction)"""
+    create_notifications(
+        ride_status_notifications(ride_id, driver_id, driver_name, rider_name, pickup, dropoff, status), cur=cur
+    )
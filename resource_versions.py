@@ -0,0 +1,212 @@
+"""
+In-memory resource versions for conditional GETs (ETag / If-None-Match)
+Polling endpoints (GET /rides/{id}, /rides/{id}/driver-location, /rides/{id}/messages,
+/driver/assigned-ride) tag responses with a version held in memory and answer a matching
+If-None-Match with 304 before touching Postgres.
+
+Versions are counters bumped by ride events from event_bus (Postgres NOTIFY), so writes made by
+any worker or by dispatch_worker.py invalidate them here:
+    ride:<ride_id>        any ride event except ride.message (ride row, payment, final fare)
+    messages:<ride_id>    ride.message
+    driver:<driver_id>    any ride event naming the driver, or a ride the driver was last seen on
+                          or its previous_driver_id (so a reassignment or cancellation changes
+                          the old driver's assigned-ride too)
+
+A tag is only valid for one listener session: it embeds a per-process token and the listener's
+reconnect count, and none are issued while the listener is down (events may have been missed),
+so callers fall back to a DB read and a content hash. A poll can see a 304 for at most the
+NOTIFY delivery lag after a commit. Tags differ between workers; behind a load balancer a poll
+that lands on another worker is simply a full response.
+
+Callers must take the tag *before* reading, so a change that races the read leaves the client
+with an older tag and the next poll refetches.
+"""
+
+import hashlib
+import json
+import os
+import secrets
+import threading
+from typing import Optional
+
+from event_bus import event_bus
+
+
+def _env(name: str, default: str) -> str:
+    v = (os.getenv(name) or "").strip()
+    return v if v else default
+
+
+RESOURCE_VERSIONS_ENABLED = _env("GLOBAPP_RESOURCE_VERSIONS_ENABLED", "true").lower() == "true"
+RESOURCE_VERSIONS_MAX_KEYS = int(_env("GLOBAPP_RESOURCE_VERSIONS_MAX_KEYS", "200000"))
+
+_NO_DRIVER = ""
+_ASSIGNMENT_EVENTS = frozenset({"ride.assigned", "ride.accepted", "ride.status_changed"})
+
+
+def content_etag(body) -> str:
+    """Weak ETag from a hash of the JSON body (used when no in-memory version is available)."""
+    digest = hashlib.blake2b(json.dumps(body, sort_keys=True, default=str).encode("utf-8"), digest_size=12)
+    return f'W/"c{digest.hexdigest()}"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: Optional[str]) -> bool:
+    """If-None-Match comparison (weak, so W/ prefixes are ignored)."""
+    if not if_none_match or not etag:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    want = etag[2:] if etag.startswith("W/") else etag
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if (tag[2:] if tag.startswith("W/") else tag) == want:
+            return True
+    return False
+
+
+class ResourceVersions:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: dict[str, int] = {}
+        self._ride_drivers: dict[str, str] = {}  # ride_id -> last known assigned driver ("" = none)
+        self._token = secrets.token_hex(4)
+        self._generation = 0
+        self._session = 0
+        self._bus_token: Optional[int] = None
+        self.events = 0
+        self.bumps = 0
+        self.resets = 0
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    @property
+    def live(self) -> bool:
+        """True when tags can be served from memory (subscribed and the listener is connected)."""
+        return self._bus_token is not None and event_bus.listening
+
+    def _epoch(self) -> str:
+        return f"{self._token}.{self._generation}.{event_bus.reconnects}"
+
+    def _check_session(self):
+        # Caller holds self._lock. After a listener reconnect events may have been missed, so
+        # drop what we know; the epoch (and so every tag) changes with the reconnect count.
+        if self._session != event_bus.reconnects:
+            self._session = event_bus.reconnects
+            self._versions.clear()
+            self._ride_drivers.clear()
+
+    # ---- events ----
+    def _on_ride_event(self, event: dict):
+        ride_id = event.get("ride_id")
+        if not ride_id:
+            return
+        self.events += 1
+        if event.get("type") == "ride.message":
+            self._bump(f"messages:{ride_id}")
+            return
+        event_type = event.get("type")
+        driver_id = event.get("driver_id")
+        with self._lock:
+            self._check_session()
+            previous = self._ride_drivers.get(ride_id)
+            if driver_id:
+                self._ride_drivers[ride_id] = driver_id
+            elif event_type in ("ride.created", "ride.cancelled"):
+                self._ride_drivers[ride_id] = _NO_DRIVER
+            elif event_type in _ASSIGNMENT_EVENTS:
+                self._ride_drivers.pop(ride_id, None)  # unknown now; the next read records it
+        self._bump(f"ride:{ride_id}")
+        for d in {driver_id, previous, event.get("previous_driver_id")} - {None, _NO_DRIVER}:
+            self._bump(f"driver:{d}")
+
+    def _bump(self, key: str):
+        with self._lock:
+            self._check_session()
+            if key not in self._versions and len(self._versions) >= RESOURCE_VERSIONS_MAX_KEYS:
+                # Forget everything: a new generation invalidates every tag handed out so far
+                self._versions.clear()
+                self._ride_drivers.clear()
+                self._generation += 1
+                self.resets += 1
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self.bumps += 1
+
+    # ---- tags ----
+    def etag(self, kind: str, key) -> Optional[str]:
+        """Current tag for a resource (None when not live)."""
+        if not self.live:
+            return None
+        name = f"{kind}:{key}"
+        with self._lock:
+            self._check_session()
+            version = self._versions.get(name, 0)
+            epoch = self._epoch()
+        return f'W/"v{epoch}.{version}"'
+
+    @staticmethod
+    def extend(etag: Optional[str], *extra) -> Optional[str]:
+        """Fold more state into a tag (e.g. a position timestamp or a page size)."""
+        if etag is None:
+            return None
+        return etag[:-1] + "".join(f".{x}" for x in extra) + '"'
+
+    def ride_driver(self, ride_id) -> tuple[bool, Optional[str]]:
+        """(known, driver_id) for a ride from events/reads seen in this listener session."""
+        with self._lock:
+            self._check_session()
+            d = self._ride_drivers.get(str(ride_id))
+        if d is None:
+            return False, None
+        return True, (d or None)
+
+    def remember_driver(self, ride_id, driver_id, etag: Optional[str]):
+        """Record a ride's driver from a read, if the ride hasn't changed since etag was taken."""
+        if etag is None or etag != self.etag("ride", ride_id):
+            return
+        with self._lock:
+            if len(self._ride_drivers) < RESOURCE_VERSIONS_MAX_KEYS:
+                self._ride_drivers[str(ride_id)] = str(driver_id) if driver_id else _NO_DRIVER
+
+    def not_modified(self, if_none_match: Optional[str], etag: Optional[str]) -> bool:
+        """Whether to answer 304 (counts hits/misses for stats)."""
+        if etag is None:
+            self.fallbacks += 1
+            return False
+        if etag_matches(if_none_match, etag):
+            self.hits += 1
+            return True
+        self.misses += 1
+        return False
+
+    # ---- lifecycle ----
+    def start(self):
+        """Subscribe to ride events (no-op if disabled or already subscribed)."""
+        if not RESOURCE_VERSIONS_ENABLED or self._bus_token is not None:
+            return
+        self._bus_token = event_bus.subscribe(self._on_ride_event)
+
+    def stop(self):
+        if self._bus_token is not None:
+            event_bus.unsubscribe(self._bus_token)
+            self._bus_token = None
+
+    def stats(self) -> dict:
+        with self._lock:
+            keys = len(self._versions)
+            rides = len(self._ride_drivers)
+        return {
+            "enabled": RESOURCE_VERSIONS_ENABLED,
+            "live": self.live,
+            "keys": keys,
+            "ride_drivers": rides,
+            "events": self.events,
+            "bumps": self.bumps,
+            "resets": self.resets,
+            "not_modified": self.hits,
+            "modified": self.misses,
+            "fallbacks": self.fallbacks,
+        }
+
+
+resource_versions = ResourceVersions()